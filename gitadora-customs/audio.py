@@ -1,7 +1,11 @@
 # Audio-related helper functions
 
+import hashlib
 import os
+import struct
 import subprocess
+import threading
+import wave
 import pydub
 import tmpfile
 
@@ -9,6 +13,25 @@ import helper
 
 helper.check_ffmpeg()
 
+# Durations keyed by (path, mtime, size) so each keysound is only probed once,
+# even when the same sounds are shared between the drum, guitar and bass parts
+duration_cache = {}
+
+# Decoded samples keyed by (path, mtime, size). The least recently used
+# sounds are dropped once the cached PCM adds up to more than
+# DECODED_SAMPLES_CACHE_SIZE bytes so a large sound set can't use up all memory.
+# decoded_samples_cache_size is the number of bytes currently cached.
+DECODED_SAMPLES_CACHE_SIZE = 128 * 1024 * 1024
+decoded_samples_cache = {}
+decoded_samples_cache_size = 0
+decoded_samples_lock = threading.Lock()
+
+# Content hashes and (sample rate, frame count) of files keyed by (path, mtime, size).
+# They're kept apart from the decoded samples so they stay known after the
+# samples are dropped and can be looked up without decoding the file again.
+file_hash_cache = {}
+frame_info_cache = {}
+
 
 def get_audio_file(filename):
     filename = helper.getCaseInsensitivePath(filename)
@@ -25,20 +48,304 @@ def get_audio_file(filename):
 
     return pydub.AudioSegment.from_file(filename, "wav")
 
+def get_frames_duration(frames, rate):
+    # Round to the millisecond the same way len() on a pydub AudioSegment does
+    if frames < 0 or rate <= 0:
+        return None
+
+    return round(1000 * frames / rate) / 1000
+
+def get_wav_header_duration(infile):
+    riff_header = infile.read(12)
+    if len(riff_header) != 12 or riff_header[:4] != b"RIFF" or riff_header[8:] != b"WAVE":
+        return None
+
+    file_size = os.fstat(infile.fileno()).st_size
+    frame_width = None
+    rate = None
+
+    while True:
+        chunk_header = infile.read(8)
+        if len(chunk_header) != 8:
+            return None
+
+        chunk_id = chunk_header[:4]
+        chunk_size = struct.unpack("<I", chunk_header[4:])[0]
+
+        if chunk_id == b"fmt ":
+            fmt = infile.read(16)
+            if len(fmt) != 16:
+                return None
+
+            audio_format, channels, rate, _, _, bits = struct.unpack("<HHIIHH", fmt)
+
+            # Only plain PCM is read natively by pydub, leave the rest to ffmpeg
+            if audio_format not in [0x01, 0xfffe]:
+                return None
+
+            frame_width = channels * (bits // 8)
+            infile.seek(chunk_size - 16 + (chunk_size & 1), 1)
+
+        elif chunk_id == b"data":
+            if not frame_width or not rate:
+                return None
+
+            # Truncated files only decode as much data as is really there
+            data_size = min(chunk_size, file_size - infile.tell())
+            return get_frames_duration(data_size // frame_width, rate)
+
+        else:
+            infile.seek(chunk_size + (chunk_size & 1), 1)
+
+def get_ogg_header_duration(infile):
+    first_page = infile.read(0x200)
+    if first_page[:4] != b"OggS":
+        return None
+
+    # The first packet of the stream identifies the codec
+    payload = first_page[0x1b + first_page[0x1a]:]
+    if payload[:7] == b"\x01vorbis" and len(payload) >= 0x10:
+        rate = struct.unpack("<I", payload[0x0c:0x10])[0]
+        pre_skip = 0
+    elif payload[:8] == b"OpusHead" and len(payload) >= 0x0c:
+        # Opus granule positions are always in 48kHz samples
+        rate = 48000
+        pre_skip = struct.unpack("<H", payload[0x0a:0x0c])[0]
+    else:
+        return None
+
+    # The granule position of the last page is the total number of samples
+    file_size = os.fstat(infile.fileno()).st_size
+    infile.seek(max(0, file_size - 0x10000))
+    tail = infile.read()
+
+    idx = tail.rfind(b"OggS")
+    while idx != -1 and idx + 0x0e > len(tail):
+        idx = tail.rfind(b"OggS", 0, idx)
+
+    if idx == -1:
+        return None
+
+    granule = struct.unpack("<q", tail[idx+0x06:idx+0x0e])[0]
+    return get_frames_duration(granule - pre_skip, rate)
+
+def get_mp3_header_duration(infile):
+    header = infile.read(10)
+
+    # Skip over ID3v2 tags
+    offset = 0
+    if header[:3] == b"ID3" and len(header) == 10:
+        offset = 10 + ((header[6] & 0x7f) << 21 | (header[7] & 0x7f) << 14 | (header[8] & 0x7f) << 7 | (header[9] & 0x7f))
+
+        if header[5] & 0x10:
+            offset += 10
+
+    infile.seek(offset)
+    frame = infile.read(0x200)
+    if len(frame) < 4 or frame[0] != 0xff or (frame[1] & 0xe0) != 0xe0:
+        return None
+
+    version = (frame[1] >> 3) & 0x03
+    layer = (frame[1] >> 1) & 0x03
+    rate_idx = (frame[2] >> 2) & 0x03
+    is_mono = (frame[3] >> 6) == 0x03
+
+    if version == 0x01 or layer != 0x01 or rate_idx == 0x03:
+        # Only Layer III with a known sample rate is handled here
+        return None
+
+    rate = [44100, 48000, 32000][rate_idx] >> [2, 0, 1, 0][version]
+    samples_per_frame = 1152 if version == 0x03 else 576
+
+    if version == 0x03:
+        xing_offset = 4 + (17 if is_mono else 32)
+    else:
+        xing_offset = 4 + (9 if is_mono else 17)
+
+    # Without a Xing/Info frame count and LAME gapless info the exact
+    # length can only be found by decoding the file
+    xing = frame[xing_offset:]
+    if xing[:4] not in [b"Xing", b"Info"] or len(xing) < 8:
+        return None
+
+    flags = struct.unpack(">I", xing[4:8])[0]
+    if not flags & 0x01:
+        return None
+
+    frames = struct.unpack(">I", xing[8:12])[0]
+
+    lame_offset = 8 + sum([size for flag, size in [(0x01, 4), (0x02, 4), (0x04, 100), (0x08, 4)] if flags & flag])
+    lame = xing[lame_offset:]
+    if lame[:4] != b"LAME" or len(lame) < 0x18:
+        return None
+
+    delay = (lame[0x15] << 4) | (lame[0x16] >> 4)
+    padding = ((lame[0x16] & 0x0f) << 8) | lame[0x17]
+
+    return get_frames_duration(frames * samples_per_frame - delay - padding, rate)
+
+def get_header_duration(filename):
+    # Read the duration from the file headers when the format allows for it,
+    # returns None when the file has to be decoded instead
+    with open(filename, "rb") as infile:
+        magic = infile.read(4)
+
+        for prefixes, probe in [([b"RIFF"], get_wav_header_duration), ([b"OggS"], get_ogg_header_duration), ([b"ID3", b"\xff"], get_mp3_header_duration)]:
+            if any([magic.startswith(prefix) for prefix in prefixes]):
+                infile.seek(0)
+                return probe(infile)
+
+    return None
+
 def get_duration(filename):
     filename = helper.getCaseInsensitivePath(filename)
-    sound_file = get_audio_file(filename)
 
-    if not sound_file:
+    if not filename or not os.path.exists(filename):
         return 0
 
-    return len(sound_file) / 1000
+    stat = os.stat(filename)
+    cache_key = (os.path.abspath(filename), stat.st_mtime, stat.st_size)
+
+    if cache_key in duration_cache:
+        return duration_cache[cache_key]
+
+    duration = None
+    if not filename.lower().endswith('.xa'):
+        try:
+            duration = get_header_duration(filename)
+        except (OSError, struct.error, IndexError):
+            duration = None
+
+    if duration is None:
+        sound_file = get_audio_file(filename)
+
+        if not sound_file:
+            return 0
+
+        duration = len(sound_file) / 1000
+
+    duration_cache[cache_key] = duration
+
+    return duration
+
+def get_file_key(filename):
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_mtime, stat.st_size)
+
+def get_file_hash(filename):
+    cache_key = get_file_key(filename)
+
+    if cache_key not in file_hash_cache:
+        sha1 = hashlib.sha1()
+
+        with open(filename, "rb") as infile:
+            for chunk in iter(lambda: infile.read(1024 * 1024), b""):
+                sha1.update(chunk)
+
+        file_hash_cache[cache_key] = sha1.hexdigest()
+
+    return file_hash_cache[cache_key]
+
+def clear_decoded_samples_cache():
+    global decoded_samples_cache_size
+
+    with decoded_samples_lock:
+        decoded_samples_cache.clear()
+        decoded_samples_cache_size = 0
+
+def get_decoded_samples(filename):
+    # Returns the raw PCM of a file along with the parameters needed to write it back out
+    global decoded_samples_cache_size
+
+    cache_key = get_file_key(filename)
+
+    # Move a cached sound to the end so it's dropped last
+    with decoded_samples_lock:
+        samples = decoded_samples_cache.pop(cache_key, None)
+        if samples:
+            decoded_samples_cache[cache_key] = samples
+            return samples
+
+    try:
+        with wave.open(filename, "rb") as infile:
+            samples = {
+                'channels': infile.getnchannels(),
+                'sample_width': infile.getsampwidth(),
+                'rate': infile.getframerate(),
+                'data': infile.readframes(infile.getnframes()),
+            }
+    except (wave.Error, EOFError):
+        pass
+
+    if not samples:
+        sound_file = get_audio_file(filename)
+        samples = {
+            'channels': sound_file.channels,
+            'sample_width': sound_file.sample_width,
+            'rate': sound_file.frame_rate,
+            'data': sound_file.raw_data,
+        }
+
+    frame_width = samples['channels'] * samples['sample_width']
+    frame_info_cache[cache_key] = (samples['rate'], len(samples['data']) // frame_width)
+
+    with decoded_samples_lock:
+        # Another thread may have decoded the same file in the meantime
+        old_samples = decoded_samples_cache.pop(cache_key, None)
+        if old_samples:
+            decoded_samples_cache_size -= len(old_samples['data'])
+
+        decoded_samples_cache[cache_key] = samples
+        decoded_samples_cache_size += len(samples['data'])
+
+        while decoded_samples_cache_size > DECODED_SAMPLES_CACHE_SIZE and len(decoded_samples_cache) > 1:
+            oldest_samples = decoded_samples_cache.pop(next(iter(decoded_samples_cache)))
+            decoded_samples_cache_size -= len(oldest_samples['data'])
+
+    return samples
+
+def get_frame_info(filename):
+    # Returns the sample rate and number of frames of a file, only reading
+    # the header of WAV files
+    cache_key = get_file_key(filename)
+
+    if cache_key not in frame_info_cache:
+        try:
+            with wave.open(filename, "rb") as infile:
+                frame_info_cache[cache_key] = (infile.getframerate(), infile.getnframes())
+        except (wave.Error, EOFError):
+            get_decoded_samples(filename)
+
+    return frame_info_cache[cache_key]
+
+def get_clip_frames(rate, frame_count, duration):
+    return min(int(round(duration * rate)), frame_count)
+
+def get_clip_key(input_filename, duration):
+    # A clip is identified by the contents of its source and its length in
+    # frames, so naming clip files by this key makes any existing file safe to reuse.
+    # Neither needs the source to be decoded once it has been seen.
+    filename = helper.getCaseInsensitivePath(input_filename)
+    rate, frame_count = get_frame_info(filename)
+    return get_file_hash(filename), get_clip_frames(rate, frame_count, duration)
 
 def clip_audio(input_filename, output_filename, duration):
     filename = helper.getCaseInsensitivePath(input_filename)
-    sound_file = get_audio_file(filename)[:duration * 1000]
-    sound_file.export(output_filename, format="wav")
-    print("Generated", output_filename, len(sound_file) / 1000, duration)
+    samples = get_decoded_samples(filename)
+    frame_width = samples['channels'] * samples['sample_width']
+    frames = get_clip_frames(samples['rate'], len(samples['data']) // frame_width, duration)
+
+    # Written under a temporary name first so a partially written clip is never used
+    temp_filename = "%s.%d.%d.tmp" % (output_filename, os.getpid(), threading.get_ident())
+    with wave.open(temp_filename, "wb") as outfile:
+        outfile.setnchannels(samples['channels'])
+        outfile.setsampwidth(samples['sample_width'])
+        outfile.setframerate(samples['rate'])
+        outfile.writeframes(samples['data'][:frames * frame_width])
+
+    os.replace(temp_filename, output_filename)
+
+    print("Generated", output_filename, frames / samples['rate'], duration)
 
 def merge_bgm(bgm_info, input_foldername, output_filename=None):
     longest_duration = bgm_info['end']
@@ -0,0 +1,329 @@
+# Benchmark and profiler for the DTX reader and writer in plugins/dtx.py
+#
+# Synthesizes sets of DTX files (one per part and difficulty, laid out the
+# same way create_dtx_from_json writes them) and times create_json_from_dtx
+# and create_dtx_from_json on them. Each step is also run under cProfile and
+# tracemalloc to report the hotspots and peak memory use.
+
+import argparse
+import cProfile
+import glob
+import os
+import pstats
+import random
+import time
+import tracemalloc
+import wave
+
+import audio
+import tmpfile
+import plugins.dtx as dtx
+
+
+TIME_SIGNATURES = [(4, 4), (3, 4), (5, 4), (2, 4), (7, 8), (6, 8)]
+DIFFICULTIES = ['nov', 'bsc', 'adv', 'ext', 'mst']
+LANES = {
+    'drum': [0x11, 0x12, 0x13, 0x14, 0x15, 0x16, 0x17, 0x1a, 0x1b],
+    'guitar': list(range(0x20, 0x27 + 1)),
+    'bass': list(range(0xa0, 0xa7 + 1)),
+}
+LONG_NOTE_LANES = {
+    'guitar': 0x2a,
+    'bass': 0x2b,
+}
+
+
+def generate_keysounds(sound_folder, keysound_count, rate, rng):
+    keysounds = {}
+
+    for wav_id in range(1, keysound_count + 1):
+        filename = "ks%03d.wav" % wav_id
+        frames = int(rate * rng.uniform(0.1, 1.5))
+
+        with wave.open(os.path.join(sound_folder, filename), "wb") as outfile:
+            outfile.setnchannels(1)
+            outfile.setsampwidth(2)
+            outfile.setframerate(rate)
+            outfile.writeframes(bytes(frames * 2))
+
+        keysounds[filename] = {
+            'duration': frames / rate,
+            'volume': rng.randint(50, 100),
+            'pan': rng.randint(-100, 100),
+        }
+
+    return keysounds
+
+
+def generate_song_layout(args, rng):
+    # Tempo and time signature changes are shared by every difficulty of a song
+    measures = []
+    bpms = [rng.choice([120, 145, 160, 172, 190])]
+    time_signature = (4, 4)
+
+    for measure in range(args.measures):
+        new_time_signature = None
+        if measure > 0 and rng.random() < args.timesig_changes:
+            new_time_signature = rng.choice([x for x in TIME_SIGNATURES if x != time_signature])
+            time_signature = new_time_signature
+
+        bpm_changes = {}
+        slots = 48 * time_signature[0] // time_signature[1]
+        if measure > 0 and rng.random() < args.bpm_changes:
+            bpms.append(round(rng.uniform(80, 240), 2))
+            bpm_changes[rng.randrange(slots)] = len(bpms) - 1
+
+        measures.append({
+            'time_signature': time_signature,
+            'new_time_signature': new_time_signature,
+            'slots': slots,
+            'bpm_changes': bpm_changes,
+        })
+
+    return measures, bpms
+
+
+def get_channel(measure, measure_info, event, chips):
+    values = ["00"] * measure_info['slots']
+
+    for slot, value in chips.items():
+        values[slot] = value
+
+    return "#%03d%02X: %s" % (measure, event, "".join(values))
+
+
+def generate_dtx(args, part, measures, bpms, density, keysounds, rng, stats):
+    lines = [
+        "#TITLE Benchmark",
+        "#ARTIST benchmark_dtx.py",
+        "#BPM %s" % bpms[0],
+    ]
+
+    for bpm_id, bpm in enumerate(bpms[1:], 1):
+        lines.append("#BPM%s %s" % (dtx.get_dtx_base36(bpm_id), bpm))
+
+    level_tag = {"drum": "DLEVEL", "guitar": "GLEVEL", "bass": "BLEVEL"}[part]
+    lines.append("#%s %d" % (level_tag, int(density * 90)))
+
+    for wav_id, filename in enumerate(sorted(keysounds.keys()), 1):
+        lines.append("#WAV%s %s" % (dtx.get_dtx_base36(wav_id), filename))
+        lines.append("#VOLUME%s %d" % (dtx.get_dtx_base36(wav_id), keysounds[filename]['volume']))
+        lines.append("#PAN%s %d" % (dtx.get_dtx_base36(wav_id), keysounds[filename]['pan']))
+
+    for measure, measure_info in enumerate(measures):
+        if measure_info['new_time_signature']:
+            numerator, denominator = measure_info['new_time_signature']
+            lines.append("#%03d02: %s" % (measure, numerator / denominator))
+
+        if measure_info['bpm_changes']:
+            chips = {slot: dtx.get_dtx_base36(bpm_id) for slot, bpm_id in measure_info['bpm_changes'].items()}
+            lines.append(get_channel(measure, measure_info, 0x08, chips))
+
+        chips_by_lane = {}
+        long_notes = {}
+
+        note_count = int(round(args.notes_per_measure * density * rng.uniform(0.5, 1.5)))
+        for slot in sorted(rng.sample(range(measure_info['slots']), min(note_count, measure_info['slots']))):
+            lane = rng.choice(LANES[part])
+            chips_by_lane.setdefault(lane, {})[slot] = dtx.get_dtx_base36(rng.randint(1, len(keysounds)))
+            stats['notes'] += 1
+
+            # A long note ends at the marker after the note it belongs to
+            if part in LONG_NOTE_LANES and slot + 1 < measure_info['slots'] and rng.random() < args.long_notes:
+                long_notes[rng.randrange(slot + 1, measure_info['slots'])] = "01"
+
+        for lane in sorted(chips_by_lane.keys()):
+            lines.append(get_channel(measure, measure_info, lane, chips_by_lane[lane]))
+
+        if long_notes:
+            lines.append(get_channel(measure, measure_info, LONG_NOTE_LANES[part], long_notes))
+            stats['long_notes'] += len(long_notes)
+
+    return "\n".join(lines) + "\n"
+
+
+def generate_corpus(args, rng):
+    corpus = []
+    stats = {
+        'files': 0,
+        'measures': 0,
+        'notes': 0,
+        'long_notes': 0,
+        'bpm_changes': 0,
+        'timesig_changes': 0,
+    }
+
+    for song_idx in range(args.sets):
+        sound_folder = tmpfile.mkdtemp(prefix="dtx_benchmark")
+        keysounds = generate_keysounds(sound_folder, args.keysounds, args.rate, rng)
+        measures, bpms = generate_song_layout(args, rng)
+
+        stats['measures'] += len(measures)
+        stats['bpm_changes'] += len(bpms) - 1
+        stats['timesig_changes'] += len([x for x in measures if x['new_time_signature']])
+
+        input_split = {part: {} for part in ['drum', 'guitar', 'bass', 'open']}
+        for difficulty_idx, difficulty in enumerate(DIFFICULTIES[-args.difficulties:]):
+            density = (5 - args.difficulties + difficulty_idx + 1) / 5
+
+            for part in args.parts:
+                filename = os.path.join(sound_folder, "%s%04d_%s.dtx" % (part[0], song_idx + 1, difficulty))
+
+                with open(filename, "w", encoding="shift-jis") as outfile:
+                    outfile.write(generate_dtx(args, part, measures, bpms, density, keysounds, rng, stats))
+
+                input_split[part][difficulty] = filename
+                stats['files'] += 1
+
+        corpus.append({
+            'musicid': song_idx + 1,
+            'sound_folder': sound_folder,
+            'keysounds': keysounds,
+            'input_split': input_split,
+        })
+
+    return corpus, stats
+
+
+def get_sound_metadata(json_dtx, keysounds):
+    # Build the same kind of metadata the SQ3 reader would pass to the DTX writer
+    entries = {}
+
+    for part in ['drum', 'guitar']:
+        sound_metadata = json_dtx['sound_metadata'].get(part)
+
+        if not sound_metadata:
+            continue
+
+        for entry in sound_metadata['entries']:
+            entries[entry['sound_id']] = {
+                'sound_id': entry['sound_id'],
+                'filename': os.path.splitext(entry['filename'])[0],
+                'volume': entry['volume'],
+                'pan': entry['pan'],
+                'duration': keysounds[entry['filename']]['duration'] if entry['filename'] in keysounds else 0,
+                'flags': [],
+            }
+
+    return {'entries': [entries[k] for k in sorted(entries.keys())]}
+
+
+def clear_caches(corpus):
+    # Every run should start cold or later runs only measure cache lookups
+    audio.duration_cache.clear()
+    audio.clear_decoded_samples_cache()
+    audio.file_hash_cache.clear()
+    audio.frame_info_cache.clear()
+
+    # Clipped keysounds written by an earlier run would be reused as they are
+    for song in corpus:
+        for filename in glob.glob(os.path.join(song['sound_folder'], "_override_clipped_*.wav")):
+            os.unlink(filename)
+
+
+def run_create_json(args, corpus):
+    json_dtxs = []
+
+    for song in corpus:
+        json_dtxs.append(dtx.create_json_from_dtx({
+            'input_split': song['input_split'],
+            'parts': args.parts,
+            'difficulty': ['all'],
+            'sound_folder': song['sound_folder'],
+            'musicid': song['musicid'],
+            'dtx_pad_start': 0,
+            'dtx_pad_end': 2,
+            'dtx_processes': args.processes,
+            'no_sounds': False,
+        }))
+
+    return json_dtxs
+
+
+def run_create_dtx(args, corpus, json_dtxs):
+    for song, json_dtx in zip(corpus, json_dtxs):
+        # The SQ3 reader fills in the music ID for every chart
+        for chart in json_dtx['charts']:
+            chart['header']['musicid'] = json_dtx['musicid']
+
+        output_folder = tmpfile.mkdtemp(prefix="dtx_benchmark_output")
+        dtx.create_dtx_from_json({
+            'input': json_dtx,
+            'output': output_folder,
+            'sound_folder': song['sound_folder'],
+            'sound_metadata': get_sound_metadata(json_dtx, song['keysounds']),
+            'dtx_fake_timesigs': args.fake_timesigs,
+        })
+
+
+def benchmark(name, args, corpus, func):
+    timings = []
+    for _ in range(args.runs):
+        clear_caches(corpus)
+        start_time = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start_time)
+
+    clear_caches(corpus)
+    tracemalloc.start()
+    func()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print("%s: best %.3fs, average %.3fs, peak memory %.1f MB" % (name,
+                                                                  min(timings),
+                                                                  sum(timings) / len(timings),
+                                                                  peak_memory / (1024 * 1024)))
+
+    clear_caches(corpus)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    func()
+    profiler.disable()
+
+    if args.profile_output:
+        profiler.dump_stats("%s_%s.prof" % (args.profile_output, name))
+
+    pstats.Stats(profiler).strip_dirs().sort_stats(args.sort).print_stats(args.top)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sets', help="Number of generated songs", default=1, type=int)
+    parser.add_argument('--difficulties', help="Number of difficulties per song", default=5, type=int, choices=range(1, 6))
+    parser.add_argument('--parts', nargs='*', choices=['drum', 'guitar', 'bass'], default=['drum', 'guitar', 'bass'])
+    parser.add_argument('--measures', help="Number of measures per song", default=120, type=int)
+    parser.add_argument('--notes-per-measure', help="Average notes per measure and part on the hardest difficulty", default=12, type=float)
+    parser.add_argument('--bpm-changes', help="Chance of a BPM change in each measure", default=0.05, type=float)
+    parser.add_argument('--timesig-changes', help="Chance of a time signature change in each measure", default=0.03, type=float)
+    parser.add_argument('--keysounds', help="Number of generated keysounds per song", default=64, type=int)
+    parser.add_argument('--long-notes', help="Chance of a guitar/bass note being a long note", default=0.1, type=float)
+    parser.add_argument('--rate', help="Sample rate of the generated keysounds", default=44100, type=int)
+    parser.add_argument('--fake-timesigs', help="Fake time signatures when writing the DTX files", default=False, action='store_true')
+    parser.add_argument('--seed', help="Random seed used to generate the songs", default=0, type=int)
+    parser.add_argument('--runs', help="Number of timed runs", default=3, type=int)
+    parser.add_argument('--processes', help="Number of processes used to parse DTX files", default=1, type=int)
+    parser.add_argument('--top', help="Number of hotspots to list", default=25, type=int)
+    parser.add_argument('--sort', help="Sort order of the hotspots", default="cumulative", choices=['cumulative', 'tottime', 'ncalls'])
+    parser.add_argument('--profile-output', help="Save the raw cProfile stats to <prefix>_<step>.prof", default=None)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    corpus, stats = generate_corpus(args, rng)
+
+    print("Generated %d DTX files in %d sets: %d measures, %d notes, %d long notes, %d BPM changes, %d time signature changes" % (
+        stats['files'],
+        args.sets,
+        stats['measures'],
+        stats['notes'],
+        stats['long_notes'],
+        stats['bpm_changes'],
+        stats['timesig_changes']
+    ))
+
+    json_dtxs = run_create_json(args, corpus)
+
+    benchmark("create_json_from_dtx", args, corpus, lambda: run_create_json(args, corpus))
+    benchmark("create_dtx_from_json", args, corpus, lambda: run_create_dtx(args, corpus, json_dtxs))
+
+    tmpfile.tmpcleanup()
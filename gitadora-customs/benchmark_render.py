@@ -0,0 +1,291 @@
+# Benchmark and accuracy check for the chart renderer in plugins/wav.py
+#
+# Synthesizes a chart with N notes spread over K generated keysounds, times
+# create_wav_from_chart and compares the result against the old pydub overlay
+# renderer and/or a stored reference render.
+#
+# The old renderer floors every sample after panning a keysound and again
+# after changing its volume, so it can be up to 2 lower than the exact mix
+# for every note sounding at that frame. The float32 mixer rounds once, so
+# every sample must be within --tolerance (1 by default) plus 2 for each
+# note sounding there of the old render. Frames where the old renderer's
+# int16 overlays could have saturated are left out of that check because
+# the float32 mix intentionally only clips once at the end.
+
+import argparse
+import math
+import os
+import random
+import time
+
+import numpy
+import pydub
+
+import tmpfile
+import plugins.wav as wav
+
+
+def write_samples(filename, samples, rate):
+    samples = numpy.clip(numpy.round(samples), -32768, 32767).astype(numpy.int16)
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    pydub.AudioSegment(data=samples.tobytes(), sample_width=2, frame_rate=rate, channels=channels).export(filename, format="wav")
+
+
+def get_samples(audio):
+    audio = audio.set_sample_width(2)
+    samples = numpy.array(audio.get_array_of_samples(), dtype=numpy.float64)
+    return samples.reshape(-1, audio.channels)
+
+
+def generate_keysounds(sound_folder, keysound_count, rate, rng):
+    entries = []
+
+    for sound_id in range(1, keysound_count + 1):
+        duration = rng.uniform(0.1, 2.0)
+        frequency = rng.uniform(80, 2000)
+        t = numpy.arange(int(rate * duration)) / rate
+        samples = numpy.sin(2 * math.pi * frequency * t) * numpy.exp(-t * 3) * 6000
+
+        filename = "%04x.wav" % sound_id
+        write_samples(os.path.join(sound_folder, filename), samples, rate)
+
+        entries.append({
+            'sound_id': sound_id,
+            'filename': filename,
+            'volume': rng.randint(64, 127),
+            'pan': rng.randint(0, 127),
+            'flags': [],
+        })
+
+    return {'entries': entries}
+
+
+def generate_bgm(filename, duration, rate, tonal):
+    t = numpy.arange(int(rate * duration)) / rate
+
+    if tonal:
+        samples = numpy.sin(2 * math.pi * 110 * t) * 4000
+    else:
+        samples = numpy.zeros(len(t))
+
+    write_samples(filename, numpy.column_stack((samples, samples)), rate)
+
+
+def generate_chart(note_count, sound_metadata, duration, rng):
+    chart = {
+        'header': {
+            'difficulty': 3,
+            'game_type': 0,
+            'is_metadata': 0,
+        },
+        'timestamp': {},
+    }
+
+    for _ in range(note_count):
+        timestamp = rng.randint(0, int((duration - 2) * 0x12c))
+        is_auto = rng.random() < 0.1
+        sound_entry = rng.choice(sound_metadata['entries'])
+
+        # The old renderer rejected pans that end up past either side
+        max_pan = min(127, int(128 - sound_entry['pan'] / 2))
+
+        chart['timestamp'].setdefault(str(timestamp), []).append({
+            'name': "note",
+            'timestamp': timestamp,
+            'data': {
+                'sound_id': sound_entry['sound_id'],
+                'volume': rng.randint(32, 127),
+                'pan': rng.randint(0, max_pan),
+                'auto_volume': 1 if is_auto else 0,
+                'auto_note': 1 if is_auto else 0,
+            }
+        })
+
+    return chart
+
+
+def render_legacy(chart, sound_folder, sound_metadata, duration):
+    # The renderer before the numpy mixer, as create_wav_from_chart did it
+    # with pydub: every keysound is panned and has its volume applied, then
+    # it's overlaid on the silent output once per note.
+    # Also returns the number of notes sounding in each frame and the sum of
+    # their magnitudes, which is the most any overlay could have reached.
+    sound_files = {}
+    overlays = []
+    output = pydub.AudioSegment.silent(duration=duration * 1000)
+
+    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
+        for cd in chart['timestamp'][timestamp_key]:
+            if cd['name'] != "note":
+                continue
+
+            note_volume = cd['data'].get('volume', 127)
+
+            is_auto = cd['data'].get('auto_volume') == 1 and cd['data'].get('auto_note') != 0
+            if is_auto:
+                note_volume = int(round(note_volume * (2/3)))
+
+            note_pan = cd['data'].get('pan', 64)
+            sound_key = (cd['data']['sound_id'], note_volume, note_pan)
+
+            if sound_key not in sound_files:
+                volume = 127
+                pan = 64
+                wav_filename = "%04x.wav" % int(cd['data']['sound_id'])
+
+                for sound_entry in sound_metadata['entries']:
+                    if int(sound_entry['sound_id']) == int(cd['data']['sound_id']):
+                        volume = sound_entry.get('volume', volume)
+                        pan = sound_entry.get('pan', pan)
+                        wav_filename = sound_entry['filename']
+                        break
+
+                if note_volume:
+                    volume = (note_volume / 127) * (volume / 127) * 127
+
+                if note_pan:
+                    pan = (note_pan - ((128 - pan) / 2)) / (128 / 2)
+                else:
+                    pan = (pan - (128 / 2)) / (128 / 2)
+
+                keysound = pydub.AudioSegment.from_file(os.path.join(sound_folder, wav_filename), "wav")
+                keysound = keysound.pan(pan)
+                keysound += 20 * math.log10(volume / 127)
+                sound_files[sound_key] = keysound
+
+            position = int(timestamp_key) / 0x12c * 1000
+            output = output.overlay(sound_files[sound_key], position=position)
+            overlays.append((position, sound_key))
+
+    rate = output.frame_rate
+    note_counts = numpy.zeros(int(output.frame_count()))
+    magnitudes = numpy.zeros((len(note_counts), output.channels))
+
+    keysound_magnitudes = {}
+    for position, sound_key in overlays:
+        if sound_key not in keysound_magnitudes:
+            keysound_magnitudes[sound_key] = numpy.abs(get_samples(sound_files[sound_key].set_frame_rate(rate)))
+
+        samples = keysound_magnitudes[sound_key]
+        start_frame = int(position * (rate / 1000.0))
+        end_frame = min(start_frame + len(samples), len(note_counts))
+
+        note_counts[start_frame:end_frame] += 1
+        magnitudes[start_frame:end_frame] += samples[:end_frame - start_frame]
+
+    return output, note_counts, magnitudes
+
+
+def compare_audio(output, reference, tolerance, note_counts=None, magnitudes=None):
+    # tolerance is the allowed error per sample, plus 2 for every note
+    # sounding at that frame when note_counts is given. Frames where
+    # magnitudes could have gone past full scale are skipped.
+    output = get_samples(output)
+    reference = get_samples(reference)
+
+    if output.shape[1] != reference.shape[1]:
+        reference = numpy.repeat(reference, output.shape[1], axis=1)
+
+    if len(output) != len(reference):
+        print("Length mismatch: %d frames vs %d frames in reference" % (len(output), len(reference)))
+
+    frame_count = min(len(output), len(reference))
+    output = output[:frame_count]
+    reference = reference[:frame_count]
+
+    allowed = numpy.full(frame_count, float(tolerance))
+    if note_counts is not None:
+        allowed[:len(note_counts)] += 2 * note_counts[:frame_count]
+
+    if magnitudes is not None:
+        saturated = numpy.zeros(frame_count, dtype=bool)
+        saturated[:len(magnitudes)] = numpy.any(magnitudes[:frame_count] >= 32767, axis=1)
+
+        if numpy.any(saturated):
+            print("Skipped %d frames where the reference could have saturated" % numpy.count_nonzero(saturated))
+            output = output[~saturated]
+            reference = reference[~saturated]
+            allowed = allowed[~saturated]
+            frame_count = len(reference)
+
+    diff = output - reference
+
+    max_error = numpy.max(numpy.abs(diff)) if frame_count else 0
+    rms_error = math.sqrt(numpy.mean(diff ** 2)) if frame_count else 0
+    failures = numpy.count_nonzero(numpy.abs(diff) > allowed[:, None])
+
+    signal_power = numpy.sum(reference ** 2)
+    noise_power = numpy.sum(diff ** 2)
+    snr = 10 * math.log10(signal_power / noise_power) if noise_power > 0 and signal_power > 0 else float('inf')
+
+    return max_error, rms_error, snr, failures
+
+
+def print_comparison(name, output, reference, tolerance, note_counts=None, magnitudes=None):
+    max_error, rms_error, snr, failures = compare_audio(output, reference, tolerance, note_counts, magnitudes)
+    print("%s: max error %d, RMS error %.3f, SNR %.1f dB, %d samples over the tolerance" % (name, max_error, rms_error, snr, failures))
+
+    return failures == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--notes', help="Number of notes in the generated chart", default=1500, type=int)
+    parser.add_argument('--keysounds', help="Number of generated keysounds", default=64, type=int)
+    parser.add_argument('--duration', help="Song length in seconds", default=120, type=float)
+    parser.add_argument('--rate', help="Sample rate of the generated audio", default=48000, type=int)
+    parser.add_argument('--tonal-bgm', help="Use a tone for the BGM instead of silence", default=False, action='store_true')
+    parser.add_argument('--seed', help="Random seed used to generate the chart", default=0, type=int)
+    parser.add_argument('--runs', help="Number of timed renders", default=3, type=int)
+    parser.add_argument('--processes', help="Number of processes used to mix", default=1, type=int)
+    parser.add_argument('--reference', help="Reference render to compare against (created if missing)")
+    parser.add_argument('--update-reference', help="Overwrite the reference render", default=False, action='store_true')
+    parser.add_argument('--skip-legacy', help="Don't time and compare against the old pydub overlay renderer", default=False, action='store_true')
+    parser.add_argument('--tolerance', help="Maximum allowed sample error when comparing, plus 2 per overlapping note against the old renderer", default=1, type=int)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    sound_folder = tmpfile.mkdtemp(prefix="render_benchmark")
+
+    sound_metadata = generate_keysounds(sound_folder, args.keysounds, args.rate, rng)
+    chart = generate_chart(args.notes, sound_metadata, args.duration, rng)
+    generate_bgm(os.path.join(sound_folder, "bgm.wav"), args.duration, args.rate, args.tonal_bgm)
+
+    timings = []
+    for _ in range(args.runs):
+        start_time = time.perf_counter()
+        output = wav.create_wav_from_chart(chart,
+                                           sound_folder,
+                                           sound_metadata,
+                                           None,
+                                           "bgm.wav",
+                                           processes=args.processes)
+        timings.append(time.perf_counter() - start_time)
+
+    print("Rendered %d notes over %d keysounds (%.1fs song)" % (args.notes, args.keysounds, args.duration))
+    print("create_wav_from_chart: best %.3fs, average %.3fs, %d notes/s" % (min(timings),
+                                                                             sum(timings) / len(timings),
+                                                                             args.notes / min(timings)))
+
+    passed = True
+
+    if not args.skip_legacy:
+        start_time = time.perf_counter()
+        legacy_output, note_counts, magnitudes = render_legacy(chart, sound_folder, sound_metadata, args.duration)
+        print("Legacy pydub renderer: %.3fs" % (time.perf_counter() - start_time))
+
+        passed = print_comparison("Legacy comparison", output, legacy_output, args.tolerance, note_counts, magnitudes) and passed
+
+    if args.reference:
+        if args.update_reference or not os.path.exists(args.reference):
+            output.export(args.reference, format="wav")
+            print("Saved reference render to %s" % args.reference)
+        else:
+            reference = pydub.AudioSegment.from_file(args.reference, "wav")
+            passed = print_comparison("Reference comparison", output, reference, args.tolerance) and passed
+
+    tmpfile.tmpcleanup()
+
+    if not passed:
+        print("Render differs from the reference by more than the tolerance")
+        exit(1)
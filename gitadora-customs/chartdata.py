@@ -0,0 +1,62 @@
+# Chart data passed between the input and output plugins
+import json
+
+
+def get_json_key(key):
+    # Dict keys are converted the same way json.dumps converts them
+    if isinstance(key, str):
+        return key
+    elif key is True:
+        return "true"
+    elif key is False:
+        return "false"
+    elif key is None:
+        return "null"
+    elif isinstance(key, int):
+        return int.__repr__(key)
+    elif isinstance(key, float):
+        return float.__repr__(key)
+
+    raise TypeError("keys must be str, int, float, bool or None, not {}".format(type(key).__name__))
+
+
+def get_json_value(value):
+    # Copy of value that matches what a json.dumps(sort_keys=True) and
+    # json.loads round trip would give back, without going through text.
+    # Containers are always copied so events shared between charts by a
+    # reader end up as separate objects, same as before.
+    if isinstance(value, dict):
+        return {get_json_key(k): get_json_value(v) for k, v in sorted(value.items())}
+    elif isinstance(value, (list, tuple)):
+        return [get_json_value(x) for x in value]
+    elif value is None or isinstance(value, (str, int, float)):
+        return value
+
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+class ChartData(dict):
+    # Behaves like the loaded chart JSON so plugins can use it the same way,
+    # but it's handed directly from the input plugin to the output plugin and
+    # only serialized when the output format is actually JSON.
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(get_json_value(data))
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(json.loads(data))
+
+    def to_json(self):
+        return json.dumps(self, indent=4)
+
+
+def get_chart_data(chart_data):
+    if chart_data is None or isinstance(chart_data, ChartData):
+        return chart_data
+
+    if isinstance(chart_data, (str, bytes, bytearray)):
+        return ChartData.from_json(chart_data)
+
+    return ChartData.from_data(chart_data)
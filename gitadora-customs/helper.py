@@ -85,3 +85,55 @@ def check_ffmpeg():
 
             if os.path.exists(path):
                 shutil.copy(path, "ffmpeg" + ext)
+
+
+def get_selected_parts(params):
+    parts = params.get('parts', ['all'])
+
+    if 'all' in parts:
+        return ["drum", "guitar", "bass", "open"]
+
+    return parts
+
+
+def is_part_selected(params, game_type):
+    return ["drum", "guitar", "bass", "open"][game_type] in get_selected_parts(params)
+
+
+def get_part_difficulties(params, charts):
+    # Difficulties of the charts in the selected parts, which min/max are
+    # resolved against. charts is a list of (game_type, difficulty).
+    return [difficulty for game_type, difficulty in charts if is_part_selected(params, game_type)]
+
+
+def is_chart_selected(params, game_type, difficulty, difficulties=None):
+    # Check a chart against the --parts and --difficulty filters so readers
+    # can skip charts before parsing them.
+    # difficulties is every difficulty found in the selected parts of the
+    # input (see get_part_difficulties), used for min/max
+    selected_difficulties = params.get('difficulty', ['all'])
+
+    if not is_part_selected(params, game_type):
+        return False
+
+    diff = ['nov', 'bsc', 'adv', 'ext', 'mst'][difficulty]
+    if 'all' in selected_difficulties or diff in selected_difficulties:
+        return True
+
+    if not difficulties:
+        difficulties = [difficulty]
+
+    if 'min' in selected_difficulties and difficulty == min(difficulties):
+        return True
+
+    if 'max' in selected_difficulties and difficulty == max(difficulties):
+        return True
+
+    return False
+
+
+def filter_charts(params, charts):
+    # Returns the charts from a list of JSON charts that the --parts and
+    # --difficulty filters keep. Metadata charts are always kept.
+    difficulties = get_part_difficulties(params, [(chart['header']['game_type'], chart['header']['difficulty']) for chart in charts if chart['header']['is_metadata'] == 0])
+    return [chart for chart in charts if chart['header']['is_metadata'] != 0 or is_chart_selected(params, chart['header']['game_type'], chart['header']['difficulty'], difficulties)]
@@ -1,6 +1,5 @@
 import collections
 import copy
-import json
 import os
 import shutil
 import struct
@@ -9,6 +8,7 @@ from lxml import etree
 from lxml.builder import E
 import uuid
 
+import chartdata
 import helper
 import mdb
 import eamxml
@@ -16,6 +16,7 @@ import audio
 import vas3tool
 import wavbintool
 import tmpfile
+import soundmetadata
 
 import plugins.wav as wav
 
@@ -166,18 +167,17 @@ def split_charts_by_parts(charts):
 
 
 def add_note_durations(chart, sound_metadata):
-    duration_lookup = {}
+    sound_metadata = soundmetadata.get_sound_metadata(sound_metadata)
 
     if not sound_metadata or 'entries' not in sound_metadata:
         return chart
 
-    for entry in sound_metadata['entries']:
-        duration_lookup[entry['sound_id']] = entry.get('duration', 0)
-
     for k in chart['timestamp']:
         for i in range(0, len(chart['timestamp'][k])):
             if chart['timestamp'][k][i]['name'] in ['note', 'auto']:
-                chart['timestamp'][k][i]['data']['note_length'] = int(round(duration_lookup.get(chart['timestamp'][k][i]['data']['sound_id'], 0) * 300))
+                sound_entry = sound_metadata.get_entry(chart['timestamp'][k][i]['data']['sound_id'])
+                duration = sound_entry.get('duration', 0) if sound_entry else 0
+                chart['timestamp'][k][i]['data']['note_length'] = int(round(duration * 300))
 
     return chart
 
@@ -471,7 +471,12 @@ def generate_json_from_dsq1(params):
     raw_charts = [x for x in raw_charts if x is not None]
 
     if len(raw_charts) > 0:
-        raw_charts.append((raw_charts[0][0], raw_charts[0][1], raw_charts[0][2], True))
+        metadata_chart = (raw_charts[0][0], raw_charts[0][1], raw_charts[0][2], True)
+
+        # Skip charts that weren't selected before parsing them
+        difficulties = helper.get_part_difficulties(params, [(x[1], x[2]) for x in raw_charts])
+        raw_charts = [x for x in raw_charts if helper.is_chart_selected(params, x[1], x[2], difficulties)]
+        raw_charts.append(metadata_chart)
 
     musicid = params.get('musicid', None) or 0
 
@@ -513,7 +518,7 @@ def generate_json_from_dsq1(params):
 
     output_data['charts'] = charts
 
-    return json.dumps(output_data, indent=4, sort_keys=True)
+    return chartdata.get_chart_data(output_data)
 
 
 class Dsq1Format:
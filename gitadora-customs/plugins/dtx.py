@@ -42,15 +42,19 @@
 # BLACKCOLORKEY
 
 
+import bisect
 import copy
 from fractions import Fraction
-import json
+import io
 import math
-from numpy import base_repr
+import multiprocessing
 import os
 import re
 
 import audio
+import chartdata
+import helper
+import soundmetadata
 
 dtx_bonus_mapping = {
     "leftcymbal": 0x01,
@@ -206,6 +210,14 @@ bass_range = list(range(0xa0, 0xa7 + 1)) + \
     list(range(0xc5, 0xcf + 1)) + \
     list(range(0xda, 0xe8 + 1))
 
+# Every 2 digit base 36 ID, so IDs don't have to be converted one at a time
+dtx_base36_ids = [x + y for x in "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ" for y in "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"]
+
+
+def get_dtx_base36(value):
+    # Only the last 2 digits fit in a DTX ID
+    return dtx_base36_ids[value % len(dtx_base36_ids)]
+
 
 # This is similar to Fraction, except it won't
 # try to reduce the fraction.
@@ -234,69 +246,80 @@ class Fraction2:
         return "%d/%d" % (self.numerator, self.denominator)
 
 
-########################
-#   DTX reading code   #
-########################
-
-def get_value_from_dtx(target_tag, lines, default=None):
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
+class DtxChannel:
+    # One channel of a measure, indexed in 1920ths of a whole note like the
+    # padded list of chips it stands for, but only the chips that aren't 00
+    # are stored. The padded chip string is only built when it's written.
+    def __init__(self, length, chips=None):
+        self.length = length
+        self.chips = chips if chips is not None else {}
 
-        if not matches:
-            continue
+    def get_index(self, idx):
+        if idx < 0:
+            idx += self.length
 
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
+        if idx < 0 or idx >= self.length:
+            raise IndexError("chip index out of range")
 
-        if tag.startswith(target_tag):
-            return value
+        return idx
 
-    return default
+    def get_ticks(self):
+        return sorted(self.chips.keys())
 
+    def __len__(self):
+        return self.length
 
-def get_bpms_from_dtx(lines):
-    bpms = {}
-    base_bpm = 0
+    def __getitem__(self, idx):
+        return self.chips.get(self.get_index(idx), '00')
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
+    def __setitem__(self, idx, value):
+        idx = self.get_index(idx)
 
-        if not matches:
-            continue
+        if value == '00':
+            self.chips.pop(idx, None)
+        else:
+            self.chips[idx] = value
 
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
+    def __contains__(self, value):
+        if value == '00':
+            return len(self.chips) < self.length
 
-        if tag.startswith("BPM"):
-            matches2 = re.match("BPM(?P<id>[0-9A-Z]{2})?", tag)
+        return value in self.chips.values()
 
-            if not matches2:
-                pass
+    def __iter__(self):
+        for idx in range(self.length):
+            yield self.chips.get(idx, '00')
 
-            bpm_id = matches2.group('id')
 
-            if bpm_id:
-                bpm_id = int(bpm_id, 36)
-            else:
-                bpm_id = 0
+########################
+#   DTX reading code   #
+########################
 
-            bpms[bpm_id] = float(value)
+DTX_TAG_PATTERN = re.compile(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)")
+DTX_CHANNEL_PATTERN = re.compile("(?P<measure>[0-9]{3})(?P<event>[0-9A-F]{2})")
+DTX_ID_PATTERNS = {x: re.compile(x + "(?P<id>[0-9A-Z]{2})?") for x in ["WAV", "WAVVOL", "VOLUME", "WAVPAN", "PAN", "BPM"]}
 
-        elif tag.startswith("BASEBPM"):
-            base_bpm = float(value)
 
-    return bpms, base_bpm
+def get_dtx_id(valid_tag, tag):
+    dtx_id = DTX_ID_PATTERNS[valid_tag].match(tag).group('id')
+    return int(dtx_id, 36) if dtx_id else 0
 
 
-def get_wavs_from_dtx(lines, target_parts, sound_metadata, get_wav_length=True):
-    wav_filenames = {}
-    wav_lengths = {}
+def get_dtx_index(lines):
+    # Classify every line once so the get_*_from_dtx helpers only have to
+    # look at the lines they care about
+    dtx_index = {
+        'tags': [],
+        'wavs': [],
+        'volumes': [],
+        'pans': [],
+        'bpms': [],
+        'base_bpms': [],
+        'channels': [],
+    }
 
     for line in lines:
-        if ';' in line:
-            line = line[:line.index(';')].strip()
-
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
+        matches = DTX_TAG_PATTERN.match(line)
 
         if not matches:
             continue
@@ -304,202 +327,165 @@ def get_wavs_from_dtx(lines, target_parts, sound_metadata, get_wav_length=True):
         tag = matches.group('tag').upper()
         value = matches.group('value')
 
-        if tag.startswith("WAV") and not tag.startswith("WAVPAN") and not tag.startswith("WAVVOL"):
-            # Handle WAV tags
-            # This can be exported for use by va3 creator
-
-            matches2 = re.match("WAV(?P<id>[0-9A-Z]{2})?", tag)
-
-            if not matches2:
-                pass
+        if tag[0].isdigit():
+            matches2 = DTX_CHANNEL_PATTERN.match(tag)
+            dtx_index['channels'].append((int(matches2.group('measure')), int(matches2.group('event'), 16), value))
+            continue
 
-            wav_id = matches2.group('id')
+        dtx_index['tags'].append((tag, value))
 
-            if wav_id:
-                wav_id = int(wav_id, 36)
-            else:
-                wav_id = 0
+        if tag.startswith("WAV") and not tag.startswith("WAVPAN") and not tag.startswith("WAVVOL"):
+            # WAV filenames can have comments after them
+            if ';' in line:
+                matches = DTX_TAG_PATTERN.match(line[:line.index(';')].strip())
 
-            wav_filenames[wav_id] = os.sep.join(value.split('\\'))
+                if matches:
+                    tag = matches.group('tag').upper()
+                    dtx_index['wavs'].append((get_dtx_id("WAV", tag), matches.group('value')))
 
-            if get_wav_length and ('guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts):
-                duration = audio.get_duration(os.path.join(sound_metadata['sound_folder'], value))
-                wav_lengths[wav_id] = int(round(duration * 300))
             else:
-                wav_lengths[wav_id] = 0
-
-    return wav_filenames, wav_lengths
+                dtx_index['wavs'].append((get_dtx_id("WAV", tag), value))
 
+        elif tag.startswith("VOLUME"):
+            dtx_index['volumes'].append((get_dtx_id("VOLUME", tag), value))
 
-def get_wav_volumes_from_dtx(lines):
-    wav_volumes = {}
+        elif tag.startswith("WAVVOL"):
+            dtx_index['volumes'].append((get_dtx_id("WAVVOL", tag), value))
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
+        elif tag.startswith("PAN"):
+            dtx_index['pans'].append((get_dtx_id("PAN", tag), value))
 
-        if not matches:
-            continue
+        elif tag.startswith("WAVPAN"):
+            dtx_index['pans'].append((get_dtx_id("WAVPAN", tag), value))
 
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
+        elif tag.startswith("BPM"):
+            dtx_index['bpms'].append((get_dtx_id("BPM", tag), value))
 
-        if tag.startswith("VOLUME"):
-            valid_tag = "VOLUME"
-        elif tag.startswith("WAVVOL"):
-            valid_tag = "WAVVOL"
-        else:
-            valid_tag = None
+        elif tag.startswith("BASEBPM"):
+            dtx_index['base_bpms'].append(value)
 
-        if valid_tag:
-            # Handle VOLUME tags
-            # This can be exported for use by va3 creator
+    return dtx_index
 
-            matches2 = re.match(valid_tag + "(?P<id>[0-9A-Z]{2})?", tag)
 
-            if not matches2:
-                pass
+def get_value_from_dtx(target_tag, dtx_index, default=None):
+    for tag, value in dtx_index['tags']:
+        if tag.startswith(target_tag):
+            return value
 
-            vol_id = matches2.group('id')
+    return default
 
-            if vol_id:
-                vol_id = int(vol_id, 36)
-            else:
-                vol_id = 0
 
-            wav_volumes[vol_id] = int(value)
+def get_bpms_from_dtx(dtx_index):
+    bpms = {}
+    base_bpm = 0
 
-    return wav_volumes
+    for bpm_id, value in dtx_index['bpms']:
+        bpms[bpm_id] = float(value)
 
+    for value in dtx_index['base_bpms']:
+        base_bpm = float(value)
 
-def get_wav_pans_from_dtx(lines):
-    wav_pans = {}
+    return bpms, base_bpm
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
 
-        if not matches:
-            continue
+def get_wavs_from_dtx(dtx_index, target_parts, sound_metadata, get_wav_length=True):
+    wav_filenames = {}
+    wav_lengths = {}
 
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
+    for wav_id, value in dtx_index['wavs']:
+        # Handle WAV tags
+        # This can be exported for use by va3 creator
+        wav_filenames[wav_id] = os.sep.join(value.split('\\'))
 
-        if tag.startswith("PAN"):
-            valid_tag = "PAN"
-        elif tag.startswith("WAVPAN"):
-            valid_tag = "WAVPAN"
+        if get_wav_length and ('guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts):
+            duration = audio.get_duration(os.path.join(sound_metadata['sound_folder'], value))
+            wav_lengths[wav_id] = int(round(duration * 300))
         else:
-            valid_tag = None
+            wav_lengths[wav_id] = 0
+
+    return wav_filenames, wav_lengths
 
 
-        if valid_tag:
-            # Handle PAN tags
-            # This can be exported for use by va3 creator
+def get_wav_volumes_from_dtx(dtx_index):
+    wav_volumes = {}
 
-            matches2 = re.match(valid_tag + "(?P<id>[0-9A-Z]{2})?", tag)
+    for vol_id, value in dtx_index['volumes']:
+        # Handle VOLUME tags
+        # This can be exported for use by va3 creator
+        wav_volumes[vol_id] = int(value)
 
-            if not matches2:
-                pass
+    return wav_volumes
 
-            pan_id = matches2.group('id')
 
-            if pan_id:
-                pan_id = int(pan_id, 36)
-            else:
-                pan_id = 0
+def get_wav_pans_from_dtx(dtx_index):
+    wav_pans = {}
 
-            wav_pans[pan_id] = int(value)
+    for pan_id, value in dtx_index['pans']:
+        # Handle PAN tags
+        # This can be exported for use by va3 creator
+        wav_pans[pan_id] = int(value)
 
     return wav_pans
 
 
-def get_bonus_notes_from_dtx(lines, start_offset_padding):
+def get_bonus_notes_from_dtx(dtx_index, start_offset_padding):
     bonus_notes = {}
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
-
-        if not matches:
-            continue
-
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
-
-        if tag[0].isdigit():
-            matches2 = re.match("(?P<measure>[0-9]{3})(?P<event>[0-9A-F]{2})", tag)
-
-            if not matches2:
-                pass
+    for measure, event, value in dtx_index['channels']:
+        measure += start_offset_padding
 
-            measure = int(matches2.group('measure')) + start_offset_padding
-            event = int(matches2.group('event'), 16)
+        if event in [0x4c, 0x4d, 0x4e, 0x4f]:  # Bonus notes
+            data = [value[i:i+2] for i in range(0, len(value), 2)]
+            for i in range(len(data)):
+                if measure not in bonus_notes:
+                    bonus_notes[measure] = {}
 
-            if event in [0x4c, 0x4d, 0x4e, 0x4f]:  # Bonus notes
-                data = [value[i:i+2] for i in range(0, len(value), 2)]
-                for i in range(len(data)):
-                    if measure not in bonus_notes:
-                        bonus_notes[measure] = {}
+                if i not in bonus_notes[measure]:
+                    bonus_notes[measure][i] = []
 
-                    if i not in bonus_notes[measure]:
-                        bonus_notes[measure][i] = []
-
-                    bonus_notes[measure][i].append(int(data[i], 36))
+                bonus_notes[measure][i].append(int(data[i], 36))
 
     return bonus_notes
 
 
-def get_measure_lengths_from_dtx(lines, start_offset_padding):
+def get_measure_lengths_from_dtx(dtx_index, start_offset_padding):
     VALID_TIMESIG_DENOMINATORS = [1 << x for x in range(0, 256)]
 
     measure_lengths = {}
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
+    for measure, event, value in dtx_index['channels']:
+        measure += start_offset_padding
 
-        if not matches:
+        if event != 0x02:
             continue
 
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
-
-        if tag[0].isdigit():
-            matches2 = re.match("(?P<measure>[0-9]{3})(?P<event>[0-9A-F]{2})", tag)
-
-            if not matches2:
-                pass
-
-            measure = int(matches2.group('measure')) + start_offset_padding
-            event = int(matches2.group('event'), 16)
-
-            if event != 0x02:
-                continue
-
-            # Measure length event
-            f1 = Fraction(float(value)).limit_denominator()
-            numerator = f1.numerator
-            denominator = f1.denominator
-
-            # How to code this?
-            if denominator == 1:
-                numerator *= 4
-                denominator = 4
-            elif denominator == 2:
-                numerator *= 2
-                denominator = 4
-
-            f2 = Fraction2(numerator, denominator)
-
-            # Add check for impossible time signatures
-            if denominator not in VALID_TIMESIG_DENOMINATORS:
-                print("ERROR: This is an impossible to represent"
-                      "time signature: {}".format(value))
-                print("This came out to be", f2)
-                print("Valid denominators for the time signature"
-                      "must be a power of two...", VALID_TIMESIG_DENOMINATORS[:12])
-                print("Please try simplifying all measures which"
-                      "use the measure length {}".format(value))
-                exit(1)
+        # Measure length event
+        f1 = Fraction(float(value)).limit_denominator()
+        numerator = f1.numerator
+        denominator = f1.denominator
+
+        # How to code this?
+        if denominator == 1:
+            numerator *= 4
+            denominator = 4
+        elif denominator == 2:
+            numerator *= 2
+            denominator = 4
+
+        f2 = Fraction2(numerator, denominator)
+
+        # Add check for impossible time signatures
+        if denominator not in VALID_TIMESIG_DENOMINATORS:
+            print("ERROR: This is an impossible to represent"
+                  "time signature: {}".format(value))
+            print("This came out to be", f2)
+            print("Valid denominators for the time signature"
+                  "must be a power of two...", VALID_TIMESIG_DENOMINATORS[:12])
+            print("Please try simplifying all measures which"
+                  "use the measure length {}".format(value))
+            exit(1)
 
-            measure_lengths[measure] = f2
+        measure_lengths[measure] = f2
 
     if 0 not in measure_lengths:
         measure_lengths[0] = Fraction2(4, 4)  # Default to 4/4
@@ -507,62 +493,49 @@ def get_measure_lengths_from_dtx(lines, start_offset_padding):
     return measure_lengths
 
 
-def get_events_by_measure_from_dtx(lines, start_offset_padding):
+def get_events_by_measure_from_dtx(dtx_index, start_offset_padding):
     events_by_measure = {}
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
+    for measure, event, value in dtx_index['channels']:
+        measure += start_offset_padding
 
-        if not matches:
+        if event == 0x02:
             continue
 
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
-
-        if tag[0].isdigit():
-            matches2 = re.match("(?P<measure>[0-9]{3})(?P<event>[0-9A-F]{2})", tag)
-
-            if not matches2:
-                pass
-
-            measure = int(matches2.group('measure')) + start_offset_padding
-            event = int(matches2.group('event'), 16)
+        # Handle specific events
+        if measure not in events_by_measure:
+            events_by_measure[measure] = {}
 
-            if event == 0x02:
-                continue
-
-            # Handle specific events
-            if measure not in events_by_measure:
-                events_by_measure[measure] = {}
-
-            events_by_measure[measure][event] = [value[i:i+2] for i in range(0, len(value), 2)]
+        events_by_measure[measure][event] = [value[i:i+2] for i in range(0, len(value), 2)]
 
     return events_by_measure
 
 
 def pad_events(events_by_measure, measure_lengths):
-    # Pad all measures to appropriate sizes
-    for measure in events_by_measure:
-        for event in events_by_measure[measure]:
-            scale = Fraction(4, 4)
+    # Spread the chips of every measure over the measure's length
+    measure_lengths_keys = sorted(measure_lengths.keys(), key=lambda x: int(x))
+    measure_lengths_ints = [int(x) for x in measure_lengths_keys]
 
-            measure_lengths_keys = sorted(measure_lengths.keys(), key=lambda x: int(x))
-            matched_measures = [x for x in measure_lengths_keys if int(x) <= measure]
+    for measure in events_by_measure:
+        scale = Fraction(4, 4)
 
-            if len(matched_measures) > 0:
-                scale = measure_lengths[matched_measures[-1]]
+        idx = bisect.bisect_right(measure_lengths_ints, measure) - 1
+        if idx >= 0:
+            scale = measure_lengths[measure_lengths_keys[idx]]
 
-            event_count = len(events_by_measure[measure][event])
-            beat_division = (1920 / scale.denominator) * scale.numerator
+        beat_division = (1920 / scale.denominator) * scale.numerator
 
-            new_chips = []
-            for i in range(len(events_by_measure[measure][event])):
-                c = events_by_measure[measure][event][i]
+        for event in events_by_measure[measure]:
+            chips = events_by_measure[measure][event]
 
-                new_chips.append(c)
-                new_chips += ['00'] * (int(beat_division / len(events_by_measure[measure][event])) - 1)
+            if len(chips) == 0:
+                events_by_measure[measure][event] = DtxChannel(0)
+                continue
 
-            events_by_measure[measure][event] = new_chips
+            step = max(int(beat_division / len(chips)), 1)
+            events_by_measure[measure][event] = DtxChannel(len(chips) * step, {
+                i * step: c for i, c in enumerate(chips) if c != '00'
+            })
 
     return events_by_measure
 
@@ -572,16 +545,15 @@ def get_bpms_at_measure_beat(events, bpms):
 
     for measure in events:
         if 0x08 in events[measure]:
-            for i in range(len(events[measure][0x08])):
-                if events[measure][0x08][i] != "00":
-                    if measure not in bpms_at_measure_beat:
-                        bpms_at_measure_beat[measure] = {}
+            for i in events[measure][0x08].get_ticks():
+                if measure not in bpms_at_measure_beat:
+                    bpms_at_measure_beat[measure] = {}
 
-                    if i not in bpms_at_measure_beat[measure]:
-                        bpms_at_measure_beat[measure][i] = {}
+                if i not in bpms_at_measure_beat[measure]:
+                    bpms_at_measure_beat[measure][i] = {}
 
-                    val = int(events[measure][0x08][i], 36)
-                    bpms_at_measure_beat[measure][i] = bpms[val]
+                val = int(events[measure][0x08][i], 36)
+                bpms_at_measure_beat[measure][i] = bpms[val]
 
     if 0 not in bpms_at_measure_beat:
         bpms_at_measure_beat[0] = {0: bpms[0]}
@@ -595,12 +567,11 @@ def get_guitar_long_notes_at_measure_beat(events):
     for measure in events:
         for long_event in [0x2a, 0x2c]:
             if long_event in events[measure]:
-                for i in range(len(events[measure][long_event])):
-                    if events[measure][long_event][i] != "00":
-                        if measure not in guitar_long_notes_at_measure_beat:
-                            guitar_long_notes_at_measure_beat[measure] = {}
+                for i in events[measure][long_event].get_ticks():
+                    if measure not in guitar_long_notes_at_measure_beat:
+                        guitar_long_notes_at_measure_beat[measure] = {}
 
-                        guitar_long_notes_at_measure_beat[measure][i] = True
+                    guitar_long_notes_at_measure_beat[measure][i] = True
 
     return guitar_long_notes_at_measure_beat
 
@@ -611,12 +582,11 @@ def get_bass_long_notes_at_measure_beat(events):
     for measure in events:
         for long_event in [0x2b, 0x2d]:
             if long_event in events[measure]:
-                for i in range(len(events[measure][long_event])):
-                    if events[measure][long_event][i] != "00":
-                        if measure not in bass_long_notes_at_measure_beat:
-                            bass_long_notes_at_measure_beat[measure] = {}
+                for i in events[measure][long_event].get_ticks():
+                    if measure not in bass_long_notes_at_measure_beat:
+                        bass_long_notes_at_measure_beat[measure] = {}
 
-                        bass_long_notes_at_measure_beat[measure][i] = True
+                    bass_long_notes_at_measure_beat[measure][i] = True
 
     return bass_long_notes_at_measure_beat
 
@@ -627,17 +597,16 @@ def get_notes_by_measure_beat(events):
     for measure in events:
         for event in events[measure]:
             if event in guitar_range or event in bass_range:
-                for i in range(len(events[measure][event])):
-                    if events[measure][event][i] != "00":
-                        if measure not in notes_by_measure_beat:
-                            notes_by_measure_beat[measure] = {}
-
-                        if event in guitar_range:
-                            notes_by_measure_beat[measure][i] = 1
-                        elif event in bass_range:
-                            notes_by_measure_beat[measure][i] = 2
-                        else:
-                            notes_by_measure_beat[measure][i] = 0
+                for i in events[measure][event].get_ticks():
+                    if measure not in notes_by_measure_beat:
+                        notes_by_measure_beat[measure] = {}
+
+                    if event in guitar_range:
+                        notes_by_measure_beat[measure][i] = 1
+                    elif event in bass_range:
+                        notes_by_measure_beat[measure][i] = 2
+                    else:
+                        notes_by_measure_beat[measure][i] = 0
 
     return notes_by_measure_beat
 
@@ -729,36 +698,6 @@ def generate_sound_metadata_map(sound_metadata, wav_filenames, wav_volumes, wav_
     return sound_metadata_map, sound_metadata
 
 
-bpm_cache = {}
-def find_last_bpm(measure, target_beat, bpms_at_measure_beat):
-    global bpm_cache
-
-    last_bpm = 0
-
-    if measure in bpm_cache and target_beat in bpm_cache[measure]:
-        return bpm_cache[measure][target_beat]
-
-    for pk in sorted(bpms_at_measure_beat.keys()):
-        if pk > measure:
-            break
-
-        if pk not in bpms_at_measure_beat:
-            continue
-
-        for subbeat_k in sorted(bpms_at_measure_beat[pk].keys()):
-            is_start = measure == 0 and target_beat == 0
-            if not is_start and pk == measure and subbeat_k > target_beat:
-                break
-
-            last_bpm = bpms_at_measure_beat[pk][subbeat_k]
-
-    if measure not in bpm_cache:
-        bpm_cache[measure] = {}
-
-    bpm_cache[measure][target_beat] = last_bpm
-
-    return last_bpm
-
 def is_mid_bpm(measure, bpms_at_measure_beat):
     if measure not in bpms_at_measure_beat:
         return False
@@ -773,94 +712,88 @@ def is_mid_bpm(measure, bpms_at_measure_beat):
     return False
 
 
-timestamp_cache = {}
-timestamp_cache2 = {}
-def calculate_current_timestamp(measure, target_beat, measure_lengths, bpms_at_measure_beat):
-    global bpm_cache
-    global timestamp_cache
-    global timestamp_cache2
 
-    def _calculate_current_timestamp(measure, target_beat, prev, timesig, bpm):
-        cache_key = "%d_%d_%d_%d_%f" % (
-            measure,
-            target_beat,
-            timesig.numerator,
-            timesig.denominator,
-            bpm
-        )
+def get_timestamp_step(measure, target_beat, timesig, bpm):
+    one_measure = (1920 / timesig.denominator) * timesig.numerator
+    beat_ts = (60 / (bpm * (timesig.denominator / 4))) * 300
+    beat_len = (beat_ts * timesig.numerator) / one_measure
 
-        if cache_key in timestamp_cache2:
-            return timestamp_cache2[cache_key]
+    return (((measure * one_measure) + target_beat) * beat_len) / 300
 
-        one_measure = (1920 / timesig.denominator) * timesig.numerator
-        beat_ts = (60 / (bpm * (timesig.denominator / 4))) * 300
-        beat_len = (beat_ts * timesig.numerator) / one_measure
 
-        timestamp = (((measure * one_measure) + target_beat) * beat_len) / 300
-        timestamp_cache2[cache_key] = timestamp
+class DtxTempoMap:
+    # Cumulative timestamps for a chart, built from the measure lengths and
+    # BPM changes. Each measure is only walked once, after that any
+    # (measure, beat) lookup is a binary search or a list index.
+    def __init__(self, measure_lengths, bpms_at_measure_beat):
+        self.measure_lengths = measure_lengths
+        self.bpms_at_measure_beat = bpms_at_measure_beat
 
-        return timestamp
+        self.timesig_measures = sorted(measure_lengths.keys())
 
-    if measure in timestamp_cache and target_beat in timestamp_cache[measure]:
-        return timestamp_cache[measure][target_beat]
+        self.bpm_positions = []
+        self.bpms = []
+        for measure in sorted(bpms_at_measure_beat.keys()):
+            for subbeat in sorted(bpms_at_measure_beat[measure].keys()):
+                self.bpm_positions.append((measure, subbeat))
+                self.bpms.append(bpms_at_measure_beat[measure][subbeat])
 
-    measure_lengths_before_target = {}
-    results = [0]
-    keys = sorted(measure_lengths.keys())
+        # Time in seconds at the start of each measure, extended as needed
+        self.measure_timestamps = [0]
 
-    if len(keys) > 0:
-        measure_lengths_before_target[keys[0]] = 0
+        # Time in seconds at every beat of measures that were looked up below the measure level
+        self.beat_timestamps = {}
 
-    for cur_measure in range(measure + 1):
-        current_timesig = find_last_timesig(cur_measure, measure_lengths)
+    def get_timesig(self, measure):
+        idx = bisect.bisect_right(self.timesig_measures, measure) - 1
+        return self.measure_lengths[self.timesig_measures[idx]] if idx >= 0 else None
 
-        if cur_measure == measure or is_mid_bpm(cur_measure, bpms_at_measure_beat):
-            numerator = current_timesig.numerator
-            denominator = current_timesig.denominator
-            beat_division = int(round((1920 // denominator) * numerator))
+    def get_bpm(self, measure, target_beat):
+        if measure == 0 and target_beat == 0:
+            # The start of the chart uses the last BPM set within the first measure
+            target_beat = math.inf
 
-            for cur_beat in range(beat_division):
-                if cur_measure not in bpm_cache or cur_beat not in bpm_cache[cur_measure]:
-                    current_bpm = find_last_bpm(cur_measure, cur_beat, bpms_at_measure_beat)
-                else:
-                    current_bpm = bpm_cache[cur_measure][cur_beat]
+        idx = bisect.bisect_right(self.bpm_positions, (measure, target_beat)) - 1
+        return self.bpms[idx] if idx >= 0 else 0
+
+    def get_measure_timestamp(self, measure):
+        while len(self.measure_timestamps) <= measure:
+            cur_measure = len(self.measure_timestamps) - 1
 
-                if cur_measure >= measure and cur_beat >= target_beat:
-                    break
+            if is_mid_bpm(cur_measure, self.bpms_at_measure_beat):
+                self.measure_timestamps.append(self.get_beat_timestamps(cur_measure)[-1])
+            else:
+                step = get_timestamp_step(1, 0, self.get_timesig(cur_measure), self.get_bpm(cur_measure, 0))
+                self.measure_timestamps.append(self.measure_timestamps[-1] + step)
 
-                cache_key = "0_1_%d_%d_%f" % (
-                    current_timesig.numerator,
-                    current_timesig.denominator,
-                    current_bpm
-                )
+        return self.measure_timestamps[measure]
 
-                results.append(results[-1] + timestamp_cache2.get(cache_key, _calculate_current_timestamp(0, 1, results[-1], current_timesig, current_bpm)))
-        else:
-            cur_beat = 0
+    def get_beat_timestamps(self, measure):
+        if measure in self.beat_timestamps:
+            return self.beat_timestamps[measure]
 
-            if cur_measure not in bpm_cache or cur_beat not in bpm_cache[cur_measure]:
-                current_bpm = find_last_bpm(cur_measure, cur_beat, bpms_at_measure_beat)
-            else:
-                current_bpm = bpm_cache[cur_measure][cur_beat]
+        timesig = self.get_timesig(measure)
+        beat_division = int(round((1920 // timesig.denominator) * timesig.numerator))
 
-            cache_key = "1_0_%d_%d_%f" % (
-                current_timesig.numerator,
-                current_timesig.denominator,
-                current_bpm
-            )
+        results = [self.get_measure_timestamp(measure)]
+        for cur_beat in range(beat_division):
+            results.append(results[-1] + get_timestamp_step(0, 1, timesig, self.get_bpm(measure, cur_beat)))
 
-            if cache_key in timestamp_cache2:
-                results.append(results[-1] + timestamp_cache2[cache_key])
-            else:
-                results.append(results[-1] + _calculate_current_timestamp(1, 0, results[-1], current_timesig, current_bpm))
+        self.beat_timestamps[measure] = results
+
+        return results
 
-    if measure not in timestamp_cache:
-        timestamp_cache[measure] = {}
+    def get_timestamp(self, measure, target_beat):
+        if measure < 0:
+            return 0
 
-    result = int(round(results[-1] * 300))
-    timestamp_cache[measure][target_beat] = result
+        if target_beat == 0:
+            timestamp = self.get_measure_timestamp(measure)
+        else:
+            beat_timestamps = self.get_beat_timestamps(measure)
+            timestamp = beat_timestamps[min(target_beat, len(beat_timestamps) - 1)]
 
-    return result
+        return int(round(timestamp * 300))
 
 
 def find_last_timesig(measure, measure_lengths):
@@ -975,14 +908,14 @@ def get_valid_chart(chart):
     return None
 
 
-def get_chart_datas(chart_data, lines):
-    song_title = get_value_from_dtx("TITLE", lines, default="")
-    artist_name = get_value_from_dtx("ARTIST", lines, default="")
-    drum_difficulty = get_value_from_dtx("DLEVEL", lines, default=0)
-    guitar_difficulty = get_value_from_dtx("GLEVEL", lines, default=0)
-    bass_difficulty = get_value_from_dtx("BLEVEL", lines, default=0)
-    pre_image = get_value_from_dtx("PREIMAGE", lines)
-    bpms, base_bpm = get_bpms_from_dtx(lines)
+def get_chart_datas(chart_data, dtx_index):
+    song_title = get_value_from_dtx("TITLE", dtx_index, default="")
+    artist_name = get_value_from_dtx("ARTIST", dtx_index, default="")
+    drum_difficulty = get_value_from_dtx("DLEVEL", dtx_index, default=0)
+    guitar_difficulty = get_value_from_dtx("GLEVEL", dtx_index, default=0)
+    bass_difficulty = get_value_from_dtx("BLEVEL", dtx_index, default=0)
+    pre_image = get_value_from_dtx("PREIMAGE", dtx_index)
+    bpms, base_bpm = get_bpms_from_dtx(dtx_index)
     first_bpm = bpms[sorted(bpms.keys(), key=lambda x:int(x))[0]]
 
     drum_chart_data = {
@@ -1066,49 +999,115 @@ def get_chart_datas(chart_data, lines):
     return get_valid_chart(drum_chart_data), get_valid_chart(guitar_chart_data), get_valid_chart(bass_chart_data)
 
 
-# TODO: Try to refactor this more later
-def parse_dtx_to_intermediate(filename,
-                              params,
-                              sound_metadata,
-                              target_parts=['drum', 'guitar', 'bass', 'open']):
-    global timestamp_cache
-    global bpm_cache
-    global timestamp_cache2
+def get_dtx_lines(data):
+    for encoding in ["shift-jis", "utf-8"]:
+        try:
+            with io.TextIOWrapper(io.BytesIO(data), encoding=encoding) as f:
+                return [x.strip() for x in f if x.strip().startswith("#")]
+        except:
+            pass
+
+    with io.TextIOWrapper(io.BytesIO(data), encoding="utf-16") as f:
+        return [x.strip() for x in f if x.strip().startswith("#")]
+
+
+def get_dtx_processes(params):
+    # Parse in this process unless more processes were asked for
+    return params.get('dtx_processes') or 1
 
+
+def parse_dtx_data(data, params):
+    # Everything a parse needs is kept in locals and the returned dict so
+    # files can be parsed at the same time in different processes
     start_offset_padding = params.get('dtx_pad_start', 0)
 
-    timestamp_cache = {}
-    bpm_cache = {}
-    timestamp_cache2 = {}
-    bpms_at_measure_beat = {}
+    # Parse all commands
+    dtx_index = get_dtx_index(get_dtx_lines(data))
+    bpms, base_bpm = get_bpms_from_dtx(dtx_index)
+    measure_lengths = get_measure_lengths_from_dtx(dtx_index, start_offset_padding)
+    events_by_measure = get_events_by_measure_from_dtx(dtx_index, start_offset_padding)
+    events_by_measure = pad_events(events_by_measure, measure_lengths)
+    bpms_at_measure_beat = get_bpms_at_measure_beat(events_by_measure, bpms)
+
+    parsed_dtx = {
+        'dtx_index': dtx_index,
+        'preview_filename': get_value_from_dtx("PREVIEW", dtx_index),
+        'wav_volumes': get_wav_volumes_from_dtx(dtx_index),
+        'wav_pans': get_wav_pans_from_dtx(dtx_index),
+        'bpms': bpms,
+        'base_bpm': base_bpm,
+        'bonus_notes': get_bonus_notes_from_dtx(dtx_index, start_offset_padding),
+        'measure_lengths': measure_lengths,
+        'events_by_measure': events_by_measure,
+        'tempo_map': DtxTempoMap(measure_lengths, bpms_at_measure_beat),
+    }
+
+    return parsed_dtx
+
+
+def parse_dtx(filename, params):
+    with open(filename, "rb") as f:
+        return parse_dtx_data(f.read(), params)
+
+
+def parse_dtx_files(filenames, params):
+    # Parse every file once up front, using a process per file when there's more than one.
+    # Returns the parsed files by absolute path. The drum, guitar and bass charts of a
+    # difficulty are usually in the same file, so every part is built from the same parse.
+    # Only the parsing is done in parallel, the charts are still built one after
+    # another so sound IDs come out the same no matter how many processes are used.
+    filenames = list(dict.fromkeys([os.path.abspath(filename) for filename in filenames]))
+    processes = min(get_dtx_processes(params), len(filenames))
+
+    if processes <= 1:
+        return {filename: parse_dtx(filename, params) for filename in filenames}
+
+    datas = []
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            datas.append(f.read())
+
+    worker_params = {
+        'dtx_pad_start': params.get('dtx_pad_start', 0),
+    }
 
+    # Spawned rather than forked for the same reason as the render workers in
+    # wav.py: files are usually converted in a worker thread
+    with multiprocessing.get_context("spawn").Pool(processes) as pool:
+        parsed_dtxs = pool.starmap(parse_dtx_data, [(data, worker_params) for data in datas])
+
+    return dict(zip(filenames, parsed_dtxs))
+
+
+# TODO: Try to refactor this more later
+def parse_dtx_to_intermediate(filename,
+                              params,
+                              sound_metadata,
+                              target_parts=['drum', 'guitar', 'bass', 'open'],
+                              parsed_dtxs=None):
     if not filename or not os.path.exists(filename):
         return None, None, None, None, sound_metadata
 
-    try:
-        with open(filename, "r", encoding="shift-jis") as f:
-            lines = [x.strip() for x in f if x.strip().startswith("#")]
-    except:
-        try:
-            with open(filename, "r", encoding="utf-8") as f:
-                lines = [x.strip() for x in f if x.strip().startswith("#")]
-        except:
-            with open(filename, "r", encoding="utf-16") as f:
-                lines = [x.strip() for x in f if x.strip().startswith("#")]
+    # The parse is shared between parts, only the part's view is built here
+    if parsed_dtxs and os.path.abspath(filename) in parsed_dtxs:
+        parsed_dtx = parsed_dtxs[os.path.abspath(filename)]
+    else:
+        parsed_dtx = parse_dtx(filename, params)
+    dtx_index = parsed_dtx['dtx_index']
+    preview_filename = parsed_dtx['preview_filename']
+    wav_volumes = parsed_dtx['wav_volumes']
+    wav_pans = parsed_dtx['wav_pans']
+    bpms = parsed_dtx['bpms']
+    base_bpm = parsed_dtx['base_bpm']
+    bonus_notes = parsed_dtx['bonus_notes']
+    measure_lengths = parsed_dtx['measure_lengths']
+    events_by_measure = parsed_dtx['events_by_measure']
+    tempo_map = parsed_dtx['tempo_map']
 
-    # Parse all commands
     bgm_info = []
     default_notes = {}
 
-    preview_filename = get_value_from_dtx("PREVIEW", lines)
-    wav_filenames, wav_lengths = get_wavs_from_dtx(lines, target_parts, sound_metadata, not params.get('no_sounds', False))
-    wav_volumes = get_wav_volumes_from_dtx(lines)
-    wav_pans = get_wav_pans_from_dtx(lines)
-    bpms, base_bpm = get_bpms_from_dtx(lines)
-
-    bonus_notes = get_bonus_notes_from_dtx(lines, start_offset_padding)
-    measure_lengths = get_measure_lengths_from_dtx(lines, start_offset_padding)
-    events_by_measure = get_events_by_measure_from_dtx(lines, start_offset_padding)
+    wav_filenames, wav_lengths = get_wavs_from_dtx(dtx_index, target_parts, sound_metadata, not params.get('no_sounds', False))
 
     # Build data for sound metadata file
     # This must be correct to get the right sound id for the note commands
@@ -1120,9 +1119,6 @@ def parse_dtx_to_intermediate(filename,
     sound_metadata_guitar = []
     sound_metadata_drum = []
 
-    events_by_measure = pad_events(events_by_measure, measure_lengths)
-    bpms_at_measure_beat = get_bpms_at_measure_beat(events_by_measure, bpms)
-
     guitar_long_notes_at_measure_beat = get_guitar_long_notes_at_measure_beat(events_by_measure)
     guitar_long_note_time_by_measure_beat = \
         get_long_note_time_by_measure_beat(events_by_measure, guitar_long_notes_at_measure_beat, 1)
@@ -1156,7 +1152,7 @@ def parse_dtx_to_intermediate(filename,
     }
 
     # Add start events
-    timestamp_cur = calculate_current_timestamp(0, 0, measure_lengths, bpms_at_measure_beat)
+    timestamp_cur = tempo_map.get_timestamp(0, 0)
     chart_data['beats'][0] = []
     chart_data['beats'][0].append({
         "name": "startpos",
@@ -1218,7 +1214,7 @@ def parse_dtx_to_intermediate(filename,
         if global_beat_metadata not in metadata_chart_data['beats']:
             metadata_chart_data['beats'][global_beat_metadata] = []
 
-        timestamp_cur = calculate_current_timestamp(measure, 0, measure_lengths, bpms_at_measure_beat)
+        timestamp_cur = tempo_map.get_timestamp(measure, 0)
         if updated_time_signature:
             metadata_chart_data['beats'][global_beat_metadata].append({
                 "data": {
@@ -1253,7 +1249,7 @@ def parse_dtx_to_intermediate(filename,
 
             metadata_chart_data['beats'][beat].append({
                 "name": "beat",
-                "timestamp": calculate_current_timestamp(measure, cb, measure_lengths, bpms_at_measure_beat),
+                "timestamp": tempo_map.get_timestamp(measure, cb),
             })
 
         global_beat_metadata = int(round(global_beat_metadata))
@@ -1276,15 +1272,10 @@ def parse_dtx_to_intermediate(filename,
                 if event == 0x01:
                     # BGM item
                     data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
-
-                        timestamp = calculate_current_timestamp(
+                    for i in data.get_ticks():
+                        timestamp = tempo_map.get_timestamp(
                             measure,
-                            i % len(data),
-                            measure_lengths,
-                            bpms_at_measure_beat
+                            i
                         )
 
                         if int(data[i], 36) in wav_filenames:
@@ -1296,10 +1287,7 @@ def parse_dtx_to_intermediate(filename,
                 elif event == 0x03:
                     # Base BPM addition
                     data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
-
+                    for i in data.get_ticks():
                         beat = global_beat_metadata + i
 
                         if beat not in metadata_chart_data['beats']:
@@ -1312,11 +1300,9 @@ def parse_dtx_to_intermediate(filename,
                                 "bpm": new_bpm
                             },
                             "name": "bpm",
-                            "timestamp": calculate_current_timestamp(
+                            "timestamp": tempo_map.get_timestamp(
                                 measure,
-                                i % len(data),
-                                measure_lengths,
-                                bpms_at_measure_beat
+                                i
                             ),
                         })
 
@@ -1328,10 +1314,7 @@ def parse_dtx_to_intermediate(filename,
                 elif event == 0x08:
                     # BPM event
                     data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
-
+                    for i in data.get_ticks():
                         beat = global_beat_metadata + i
 
                         if beat not in metadata_chart_data['beats']:
@@ -1347,11 +1330,9 @@ def parse_dtx_to_intermediate(filename,
                                     "bpm": base_bpm + bpms[int(data[i], 36)]
                                 },
                                 "name": "bpm",
-                                "timestamp": calculate_current_timestamp(
+                                "timestamp": tempo_map.get_timestamp(
                                     measure,
-                                    i % len(data),
-                                    measure_lengths,
-                                    bpms_at_measure_beat
+                                    i
                                 ),
                             })
 
@@ -1363,10 +1344,7 @@ def parse_dtx_to_intermediate(filename,
                 elif event == 0xc2:
                     # baron/off
                     data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
-
+                    for i in data.get_ticks():
                         beat = global_beat_metadata + i
 
                         name = ""
@@ -1386,11 +1364,9 @@ def parse_dtx_to_intermediate(filename,
 
                         metadata_chart_data['beats'][beat].append({
                             "name": name,
-                            "timestamp": calculate_current_timestamp(
+                            "timestamp": tempo_map.get_timestamp(
                                 measure,
-                                i % len(data),
-                                measure_lengths,
-                                bpms_at_measure_beat
+                                i
                             ),
                         })
 
@@ -1399,10 +1375,7 @@ def parse_dtx_to_intermediate(filename,
 
                 elif event in default_note_events:
                     data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
-
+                    for i in data.get_ticks():
                         sound_id = int(data[i], 36)
                         mapped_sound_id = sound_metadata_map.get(sound_id, 0)
                         default_notes[reverse_dtx_mapping[event]] = mapped_sound_id
@@ -1410,43 +1383,30 @@ def parse_dtx_to_intermediate(filename,
                 elif event in [0x2a, 0x2c]:
                     # Guitar long note
                     data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
-
+                    for i in data.get_ticks():
                         if measure not in guitar_long_note_info:
                             guitar_long_note_info[measure] = {}
 
-                        guitar_long_note_info[measure][i] = calculate_current_timestamp(
+                        guitar_long_note_info[measure][i] = tempo_map.get_timestamp(
                             measure,
-                            i % len(data),
-                            measure_lengths,
-                            bpms_at_measure_beat
+                            i
                         )
 
                 elif event in [0x2b, 0x2d]:
                     # Bass long note
                     data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
-
+                    for i in data.get_ticks():
                         if measure not in bass_long_note_info:
                             bass_long_note_info[measure] = {}
 
-                        bass_long_note_info[measure][i] = calculate_current_timestamp(
+                        bass_long_note_info[measure][i] = tempo_map.get_timestamp(
                             measure,
-                            i % len(data),
-                            measure_lengths,
-                            bpms_at_measure_beat
+                            i
                         )
 
                 elif event in reverse_dtx_mapping:
                     data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
-
+                    for i in data.get_ticks():
                         beat = global_beat_chart + i
 
                         if beat not in chart_data['beats']:
@@ -1509,7 +1469,7 @@ def parse_dtx_to_intermediate(filename,
                                 "bonus_note": 1 if measure in bonus_notes and i in bonus_notes[measure] and sound_id in bonus_notes[measure][i] else 0,
                             },
                             "name": "note",
-                            "timestamp": calculate_current_timestamp(measure, i % len(data), measure_lengths, bpms_at_measure_beat),
+                            "timestamp": tempo_map.get_timestamp(measure, i),
                         })
 
                         if 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts:
@@ -1522,10 +1482,7 @@ def parse_dtx_to_intermediate(filename,
 
                     data = events_by_measure[measure][event]
 
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
-
+                    for i in data.get_ticks():
                         beat = global_beat_chart + i
 
                         if beat not in chart_data['beats']:
@@ -1549,7 +1506,7 @@ def parse_dtx_to_intermediate(filename,
                                 "guitar_special": 0,
                             },
                             "name": "note",
-                            "timestamp": calculate_current_timestamp(measure, i % len(data), measure_lengths, bpms_at_measure_beat),
+                            "timestamp": tempo_map.get_timestamp(measure, i),
                         })
 
                         if 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts:
@@ -1574,7 +1531,7 @@ def parse_dtx_to_intermediate(filename,
 
     chart_data['beats'][last_event[2]].append({
         "name": "chipend",
-        "timestamp": calculate_current_timestamp(last_event[0], last_event[1], measure_lengths, bpms_at_measure_beat),
+        "timestamp": tempo_map.get_timestamp(last_event[0], last_event[1]),
     })
 
     # Delayed end command
@@ -1592,12 +1549,12 @@ def parse_dtx_to_intermediate(filename,
 
     chart_data['beats'][last_event[2]].append({
         "name": "endpos",
-        "timestamp": calculate_current_timestamp(last_event[0], last_event[1], measure_lengths, bpms_at_measure_beat),
+        "timestamp": tempo_map.get_timestamp(last_event[0], last_event[1]),
     })
 
     metadata_chart_data['beats'][last_event[2]].append({
         "name": "endpos",
-        "timestamp": calculate_current_timestamp(last_event[0], last_event[1], measure_lengths, bpms_at_measure_beat),
+        "timestamp": tempo_map.get_timestamp(last_event[0], last_event[1]),
     })
 
     chart_data = generate_timestamp_set(chart_data, last_event)
@@ -1616,13 +1573,13 @@ def parse_dtx_to_intermediate(filename,
     sound_metadata['drum'] = list(set(sound_metadata['drum'] + sound_metadata_drum))
     sound_metadata['guitar'] = list(set(sound_metadata['guitar'] + sound_metadata_guitar))
     sound_metadata['bgm'] = {
-        'end': calculate_current_timestamp(last_event[0], last_event[1], measure_lengths, bpms_at_measure_beat) / 300,
+        'end': tempo_map.get_timestamp(last_event[0], last_event[1]) / 300,
         'data': bgm_info
     }
     sound_metadata['preview'] = preview_filename
     sound_metadata['defaults'] = default_notes
 
-    drum_chart_data, guitar_chart_data, bass_chart_data = get_chart_datas(chart_data, lines)
+    drum_chart_data, guitar_chart_data, bass_chart_data = get_chart_datas(chart_data, dtx_index)
 
     return metadata_chart_data, drum_chart_data, guitar_chart_data, bass_chart_data, sound_metadata
 
@@ -1654,24 +1611,45 @@ def create_json_from_dtx(params):
     ext_data = get_data('ext')
     master_data = get_data('mst')
 
+    # --parts all is expanded so it can be checked one part at a time
+    parts = helper.get_selected_parts(params)
+
+    # Skip charts that weren't selected before parsing them
+    all_data = [novice_data, basic_data, adv_data, ext_data, master_data]
+    difficulties = helper.get_part_difficulties(params, [(["drum", "guitar", "bass", "open"].index(part), idx) for idx, data in enumerate(all_data) for part in data if data[part]])
+    for idx, data in enumerate(all_data):
+        for part in list(data.keys()):
+            if not helper.is_chart_selected(params, ["drum", "guitar", "bass", "open"].index(part), idx, difficulties):
+                del data[part]
+
     sound_metadata = {'sound_folder': params['sound_folder'] if 'sound_folder' in params else "", 'preview': "", 'bgm': {}, 'data': {}, 'guitar': [], 'drum': [], 'defaults': {}}
 
+    # Parse the files for all difficulties at once
+    filenames = []
+    for data in all_data:
+        for part in ['drum', 'guitar', 'bass']:
+            if part in parts and data.get(part) and data[part] not in filenames:
+                filenames.append(data[part])
+
+    # Only kept for this song so parses don't pile up when converting many songs
+    parsed_dtxs = parse_dtx_files(filenames, params)
+
     def get_chart_data(data, sound_metadata, parts):
         metadatas = []
 
         chart_drum = None
         if "drum" in parts and 'drum' in data:
-            metadata1, chart_drum, _, _, sound_metadata = parse_dtx_to_intermediate(data['drum'], params, sound_metadata, "drum")
+            metadata1, chart_drum, _, _, sound_metadata = parse_dtx_to_intermediate(data['drum'], params, sound_metadata, "drum", parsed_dtxs)
             metadatas.append(metadata1)
 
         chart_guitar = None
         if "guitar" in parts and 'guitar' in data:
-            metadata2, _, chart_guitar, _, sound_metadata = parse_dtx_to_intermediate(data['guitar'], params, sound_metadata, "guitar")
+            metadata2, _, chart_guitar, _, sound_metadata = parse_dtx_to_intermediate(data['guitar'], params, sound_metadata, "guitar", parsed_dtxs)
             metadatas.append(metadata2)
 
         chart_bass = None
         if "bass" in parts and 'bass' in data:
-            metadata3, _,  _, chart_bass, sound_metadata = parse_dtx_to_intermediate(data['bass'], params, sound_metadata, "bass")
+            metadata3, _,  _, chart_bass, sound_metadata = parse_dtx_to_intermediate(data['bass'], params, sound_metadata, "bass", parsed_dtxs)
             metadatas.append(metadata3)
 
         chart_open = None
@@ -1684,11 +1662,11 @@ def create_json_from_dtx(params):
 
         return metadata, chart_drum, chart_guitar, chart_bass, chart_open, sound_metadata
 
-    novice_metadata, novice_chart_drum, novice_chart_guitar, novice_chart_bass, novice_chart_open, sound_metadata = get_chart_data(novice_data, sound_metadata, params['parts'])
-    basic_metadata, basic_chart_drum, basic_chart_guitar, basic_chart_bass, basic_chart_open, sound_metadata = get_chart_data(basic_data, sound_metadata, params['parts'])
-    adv_metadata, adv_chart_drum, adv_chart_guitar, adv_chart_bass, adv_chart_open, sound_metadata = get_chart_data(adv_data, sound_metadata, params['parts'])
-    ext_metadata, ext_chart_drum, ext_chart_guitar, ext_chart_bass, ext_chart_open, sound_metadata = get_chart_data(ext_data, sound_metadata, params['parts'])
-    master_metadata, master_chart_drum, master_chart_guitar, master_chart_bass, master_chart_open, sound_metadata = get_chart_data(master_data, sound_metadata, params['parts'])
+    novice_metadata, novice_chart_drum, novice_chart_guitar, novice_chart_bass, novice_chart_open, sound_metadata = get_chart_data(novice_data, sound_metadata, parts)
+    basic_metadata, basic_chart_drum, basic_chart_guitar, basic_chart_bass, basic_chart_open, sound_metadata = get_chart_data(basic_data, sound_metadata, parts)
+    adv_metadata, adv_chart_drum, adv_chart_guitar, adv_chart_bass, adv_chart_open, sound_metadata = get_chart_data(adv_data, sound_metadata, parts)
+    ext_metadata, ext_chart_drum, ext_chart_guitar, ext_chart_bass, ext_chart_open, sound_metadata = get_chart_data(ext_data, sound_metadata, parts)
+    master_metadata, master_chart_drum, master_chart_guitar, master_chart_bass, master_chart_open, sound_metadata = get_chart_data(master_data, sound_metadata, parts)
 
     # Create sound metadata file
     # Any notes not in the drums or guitar sound metadata fields should be added to both just in case
@@ -1748,28 +1726,28 @@ def create_json_from_dtx(params):
 
     metadata_charts = [x for x in [novice_metadata, basic_metadata, adv_metadata, ext_metadata, master_metadata] if x is not None]
 
-    if 'drum' not in params['parts']:
+    if 'drum' not in parts:
         novice_chart_drum = None
         basic_chart_drum = None
         adv_chart_drum = None
         ext_chart_drum = None
         master_chart_drum = None
 
-    if 'guitar' not in params['parts']:
+    if 'guitar' not in parts:
         novice_chart_guitar = None
         basic_chart_guitar = None
         adv_chart_guitar = None
         ext_chart_guitar = None
         master_chart_guitar = None
 
-    if 'bass' not in params['parts']:
+    if 'bass' not in parts:
         novice_chart_bass = None
         basic_chart_bass = None
         adv_chart_bass = None
         ext_chart_bass = None
         master_chart_bass = None
 
-    if 'guitar' not in params['parts'] and 'bass' not in params['parts']:
+    if 'guitar' not in parts and 'bass' not in parts:
         sound_metadata_guitar = None
 
     def set_chart_difficulty(charts, difficulty):
@@ -1800,38 +1778,54 @@ def create_json_from_dtx(params):
         "preview": sound_metadata['preview'],
     }
 
-    return json.dumps(output_json, indent=4, sort_keys=True)
+    return chartdata.get_chart_data(output_json)
 
 
 #########################
 #   DTX creation code   #
 #########################
 
-def combine_charts(metadata, chart):
-    chart_combined = copy.deepcopy(chart)
+def copy_event(event):
+    # The DTX creation code only ever changes an event's own fields and
+    # its data, so that's all that has to be copied to leave the input alone
+    event = dict(event)
 
-    # Remove endpos command from chart but keep metadata's command
-    for k in sorted(chart_combined['timestamp'].keys(), key=lambda x: int(x)):
-        filter_list = ["endpos"]
-        chart_combined['timestamp'][k] = [x for x in chart_combined['timestamp'][k] if x['name'] not in filter_list]
+    if 'data' in event:
+        event['data'] = dict(event['data'])
+
+    return event
 
-    for k in sorted(metadata['timestamp'].keys(), key=lambda x: int(x)):
-        if k not in chart_combined['timestamp']:
-            chart_combined['timestamp'][k] = []
 
-        for d in metadata['timestamp'][k]:
-            chart_combined['timestamp'][k].append(d)
+def get_sorted_timestamps(timestamps):
+    # Timestamps can be strings after a trip through JSON so sort them as numbers
+    return {k: timestamps[k] for k in sorted(timestamps.keys(), key=lambda x: int(x))}
+
+
+def combine_charts(metadata, chart):
+    # Merge the chart's and metadata's events in timestamp order.
+    # Everything after this relies on chart_combined['timestamp'] being sorted.
+    chart_combined = dict(chart)
+    chart_combined['timestamp'] = {}
+
+    timestamps = set(chart['timestamp'].keys()).union(metadata['timestamp'].keys())
+    for k in sorted(timestamps, key=lambda x: int(x)):
+        # Remove endpos command from chart but keep metadata's command
+        filter_list = ["endpos"]
+        chart_combined['timestamp'][k] = [copy_event(x) for x in chart['timestamp'].get(k, []) if x['name'] not in filter_list]
+        chart_combined['timestamp'][k] += [copy_event(x) for x in metadata['timestamp'].get(k, [])]
 
     return chart_combined
 
 
 def generate_hold_release_events(chart):
-    for k in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
+    added_timestamps = False
+
+    for k in list(chart['timestamp'].keys()):
         for beat in chart['timestamp'][k]:
             if beat['name'] == "note":
                 if 'guitar_special' in beat['data'] and beat['data']['guitar_special'] & 0x02:
                     # Long note start
-                    new_note = copy.deepcopy(beat)
+                    new_note = copy_event(beat)
                     new_note['name'] = "_note_start"
 
                     if 'beat' in new_note:
@@ -1840,7 +1834,7 @@ def generate_hold_release_events(chart):
                     chart['timestamp'][k].append(new_note)
 
                     # Long note end
-                    new_note = copy.deepcopy(beat)
+                    new_note = copy_event(beat)
                     new_note['name'] = "_note_release"
 
                     if 'beat' in new_note:
@@ -1872,16 +1866,20 @@ def generate_hold_release_events(chart):
 
                     if new_timestamp not in chart['timestamp']:
                         chart['timestamp'][new_timestamp] = []
+                        added_timestamps = True
 
                     chart['timestamp'][new_timestamp].append(new_note)
 
+    if added_timestamps:
+        chart['timestamp'] = get_sorted_timestamps(chart['timestamp'])
+
     return chart
 
 
 def get_time_signatures_by_timestamp(chart):
     time_signatures_by_timestamp = {}
 
-    for k in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
+    for k in chart['timestamp']:
         for beat in chart['timestamp'][k]:
             if beat['name'] == "barinfo":
                 time_signatures_by_timestamp[k] = {
@@ -1898,9 +1896,9 @@ def generate_time_signature_by_timestamp(chart):
     time_signatures_by_timestamp = get_time_signatures_by_timestamp(chart)
 
     # Generate a time_signature field for everything based on timestamp
-    for k in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        idx = [x for x in sorted(time_signatures_by_timestamp.keys(), key=lambda x: int(x)) if int(x) <= int(k)][-1]
-        time_signature = time_signatures_by_timestamp[idx]
+    time_signature = None
+    for k in chart['timestamp']:
+        time_signature = time_signatures_by_timestamp.get(k, time_signature)
 
         for idx in range(len(chart['timestamp'][k])):
             chart['timestamp'][k][idx]['time_signature'] = time_signature
@@ -1915,7 +1913,7 @@ def force_dtx_time_signatures(chart):
     last_bpm_k = None
     last_bpm_real = None
     is_mod_bpm = False
-    for k in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
+    for k in chart['timestamp']:
         for data in chart['timestamp'][k]:
             if data['name'] == "bpm":
                 last_bpm = data
@@ -1937,7 +1935,7 @@ def force_dtx_time_signatures(chart):
                                 data2['data']['bpm'] *= diff
                     else:
                         # Add new BPM command
-                        new_bpm = copy.deepcopy(last_bpm_real)
+                        new_bpm = copy_event(last_bpm_real)
                         new_bpm['beat'] = data['beat']
                         new_bpm['data']['bpm'] *= diff
                         chart['timestamp'][k].append(new_bpm)
@@ -1948,7 +1946,7 @@ def force_dtx_time_signatures(chart):
                 else:
                     if is_mod_bpm:
                         # Add new BPM command
-                        new_bpm = copy.deepcopy(last_bpm_real)
+                        new_bpm = copy_event(last_bpm_real)
                         new_bpm['beat'] = data['beat']
                         chart['timestamp'][k].append(new_bpm)
                         last_bpm = new_bpm
@@ -1961,6 +1959,10 @@ def force_dtx_time_signatures(chart):
 def generate_metadata_fields(metadata, chart, is_forced_dtx_time_signatures=False):
     # Generate and add any important data that isn't guaranteed to be there (namely, beat markers for SQ3)
 
+    # The same metadata chart is used for every chart so don't change the original
+    metadata = dict(metadata)
+    metadata['header'] = dict(metadata['header'])
+
     if 'beat_division' not in metadata['header']:
         metadata['header']['beat_division'] = 480
 
@@ -1981,7 +1983,7 @@ def generate_metadata_fields(metadata, chart, is_forced_dtx_time_signatures=Fals
 def get_chart_data_by_measure_beat(chart_data):
     chart_data_sorted = {}
 
-    for k in sorted(chart_data['timestamp'].keys(), key=lambda x: int(x)):
+    for k in chart_data['timestamp']:
         for idx in range(len(chart_data['timestamp'][k])):
             measure = chart_data['timestamp'][k][idx]['metadata']['measure']
             beat = chart_data['timestamp'][k][idx]['metadata']['beat']
@@ -1996,14 +1998,18 @@ def get_chart_data_by_measure_beat(chart_data):
             d['timestamp'] = k
             chart_data_sorted[measure][beat].append(d)
 
-    return chart_data_sorted
+    # Sort everything once here so the DTX writer can walk it in order
+    for measure in chart_data_sorted:
+        chart_data_sorted[measure] = {beat: chart_data_sorted[measure][beat] for beat in sorted(chart_data_sorted[measure].keys())}
+
+    return {measure: chart_data_sorted[measure] for measure in sorted(chart_data_sorted.keys())}
 
 
 def calculate_time_signatures_by_timestamp(chart_data):
     time_signatures_by_timestamp = {}
     last_timesig_timestamp = 0
 
-    for k in sorted(chart_data['timestamp'].keys(), key=lambda x: int(x)):
+    for k in chart_data['timestamp']:
         found_timesig = False
 
         for beat in chart_data['timestamp'][k]:
@@ -2028,13 +2034,9 @@ def add_time_signature_to_events(chart_data):
     time_signatures_by_timestamp = calculate_time_signatures_by_timestamp(chart_data)
 
     # Generate a time_signature field for everything based on timestamp
-    time_signatures_by_timestamp_keys = list(sorted(time_signatures_by_timestamp.keys(), key=lambda x: int(x)))
-    last_idx = 0
-    for k in sorted(chart_data['timestamp'].keys(), key=lambda x: int(x)):
-        idx = [x for x in time_signatures_by_timestamp_keys[last_idx:] if int(x) <= int(k)][-1]
-        last_idx = time_signatures_by_timestamp_keys.index(idx)
-
-        time_signature = time_signatures_by_timestamp[idx]
+    time_signature = None
+    for k in chart_data['timestamp']:
+        time_signature = time_signatures_by_timestamp.get(k, time_signature)
 
         for idx in range(len(chart_data['timestamp'][k])):
             chart_data['timestamp'][k][idx]['time_signature'] = time_signature
@@ -2051,7 +2053,7 @@ def generate_measure_beat_for_chart(chart_data):
     last_timesig = {'numerator': 4, 'denominator': 4}
     cur_bpm = None
     base_beat = 0
-    for k in sorted(chart_data['timestamp'].keys(), key=lambda x: int(x)):
+    for k in chart_data['timestamp']:
         for idx in range(len(chart_data['timestamp'][k])):
             if chart_data['timestamp'][k][idx]['name'] == "measure":
                 measure += 1
@@ -2122,48 +2124,45 @@ def get_clipped_wav(sound_metadata, sound_entry, duration):
 
     duration = round(duration, 3) # Pydub only can handle 3 decimal places
 
-    for entry in sound_metadata['entries']:
-        if not entry.get('clipped', False):
-            continue
-
-        if entry['filename'] == sound_entry['filename'] and entry['duration'] == duration:
-            return entry
+    clipped_wav_entry = sound_metadata.get_clipped_entry(sound_entry['filename'], duration)
+    if clipped_wav_entry:
+        return clipped_wav_entry
 
-    next_sound_id = 100
-    for entry in sound_metadata['entries']:
-        if entry['sound_id'] >= next_sound_id:
-            next_sound_id = entry['sound_id'] + 1
+    next_sound_id = sound_metadata.get_next_sound_id(100)
 
     clipped_wav_entry = copy.deepcopy(sound_entry)
     clipped_wav_entry['sound_id'] = next_sound_id
     clipped_wav_entry['clipped'] = True
     clipped_wav_entry['duration'] = duration
-    sound_metadata['entries'].append(clipped_wav_entry)
+    sound_metadata.add_entry(clipped_wav_entry)
 
     if "NoFilename" not in sound_entry['flags']:
         orig_wav_filename = "%s.wav" % (sound_entry['filename'])
     else:
         orig_wav_filename = "%04d.wav" % (next_sound_id)
 
-    if "NoFilename" not in sound_entry['flags']:
-        wav_filename = "_override_clipped_%d_%s.wav" % (next_sound_id, sound_entry['filename'])
-    else:
-        wav_filename = "_override_clipped_%d_%04d.wav" % (next_sound_id, next_sound_id)
-
     sound_folder = sound_metadata['sound_folder'] if sound_metadata['sound_folder'] else ""
     orig_wav_filename = os.path.join(sound_folder, orig_wav_filename)
-    wav_filename = os.path.join(sound_folder, wav_filename)
 
     if not os.path.exists(orig_wav_filename):
         return None
 
-    audio.clip_audio(orig_wav_filename, wav_filename, duration)
+    # Clips are named by the source's contents and the clip length instead of the
+    # sound ID, so a clip left over from another chart or run is only reused if
+    # it's exactly the same
+    source_hash, frames = audio.get_clip_key(orig_wav_filename, duration)
+    clipped_wav_entry['clipped_filename'] = "_override_clipped_%s_%d.wav" % (source_hash[:16], frames)
+
+    wav_filename = os.path.join(sound_folder, clipped_wav_entry['clipped_filename'])
+    if not os.path.exists(wav_filename):
+        audio.clip_audio(orig_wav_filename, wav_filename, duration)
 
     return clipped_wav_entry
 
 
 def generate_dtx_info(chart_data, sound_metadata, game_type):
-    sound_keys = [""]
+    # DTX sound IDs by sound key, IDs start at 1
+    sound_keys = {}
 
     sound_files = {}
     volumes = {}
@@ -2176,8 +2175,9 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
     last_played_note = None
 
     # TODO: Refactor this more eventually if possible
-    for measure in sorted(chart_data.keys(), key=lambda x: int(x)):
-        for beat in sorted(chart_data[measure].keys(), key=lambda x: int(x)):
+    # chart_data is already sorted by measure and beat
+    for measure in chart_data:
+        for beat in chart_data[measure]:
             for idx in range(len(chart_data[measure][beat])):
                 cd = chart_data[measure][beat][idx]
 
@@ -2193,13 +2193,12 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                 pan = 64  # Center
                 volume = 127  # 100% volume
                 if sound_metadata and 'entries' in sound_metadata:
-                    for sound_entry in sound_metadata['entries']:
-                        if sound_entry['sound_id'] == cd['data']['sound_id']:
-                            if 'volume' in sound_entry:
-                                volume = sound_entry['volume']
-                            if 'pan' in sound_entry:
-                                pan = sound_entry['pan']
-                            break
+                    sound_entry = sound_metadata.get_entry(cd['data']['sound_id'])
+                    if sound_entry:
+                        if 'volume' in sound_entry:
+                            volume = sound_entry['volume']
+                        if 'pan' in sound_entry:
+                            pan = sound_entry['pan']
 
                 pan_final = 0
                 if cd['data'].get('pan') != 64:
@@ -2257,9 +2256,9 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                         numerator = cd['time_signature']['numerator']
                         denominator = cd['time_signature']['denominator']
                         beat_division = int((1920 / denominator) * numerator)
-                        dtx_info[measure][0x08] = ['00'] * beat_division
+                        dtx_info[measure][0x08] = DtxChannel(beat_division)
                     d = dtx_info[measure][0x08]
-                    d[beat] = base_repr(len(bpms), 36, padding=2).upper()[-2:]
+                    d[beat] = get_dtx_base36(len(bpms))
                     cur_bpm = cd['data']['bpm']
 
                     dtx_info[measure][0x08] = d
@@ -2277,10 +2276,10 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                         numerator = cd['time_signature']['numerator']
                         denominator = cd['time_signature']['denominator']
                         beat_division = int((1920 / denominator) * numerator)
-                        dtx_info[measure][0xc2] = ['00'] * beat_division
+                        dtx_info[measure][0xc2] = DtxChannel(beat_division)
 
                     d = dtx_info[measure][0xc2]
-                    d[beat] = base_repr(0x01, 36, padding=2).upper()[-2:]
+                    d[beat] = get_dtx_base36(0x01)
 
                     dtx_info[measure][0xc2] = d
 
@@ -2289,10 +2288,10 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                         numerator = cd['time_signature']['numerator']
                         denominator = cd['time_signature']['denominator']
                         beat_division = int((1920 / denominator) * numerator)
-                        dtx_info[measure][0xc2] = ['00'] * beat_division
+                        dtx_info[measure][0xc2] = DtxChannel(beat_division)
 
                     d = dtx_info[measure][0xc2]
-                    d[beat + 10] = base_repr(0x02, 36, padding=2).upper()[-2:] #baroff should be right after barline, not on barline itself
+                    d[beat + 10] = get_dtx_base36(0x02) #baroff should be right after barline, not on barline itself
 
                     dtx_info[measure][0xc2] = d
 
@@ -2301,12 +2300,12 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                         numerator = cd['time_signature']['numerator']
                         denominator = cd['time_signature']['denominator']
                         beat_division = int((1920 / denominator) * numerator)
-                        dtx_info[measure][0x61] = ['00'] * beat_division
+                        dtx_info[measure][0x61] = DtxChannel(beat_division)
 
                     d = dtx_info[measure][0x61]
                     #For some songs, beat is 1920 which is off index
                     if beat in d:
-                        d[beat] = base_repr(1294, 36, padding=2).upper()[-2:] #1294 is ZY, which we assume no chip sound, or we can reserve it as empty
+                        d[beat] = get_dtx_base36(1294) #1294 is ZY, which we assume no chip sound, or we can reserve it as empty
                     else:
                         pass #avoid putting endpos for this case for now since only 8 songs affected. Manually place the endpos if it effects ending
 
@@ -2321,10 +2320,10 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                         numerator = cd['time_signature']['numerator']
                         denominator = cd['time_signature']['denominator']
                         beat_division = int((1920 / denominator) * numerator)
-                        dtx_info[measure][longnote_field] = ['00'] * beat_division
+                        dtx_info[measure][longnote_field] = DtxChannel(beat_division)
 
                     d = dtx_info[measure][longnote_field]
-                    d[beat] = base_repr(0x01, 36, padding=2).upper()[-2:]
+                    d[beat] = get_dtx_base36(0x01)
 
                     dtx_info[measure][longnote_field] = d
 
@@ -2334,9 +2333,7 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                         # Only one mutable sound can be played at once
                         sound_entry = None
                         if sound_metadata and 'entries' in sound_metadata:
-                            for sound_entry in sound_metadata['entries']:
-                                if sound_entry['sound_id'] == last_played_note['data']['data']['sound_id']:
-                                    break
+                            sound_entry = sound_metadata.get_entry(last_played_note['data']['data']['sound_id'])
 
                         if sound_entry:
                             time_diff = (int(cd['timestamp']) - int(last_played_note['data']['timestamp'])) / 300
@@ -2367,16 +2364,16 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                                     )
 
                                     if sound_key not in sound_keys:
-                                        sound_keys.append(sound_key)
-                                        sound_id = sound_keys.index(sound_key)
-                                        prev_sound_id = sound_keys.index(prev_sound_key)
+                                        sound_keys[sound_key] = len(sound_keys) + 1
+                                        sound_id = sound_keys[sound_key]
+                                        prev_sound_id = sound_keys[prev_sound_key]
 
                                         sound_files[sound_id] = last_played_note['data']['data']['sound_id']
                                         volumes[sound_id] = volumes[prev_sound_id]
                                         pans[sound_id] = pans[prev_sound_id]
 
-                                    sound_id = sound_keys.index(sound_key)
-                                    d[last_played_note['beat']] = base_repr(sound_id, 36, padding=2).upper()[-2:]
+                                    sound_id = sound_keys[sound_key]
+                                    d[last_played_note['beat']] = get_dtx_base36(sound_id)
                                     dtx_info[last_played_note['measure']][mapped_note] = d
 
                     mapped_note = dtx_mapping[cd['data']['note']]
@@ -2400,7 +2397,7 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                         numerator = cd['time_signature']['numerator']
                         denominator = cd['time_signature']['denominator']
                         beat_division = int((1920 / denominator) * numerator)
-                        dtx_info[measure][mapped_note] = ['00'] * beat_division
+                        dtx_info[measure][mapped_note] = DtxChannel(beat_division)
 
                     d = dtx_info[measure][mapped_note]
 
@@ -2417,16 +2414,16 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                     )
 
                     if sound_key not in sound_keys:
-                        sound_keys.append(sound_key)
-                        sound_id = sound_keys.index(sound_key)
+                        sound_keys[sound_key] = len(sound_keys) + 1
+                        sound_id = sound_keys[sound_key]
                         sound_files[sound_id] = cd['data']['sound_id']
                         volumes[sound_id] = cd['data']['volume']
                         pans[sound_id] = cd['data']['pan']
 
                     #print(measure, len(d), beat, cd['time_signature'], cur_bpm)
 
-                    sound_id = sound_keys.index(sound_key)
-                    d[beat] = base_repr(sound_id, 36, padding=2).upper()[-2:]
+                    sound_id = sound_keys[sound_key]
+                    d[beat] = get_dtx_base36(sound_id)
                     dtx_info[measure][mapped_note] = d
 
                     # Wail support
@@ -2445,7 +2442,7 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                             denominator = cd['time_signature']['denominator']
                             timesig = numerator / denominator
                             beat_division = int(1920 * timesig)
-                            dtx_info[measure][wail_field] = ['00'] * beat_division
+                            dtx_info[measure][wail_field] = DtxChannel(beat_division)
 
                         wail_d = dtx_info[measure][wail_field]
                         wail_d[beat] = d[beat]
@@ -2461,7 +2458,7 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                                 numerator = cd['time_signature']['numerator']
                                 denominator = cd['time_signature']['denominator']
                                 beat_division = int((1920 / denominator) * numerator)
-                                dtx_info[measure][bonus_note_lane] = ['00'] * beat_division
+                                dtx_info[measure][bonus_note_lane] = DtxChannel(beat_division)
 
                             bonus_d = dtx_info[measure][bonus_note_lane]
 
@@ -2469,7 +2466,7 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                                 bonus_note_lane -= 1
                                 continue
 
-                            bonus_d[beat] = base_repr(dtx_bonus_mapping[cd['data']['note']], 16, padding=2).upper()[-2:]
+                            bonus_d[beat] = "%02X" % dtx_bonus_mapping[cd['data']['note']]
 
                             dtx_info[measure][bonus_note_lane] = bonus_d
                             break
@@ -2492,66 +2489,56 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
     return dtx_info, bpms, sound_files, volumes, pans
 
 def downscale_beat_division_dtx_chart(input_dtx_info):
-    
     output_dtx_info = input_dtx_info
     #Reduce from 1920 divisions to 192 as that is the max supported in dtx
     for measure in sorted(output_dtx_info.keys(), key=lambda x: int(x)):
         for key in sorted(output_dtx_info[measure].keys(), key=lambda x: int(x)):
-            if( len(output_dtx_info[measure][key]) >= 10):
-                in_length = len(output_dtx_info[measure][key])
-                out_length = in_length // 10
-                new_array = ['00'] * out_length
-                temp_new_object = []
-                for x in range(0, in_length):
-                    if(output_dtx_info[measure][key][x] != '00'):
-                        #Round x to nearest integer after divide by 10 
-                        num_y = int(round(x/10.0))
-                        
-                        #if num_y happens to be equal to out_length, move the note to the next measure at the zeroth position!
-                        if(num_y >= out_length):
-                            next_measure = measure + 1
-                            if(next_measure < len(output_dtx_info)):
-                                #Check if key exist
-                                if(not key in output_dtx_info[next_measure]):
-                                    #Get any bar length change member from next_measure if any
-                                    next_measure_length = in_length
-                                    if(2 in output_dtx_info[next_measure]):
-                                        next_measure_length = int(float(output_dtx_info[next_measure][2][0]) * 1920)
-                                    #Create new key for next measure
-                                    output_dtx_info[next_measure][key] = ['00'] * next_measure_length
-                                
-                                output_dtx_info[next_measure][key][0] = output_dtx_info[measure][key][x]
-                                output_dtx_info[measure][key][x] = '00'
-                            else:
-                                print('Warning: note removed at last measure!')
-                        else:                            
-                            #Problem: Later values within 5 beat division will overwrite previous values
-                            #but it shouldn't happen because game never have notes so close to one another
-                            new_array[num_y] = output_dtx_info[measure][key][x]
-                            temp_new_object.append({
-                                'index': num_y,
-                                'value': new_array[num_y]
-                            })
-                #TODO: Further reduce out_length based on HCF or GCD
-                #Find GCD of all index in temp_new_object                
-                gcd = 0
-                len_new_object = len(temp_new_object)
-                for tIndex in range(0, len_new_object):
-                    gcd = math.gcd(gcd, temp_new_object[tIndex]['index'])                    
-                    if(tIndex == len_new_object - 1):
-                        gcd = math.gcd(gcd, out_length)
-                
-                #print('Measure:', measure, ' has GCD of' , gcd)
-                #Replace new_array with the reduced length
-                if(gcd > 0):
-                    new_array = ['00'] * (out_length // gcd)
-                    #Put the chip values back
-                    for tIndex in range(0, len_new_object):
-                        reducedIndex = temp_new_object[tIndex]['index'] // gcd
-                        new_array[reducedIndex] = temp_new_object[tIndex]['value']
-
-                #Overwrite with new reduced array 
-                output_dtx_info[measure][key] = new_array
+            if len(output_dtx_info[measure][key]) < 10:
+                continue
+
+            channel = output_dtx_info[measure][key]
+            in_length = len(channel)
+            out_length = in_length // 10
+            new_chips = {}
+
+            for x in channel.get_ticks():
+                #Round x to nearest integer after divide by 10
+                num_y = int(round(x/10.0))
+
+                #if num_y happens to be equal to out_length, move the note to the next measure at the zeroth position!
+                if num_y >= out_length:
+                    next_measure = measure + 1
+                    if next_measure < len(output_dtx_info):
+                        #Check if key exist
+                        if key not in output_dtx_info[next_measure]:
+                            #Get any bar length change member from next_measure if any
+                            next_measure_length = in_length
+                            if 2 in output_dtx_info[next_measure]:
+                                next_measure_length = int(float(output_dtx_info[next_measure][2][0]) * 1920)
+                            #Create new key for next measure
+                            output_dtx_info[next_measure][key] = DtxChannel(next_measure_length)
+
+                        output_dtx_info[next_measure][key][0] = channel[x]
+                    else:
+                        print('Warning: note removed at last measure!')
+                else:
+                    #Problem: Later values within 5 beat division will overwrite previous values
+                    #but it shouldn't happen because game never have notes so close to one another
+                    new_chips[num_y] = channel[x]
+
+            #Reduce out_length based on the GCD of all of the chip positions
+            gcd = 0
+            if new_chips:
+                for num_y in new_chips:
+                    gcd = math.gcd(gcd, num_y)
+
+                gcd = math.gcd(gcd, out_length)
+
+            #Overwrite with new reduced channel
+            if gcd > 0:
+                output_dtx_info[measure][key] = DtxChannel(out_length // gcd, {num_y // gcd: new_chips[num_y] for num_y in new_chips})
+            else:
+                output_dtx_info[measure][key] = DtxChannel(out_length, new_chips)
 
     return output_dtx_info
 
@@ -2572,16 +2559,15 @@ def generate_dtx_chart_from_json(metadata, orig_chart_data, sound_metadata, para
     #Hardcode movie sub-folder path here
     movie_sub_folder = "../movies/"
 
-    output = []
     if 'title' in orig_chart_data['header']:
-        output.append("#TITLE %s" % orig_chart_data['header']['title'])
+        yield "#TITLE %s" % orig_chart_data['header']['title']
     else:
-        output.append("#TITLE (no title)")
+        yield "#TITLE (no title)"
 
     if 'artist' in orig_chart_data['header']:
-        output.append("#ARTIST %s" % orig_chart_data['header']['artist'])
+        yield "#ARTIST %s" % orig_chart_data['header']['artist']
     else:
-        output.append("#ARTIST (no artist)")
+        yield "#ARTIST (no artist)"
 
     if 'level' in orig_chart_data['header']:
         for k in orig_chart_data['header']['level']:
@@ -2591,7 +2577,7 @@ def generate_dtx_chart_from_json(metadata, orig_chart_data, sound_metadata, para
                 "open": "GLEVEL",
                 "bass": "BLEVEL"
             }
-            output.append("#%s %s" % (level_map[k], orig_chart_data['header']['level'][k]))
+            yield "#%s %s" % (level_map[k], orig_chart_data['header']['level'][k])
 
     if 'level' in orig_chart_data['header']:
         has_drum = "drum" in orig_chart_data['header']['level']
@@ -2599,38 +2585,34 @@ def generate_dtx_chart_from_json(metadata, orig_chart_data, sound_metadata, para
         has_bass = "bass" in orig_chart_data['header']['level']
         has_open = "open" in orig_chart_data['header']['level']
         if has_drum:
-            output.append("#PREVIEW i%04ddm.wav" % orig_chart_data['header']['musicid'])
+            yield "#PREVIEW i%04ddm.wav" % orig_chart_data['header']['musicid']
         elif has_guitar or has_bass or has_open:
-            output.append("#PREVIEW i%04dgf.wav" % orig_chart_data['header']['musicid'])
+            yield "#PREVIEW i%04dgf.wav" % orig_chart_data['header']['musicid']
 
-    output.append("#PREIMAGE img_jk%04d.png" % orig_chart_data['header']['musicid'])
+    yield "#PREIMAGE img_jk%04d.png" % orig_chart_data['header']['musicid']
 
     if 'movie_filename' in orig_chart_data['header']:
-        output.append("#AVIZZ %s" % (movie_sub_folder + orig_chart_data['header']['movie_filename']))
+        yield "#AVIZZ %s" % (movie_sub_folder + orig_chart_data['header']['movie_filename'])
     else:
-        output.append("#AVIZZ mv%04d.avi" % orig_chart_data['header']['musicid'])
+        yield "#AVIZZ mv%04d.avi" % orig_chart_data['header']['musicid']
     
-    output.append("#BPM %s" % (bpms[0]))
+    yield "#BPM %s" % (bpms[0])
     for i in range(0, len(bpms)):
-        output.append("#BPM%s %s" % (base_repr(i+1, 36, padding=2).upper()[-2:], bpms[i]))
+        yield "#BPM%s %s" % (get_dtx_base36(i+1), bpms[i])
 
     for k in sorted(sound_files.keys()):
         wav_filename = "%04x.wav" % sound_files[k]
 
         if sound_metadata and 'entries' in sound_metadata:
-            for sound_entry in sound_metadata['entries']:
-                if sound_entry['sound_id'] != sound_files[k]:
-                    continue
-
+            sound_entry = sound_metadata.get_entry(sound_files[k])
+            if sound_entry:
                 if "NoFilename" not in sound_entry['flags']:
                     wav_filename = "%s.wav" % sound_entry['filename']
 
                 if sound_entry.get('clipped', False):
-                    wav_filename = "_override_clipped_%d_%s" % (sound_entry['sound_id'], wav_filename)
-
-                break
+                    wav_filename = sound_entry.get('clipped_filename', "_override_clipped_%d_%s" % (sound_entry['sound_id'], wav_filename))
 
-        output.append("#WAV%s %s" % (base_repr(int(k), 36, padding=2).upper()[-2:], wav_filename))
+        yield "#WAV%s %s" % (get_dtx_base36(int(k)), wav_filename)
 
     bgm_filename = "bgm.wav"
     if 'level' in orig_chart_data['header']:
@@ -2653,21 +2635,19 @@ def generate_dtx_chart_from_json(metadata, orig_chart_data, sound_metadata, para
         bgm_filename = "bgm%04d%s.wav" % (orig_chart_data['header']['musicid'],
                                           bgm_filename_part)
 
-    output.append("#WAVZZ %s" % bgm_filename)
+    yield "#WAVZZ %s" % bgm_filename
 
     for k in sorted(volumes.keys()):
-        output.append("#VOLUME%s %d" % (base_repr(int(k), 36, padding=2).upper()[-2:], volumes[k]))
+        yield "#VOLUME%s %d" % (get_dtx_base36(int(k)), volumes[k])
 
     for k in sorted(pans.keys()):
-        output.append("#PAN%s %d" % (base_repr(int(k), 36, padding=2).upper()[-2:], pans[k]))
-
-    output.append("#00001: ZZ")
-    output.append("#00054: ZZ")
-    for measure in sorted(dtx_info.keys(), key=lambda x: int(x)):
-        for key in sorted(dtx_info[measure].keys(), key=lambda x: int(x)):
-            output.append("#%03d%02X: %s" % (measure, key, "".join(dtx_info[measure][key])))
+        yield "#PAN%s %d" % (get_dtx_base36(int(k)), pans[k])
 
-    return "\n".join(output)
+    yield "#00001: ZZ"
+    yield "#00054: ZZ"
+    for measure in sorted(dtx_info.keys()):
+        for key in sorted(dtx_info[measure].keys()):
+            yield "#%03d%02X: %s" % (measure, key, "".join(dtx_info[measure][key]))
 
 
 def get_metadata_chart(charts):
@@ -2684,20 +2664,20 @@ def get_charts_data(charts, sound_metadata, params):
 
     return [{
         'chart': x,
-        'data': generate_dtx_chart_from_json(copy.deepcopy(chart_metadata), x, sound_metadata, params)
+        'data': generate_dtx_chart_from_json(chart_metadata, x, sound_metadata, params)
     } for x in charts if x['header']['is_metadata'] == 0]
 
 
 def create_dtx_from_json(params):
     dtx_data = params.get('input', None)
     sound_folder = params.get('sound_folder', None)
-    json_dtx = json.loads(dtx_data)
+    json_dtx = chartdata.get_chart_data(dtx_data)
 
     output_folder = params.get('output', None)
     if output_folder and not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    sound_metadata = params.get('sound_metadata', None)
+    sound_metadata = soundmetadata.get_sound_metadata(params.get('sound_metadata', None))
 
     charts_data = get_charts_data(json_dtx['charts'], sound_metadata, params)
     create_dtx_files(json_dtx, params, charts_data)
@@ -2731,8 +2711,23 @@ def create_dtx_files(json_dtx, params, charts_data):
         if output_folder:
             output_filename = os.path.join(output_folder, output_filename)
 
-        with open(output_filename, "w", encoding="shift-jis") as f:
-            f.write(x['data'])
+        # The chart is generated as it's written so the whole file is never held in memory.
+        # It's written under a temporary name first so an error part way through
+        # doesn't leave a truncated chart behind.
+        temp_filename = "%s.%d.tmp" % (output_filename, os.getpid())
+
+        try:
+            with open(temp_filename, "w", encoding="shift-jis") as f:
+                for idx, line in enumerate(x['data']):
+                    if idx > 0:
+                        f.write("\n")
+
+                    f.write(line)
+
+            os.replace(temp_filename, output_filename)
+        finally:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
 
 
 def create_set_definition_file(json_dtx, params, charts_data):
@@ -1,6 +1,8 @@
 import json
 import os
 
+import chartdata
+
 
 class JsonFormat:
     @staticmethod
@@ -31,8 +33,11 @@ class JsonFormat:
 
         #output_filename = params.get('output', "")
 
+        # Chart data is only serialized here when JSON is the output format
+        chart_data = chartdata.get_chart_data(params.get('input'))
+
         with open(output_filename, "w") as f:
-            f.write(params.get('input', ""))
+            f.write(chart_data.to_json() if chart_data is not None else "")
 
     @staticmethod
     def is_format(filename):
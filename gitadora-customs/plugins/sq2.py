@@ -8,6 +8,7 @@ from lxml import etree
 from lxml.builder import E
 import uuid
 
+import chartdata
 import helper
 import mdb
 import eamxml
@@ -15,6 +16,8 @@ import audio
 import vas3tool
 import wavbintool
 import tmpfile
+import tempomap
+import soundmetadata
 
 import plugins.wav as wav
 
@@ -262,49 +265,13 @@ def correct_auto_notes(chart):
 
 def generate_beats_for_events(chart):
     beats_by_timestamp = generate_beats_by_timestamp(chart)
+    tempo_map = tempomap.get_tempo_map(chart, beats_by_timestamp)
 
-    # Set base beat for every event at timestamp
-    last_timestamp = 0
-    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart['timestamp'][timestamp_key]:
-            name = beat['name']
-            timestamp = int(timestamp_key)
-
-            if timestamp in beats_by_timestamp:
-                last_timestamp = timestamp
-                break
-
-        for beat in chart['timestamp'][timestamp_key]:
-            name = beat['name']
-            beat['beat'] = beats_by_timestamp[last_timestamp]
-
-    last_timestamp = 0
-    cur_bpm = 0
-    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart['timestamp'][timestamp_key]:
-            name = beat['name']
-            timestamp = int(timestamp_key)
-
-            if timestamp in beats_by_timestamp:
-                last_timestamp = timestamp
-                break
+    for timestamp_key in chart['timestamp']:
+        timestamp = int(timestamp_key)
 
         for beat in chart['timestamp'][timestamp_key]:
-            if beat['name'] == "bpm":
-                cur_bpm = beat['data']['bpm']
-                break
-
-        for beat in chart['timestamp'][timestamp_key]:
-            name = beat['name']
-            timestamp = int(timestamp_key)
-
-            keys = list(sorted(beats_by_timestamp.keys(), key=lambda x: int(x))) + [0]
-            next_timestamp = keys[keys.index(last_timestamp) + 1]
-            if timestamp not in beats_by_timestamp:
-                diff = int(timestamp_key) - last_timestamp
-                tf = ((diff / 300) * (cur_bpm / 60)) * (1920 // beat['time_signature']['denominator'])
-
-                beat['beat'] = beat['beat'] + int(tf)
+            beat['beat'] = tempomap.get_beat_at_timestamp(tempo_map, timestamp, beat['time_signature']['denominator'])
 
     return chart
 
@@ -401,37 +368,47 @@ def create_preview(json_sq2, params, part):
     return running_threads
 
 
-def create_bgm_render(json_sq2, params, target_parts, output_bgm_filename):
-    def _create_bgm_render(params_bgm, target_parts, output_bgm_filename):
-        wav.generate_wav_from_json(params_bgm, generate_output_filename=False)
-        wavbintool.parse_wav(params_bgm['output'], output_bgm_filename)
+def create_bgm_renders(json_sq2, params, bgm_renders):
+    # bgm_renders is a list of (target_parts, output_bgm_filename).
+    # All of the renders are mixed together so each keysound is only decoded once.
+    def _create_bgm_renders(params_bgm, renders, output_bgm_filenames):
+        wav.generate_wav_stems_from_json(params_bgm, renders)
+
+        for (_, _, render_filename), output_bgm_filename in zip(renders, output_bgm_filenames):
+            wavbintool.parse_wav(render_filename, output_bgm_filename)
 
-    print("Creating BGM render", target_parts)
+    print("Creating BGM renders", [x[0] for x in bgm_renders])
 
-    params_bgm = copy.deepcopy(params)
+    # The chart data is only read by the renders so it's shared instead of copied
+    params_bgm = copy.deepcopy({k: params[k] for k in params if k != 'input'})
+    params_bgm['input'] = params.get('input')
     params_bgm['render_ext'] = "wav"
-    params_bgm['output'] = tmpfile.mkstemp(suffix="." + params_bgm.get('render_ext', 'wav'))
+    params_bgm['difficulty'] = ['max']
 
-    if os.path.exists(params_bgm['output']):
-        os.unlink(params_bgm['output'])
+    renders = []
+    output_bgm_filenames = []
+    for target_parts, output_bgm_filename in bgm_renders:
+        render_filename = tmpfile.mkstemp(suffix="." + params_bgm.get('render_ext', 'wav'))
 
-    if 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts:
-        params_bgm['render_ignore_auto'] = True
+        if os.path.exists(render_filename):
+            os.unlink(render_filename)
 
-    params_bgm['parts'] = target_parts
-    params_bgm['difficulty'] = ['max']
+        # Guitar and bass renders always leave out auto notes, the others follow the user's setting
+        ignore_auto = params_bgm.get('render_ignore_auto', False) or 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts
+        renders.append((target_parts, ignore_auto, render_filename))
+        output_bgm_filenames.append(output_bgm_filename)
 
     running_threads = []
 
     if USE_THREADS:
-        bgm_thread = threading.Thread(target=_create_bgm_render,
+        bgm_thread = threading.Thread(target=_create_bgm_renders,
                                       args=(params_bgm,
-                                            target_parts,
-                                            output_bgm_filename))
+                                            renders,
+                                            output_bgm_filenames))
         bgm_thread.start()
         running_threads.append(bgm_thread)
     else:
-        _create_bgm_render(params_bgm, target_parts, output_bgm_filename)
+        _create_bgm_renders(params_bgm, renders, output_bgm_filenames)
 
     return running_threads
 
@@ -817,14 +794,18 @@ def create_sound_files(json_sq2, params, target_parts):
             output_bgm_filename = os.path.join(output_folder, 'bgm%04d___k.bin' % (json_sq2['musicid']))
             running_threads += create_bgm(json_sq2, params, output_bgm_filename)
 
+            bgm_renders = []
+
             if 'guitar' in target_parts or 'bass' in target_parts:
-                running_threads += create_bgm_render(json_sq2, params, ['bass'], os.path.join(output_folder, 'bgm%04d__bk.bin' % (json_sq2['musicid'])))
-                running_threads += create_bgm_render(json_sq2, params, ['guitar', 'bass', 'open'], os.path.join(output_folder, 'bgm%04d_gbk.bin' % (json_sq2['musicid'])))
+                bgm_renders.append((['bass'], os.path.join(output_folder, 'bgm%04d__bk.bin' % (json_sq2['musicid']))))
+                bgm_renders.append((['guitar', 'bass', 'open'], os.path.join(output_folder, 'bgm%04d_gbk.bin' % (json_sq2['musicid']))))
 
             if 'drum' in target_parts:
-                running_threads += create_bgm_render(json_sq2, params, ['drum'], os.path.join(output_folder, 'bgm%04dd__k.bin' % (json_sq2['musicid'])))
+                bgm_renders.append((['drum'], os.path.join(output_folder, 'bgm%04dd__k.bin' % (json_sq2['musicid']))))
 
-            running_threads += create_bgm_render(json_sq2, params, ['drum', 'bass'], os.path.join(output_folder, 'bgm%04dd_bk.bin' % (json_sq2['musicid'])))
+            bgm_renders.append((['drum', 'bass'], os.path.join(output_folder, 'bgm%04dd_bk.bin' % (json_sq2['musicid']))))
+
+            running_threads += create_bgm_renders(json_sq2, params, bgm_renders)
 
         else:
             if 'drum' in target_parts:
@@ -869,7 +850,7 @@ def create_sound_files(json_sq2, params, target_parts):
 
 
 def generate_sq2_file_from_json(params):
-    json_sq2 = json.loads(params['input']) if 'input' in params else None
+    json_sq2 = chartdata.get_chart_data(params.get('input'))
 
     if not json_sq2:
         print("Couldn't find input data")
@@ -1357,18 +1338,17 @@ def combine_guitar_charts(guitar_charts, bass_charts):
 
 
 def add_note_durations(chart, sound_metadata):
-    duration_lookup = {}
+    sound_metadata = soundmetadata.get_sound_metadata(sound_metadata)
 
     if not sound_metadata or 'entries' not in sound_metadata:
         return chart
 
-    for entry in sound_metadata['entries']:
-        duration_lookup[entry['sound_id']] = entry.get('duration', 0)
-
     for k in chart['timestamp']:
         for i in range(0, len(chart['timestamp'][k])):
             if chart['timestamp'][k][i]['name'] in ['note', 'auto']:
-                chart['timestamp'][k][i]['data']['note_length'] = int(round(duration_lookup.get(chart['timestamp'][k][i]['data']['sound_id'], 0) * 300))
+                sound_entry = sound_metadata.get_entry(chart['timestamp'][k][i]['data']['sound_id'])
+                duration = sound_entry.get('duration', 0) if sound_entry else 0
+                chart['timestamp'][k][i]['data']['note_length'] = int(round(duration * 300))
 
     return chart
 
@@ -1398,6 +1378,11 @@ def generate_json_from_sq2(params):
         raw_charts.append(chart_data)
         data_offset += data_size
 
+    # Skip charts that weren't selected using the header before parsing the events
+    headers = [chart[0x14:0x18] for chart in raw_charts]
+    difficulties = helper.get_part_difficulties(params, [(game_type, difficulty) for _, is_metadata, difficulty, game_type in headers if is_metadata == 0])
+    raw_charts = [chart for chart, (_, is_metadata, difficulty, game_type) in zip(raw_charts, headers) if is_metadata != 0 or helper.is_chart_selected(params, game_type, difficulty, difficulties)]
+
     output_data['musicid'] = musicid
     output_data['format'] = Sq2Format.get_format_name()
 
@@ -1429,7 +1414,7 @@ def generate_json_from_sq2(params):
 
     output_data['charts'] = charts
 
-    return json.dumps(output_data, indent=4, sort_keys=True)
+    return chartdata.get_chart_data(output_data)
 
 
 class Sq2Format:
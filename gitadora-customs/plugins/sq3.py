@@ -1,5 +1,6 @@
 import copy
 import json
+import numpy
 import os
 import shutil
 import struct
@@ -8,6 +9,7 @@ from lxml import etree
 from lxml.builder import E
 import uuid
 
+import chartdata
 import helper
 import mdb
 import eamxml
@@ -15,6 +17,7 @@ import audio
 import vas3tool
 import wavbintool
 import tmpfile
+import tempomap
 
 import plugins.wav as wav
 
@@ -37,6 +40,15 @@ EVENT_ID_MAP = {
 
 EVENT_ID_REVERSE = {EVENT_ID_MAP[k]: k for k in EVENT_ID_MAP}
 
+# Layout of a 0x40 byte event block. Some fields overlap because their
+# meaning depends on the event ID
+EVENT_DTYPE = numpy.dtype({
+    'names': ['timestamp', 'id', 'hold_duration', 'beat', 'unk', 'sound_id', 'note_length', 'volume', 'auto_volume', 'note', 'wail_misc', 'guitar_special', 'auto_note', 'denominator', 'bpm_mpm'],
+    'formats': ['<u4', 'u1', '<u4', '<u4', '<u4', '<u4', '<u4', 'u1', 'u1', 'u1', 'u1', 'u1', 'u1', 'u1', '<u4'],
+    'offsets': [0x00, 0x04, 0x08, 0x10, 0x14, 0x20, 0x24, 0x2d, 0x2e, 0x30, 0x31, 0x32, 0x34, 0x35, 0x34],
+    'itemsize': 0x40,
+})
+
 drum_note_map = {
     0x00: "Hi-hat (left Blue)",
     0x01: "Snare (yellow)",
@@ -337,49 +349,13 @@ def generate_beats_by_timestamp(chart):
 
 def generate_beats_for_events(chart):
     beats_by_timestamp = generate_beats_by_timestamp(chart)
+    tempo_map = tempomap.get_tempo_map(chart, beats_by_timestamp)
 
-    # Set base beat for every event at timestamp
-    last_timestamp = 0
-    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart['timestamp'][timestamp_key]:
-            name = beat['name']
-            timestamp = int(timestamp_key)
-
-            if timestamp in beats_by_timestamp:
-                last_timestamp = timestamp
-                break
+    for timestamp_key in chart['timestamp']:
+        timestamp = int(timestamp_key)
 
         for beat in chart['timestamp'][timestamp_key]:
-            name = beat['name']
-            beat['beat'] = beats_by_timestamp[last_timestamp]
-
-    last_timestamp = 0
-    cur_bpm = 0
-    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart['timestamp'][timestamp_key]:
-            name = beat['name']
-            timestamp = int(timestamp_key)
-
-            if timestamp in beats_by_timestamp:
-                last_timestamp = timestamp
-                break
-
-        for beat in chart['timestamp'][timestamp_key]:
-            if beat['name'] == "bpm":
-                cur_bpm = beat['data']['bpm']
-                break
-
-        for beat in chart['timestamp'][timestamp_key]:
-            name = beat['name']
-            timestamp = int(timestamp_key)
-
-            keys = list(sorted(beats_by_timestamp.keys(), key=lambda x: int(x))) + [0]
-            next_timestamp = keys[keys.index(last_timestamp) + 1]
-            if timestamp not in beats_by_timestamp:
-                diff = int(timestamp_key) - last_timestamp
-                tf = ((diff / 300) * (cur_bpm / 60)) * (1920 // beat['time_signature']['denominator'])
-
-                beat['beat'] = beat['beat'] + int(tf)
+            beat['beat'] = tempomap.get_beat_at_timestamp(tempo_map, timestamp, beat['time_signature']['denominator'])
 
     return chart
 
@@ -475,37 +451,47 @@ def create_preview(json_sq3, params, part):
     return running_threads
 
 
-def create_bgm_render(json_sq3, params, target_parts, output_bgm_filename):
-    def _create_bgm_render(params_bgm, target_parts, output_bgm_filename):
-        wav.generate_wav_from_json(params_bgm, generate_output_filename=False)
-        wavbintool.parse_wav(params_bgm['output'], output_bgm_filename)
+def create_bgm_renders(json_sq3, params, bgm_renders):
+    # bgm_renders is a list of (target_parts, output_bgm_filename).
+    # All of the renders are mixed together so each keysound is only decoded once.
+    def _create_bgm_renders(params_bgm, renders, output_bgm_filenames):
+        wav.generate_wav_stems_from_json(params_bgm, renders)
+
+        for (_, _, render_filename), output_bgm_filename in zip(renders, output_bgm_filenames):
+            wavbintool.parse_wav(render_filename, output_bgm_filename)
 
-    print("Creating BGM render", target_parts)
+    print("Creating BGM renders", [x[0] for x in bgm_renders])
 
-    params_bgm = copy.deepcopy(params)
+    # The chart data is only read by the renders so it's shared instead of copied
+    params_bgm = copy.deepcopy({k: params[k] for k in params if k != 'input'})
+    params_bgm['input'] = params.get('input')
     params_bgm['render_ext'] = "wav"
-    params_bgm['output'] = tmpfile.mkstemp(suffix="." + params_bgm.get('render_ext', 'wav'))
+    params_bgm['difficulty'] = ['max']
 
-    if os.path.exists(params_bgm['output']):
-        os.unlink(params_bgm['output'])
+    renders = []
+    output_bgm_filenames = []
+    for target_parts, output_bgm_filename in bgm_renders:
+        render_filename = tmpfile.mkstemp(suffix="." + params_bgm.get('render_ext', 'wav'))
 
-    if 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts:
-        params_bgm['render_ignore_auto'] = True
+        if os.path.exists(render_filename):
+            os.unlink(render_filename)
 
-    params_bgm['parts'] = target_parts
-    params_bgm['difficulty'] = ['max']
+        # Guitar and bass renders always leave out auto notes, the others follow the user's setting
+        ignore_auto = params_bgm.get('render_ignore_auto', False) or 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts
+        renders.append((target_parts, ignore_auto, render_filename))
+        output_bgm_filenames.append(output_bgm_filename)
 
     running_threads = []
 
     if USE_THREADS:
-        bgm_thread = threading.Thread(target=_create_bgm_render,
+        bgm_thread = threading.Thread(target=_create_bgm_renders,
                                       args=(params_bgm,
-                                            target_parts,
-                                            output_bgm_filename))
+                                            renders,
+                                            output_bgm_filenames))
         bgm_thread.start()
         running_threads.append(bgm_thread)
     else:
-        _create_bgm_render(params_bgm, target_parts, output_bgm_filename)
+        _create_bgm_renders(params_bgm, renders, output_bgm_filenames)
 
     return running_threads
 
@@ -847,27 +833,26 @@ def create_sq3_file(json_sq3, params, target_parts, charts_data):
     # Create actual SQ3 data
     archive_size = 0x20 + (0x10 * len(charts_data)) + sum([len(x['data']) for x in charts_data])
 
-    output_data = [0] * 0x20
+    output_data = bytearray(archive_size)
     output_data[0x00:0x04] = b'SEQP'
     output_data[0x04] = 0x01
     output_data[0x06] = 0x01
     output_data[0x0a] = 0x03
-    output_data[0x0c:0x10] = struct.pack("<I", archive_size)
-    output_data[0x10:0x14] = struct.pack("<I", 0x20)  # Size of header
-    output_data[0x14:0x18] = struct.pack("<I", json_sq3['musicid'])
-    output_data[0x18:0x1c] = struct.pack("<I", len(charts_data))
-    output_data[0x1c:0x20] = struct.pack("<I", 0x12345678)
+    struct.pack_into("<I", output_data, 0x0c, archive_size)
+    struct.pack_into("<I", output_data, 0x10, 0x20)  # Size of header
+    struct.pack_into("<I", output_data, 0x14, json_sq3['musicid'])
+    struct.pack_into("<I", output_data, 0x18, len(charts_data))
+    struct.pack_into("<I", output_data, 0x1c, 0x12345678)
 
-    output_data = bytearray(output_data)
+    offset = 0x20
     for chart_data in charts_data:
         data = chart_data['data']
 
-        file_header = [0] * 0x10
-        file_header[0x00:0x04] = struct.pack("<I", len(data) + 0x10)
-        file_header[0x04] = 0x10
+        struct.pack_into("<I", output_data, offset, len(data) + 0x10)
+        output_data[offset + 0x04] = 0x10
 
-        output_data += bytearray(file_header)
-        output_data += data
+        output_data[offset + 0x10:offset + 0x10 + len(data)] = data
+        offset += 0x10 + len(data)
 
     if 'drum' in target_parts:
         output_filename = 'd%04d.sq3' % (json_sq3['musicid'])
@@ -895,14 +880,18 @@ def create_sound_files(json_sq3, params, target_parts):
         running_threads += create_bgm(json_sq3, params, output_bgm_filename)
 
         if params.get('generate_bgms', False):
+            bgm_renders = []
+
             if 'guitar' in target_parts or 'bass' in target_parts:
-                running_threads += create_bgm_render(json_sq3, params, ['bass'], os.path.join(output_folder, 'bgm%04d__bk.bin' % (json_sq3['musicid'])))
-                running_threads += create_bgm_render(json_sq3, params, ['guitar', 'bass', 'open'], os.path.join(output_folder, 'bgm%04d_gbk.bin' % (json_sq3['musicid'])))
+                bgm_renders.append((['bass'], os.path.join(output_folder, 'bgm%04d__bk.bin' % (json_sq3['musicid']))))
+                bgm_renders.append((['guitar', 'bass', 'open'], os.path.join(output_folder, 'bgm%04d_gbk.bin' % (json_sq3['musicid']))))
 
             if 'drum' in target_parts:
-                running_threads += create_bgm_render(json_sq3, params, ['drum'], os.path.join(output_folder, 'bgm%04dd__k.bin' % (json_sq3['musicid'])))
+                bgm_renders.append((['drum'], os.path.join(output_folder, 'bgm%04dd__k.bin' % (json_sq3['musicid']))))
 
-            running_threads += create_bgm_render(json_sq3, params, ['drum', 'bass'], os.path.join(output_folder, 'bgm%04dd_bk.bin' % (json_sq3['musicid'])))
+            bgm_renders.append((['drum', 'bass'], os.path.join(output_folder, 'bgm%04dd_bk.bin' % (json_sq3['musicid']))))
+
+            running_threads += create_bgm_renders(json_sq3, params, bgm_renders)
 
         if 'drum' in target_parts:
             running_threads += create_va3(json_sq3, params, 'drum')
@@ -942,7 +931,7 @@ def create_sound_files(json_sq3, params, target_parts):
 
 
 def generate_sq3_file_from_json(params):
-    json_sq3 = json.loads(params['input']) if 'input' in params else None
+    json_sq3 = chartdata.get_chart_data(params.get('input'))
 
     if not json_sq3:
         print("Couldn't find input data")
@@ -1038,37 +1027,37 @@ def get_end_timestamp(chart):
 def generate_sq3_chart_data_from_json(chart):
     metadata = True if chart['header']['is_metadata'] == 1 else False
 
-    event_data = []
+    events = []
     found_events = []
 
     start_timestamp = int(get_start_timestamp(chart))
     end_timestamp = int(get_end_timestamp(chart))
 
+    chart_events = [
+        "chipstart",
+        "chipend",
+        "startpos",
+        "endpos",
+        "note"
+    ]
+
+    metadata_events = [
+        "bpm",
+        "barinfo",
+        "baron",
+        "baroff",
+        "measure",
+        "beat",
+        "startpos",
+        "endpos"
+    ]
+
     # Handle events based on beat offset in ascending order
     for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
         if int(timestamp_key) < start_timestamp or int(timestamp_key) > end_timestamp:
             continue
 
         for beat in chart['timestamp'][timestamp_key]:
-            chart_events = [
-                "chipstart",
-                "chipend",
-                "startpos",
-                "endpos",
-                "note"
-            ]
-
-            metadata_events = [
-                "bpm",
-                "barinfo",
-                "baron",
-                "baroff",
-                "measure",
-                "beat",
-                "startpos",
-                "endpos"
-            ]
-
             if not metadata and beat['name'] not in chart_events:
                 continue
 
@@ -1080,94 +1069,92 @@ def generate_sq3_chart_data_from_json(chart):
                 continue
 
             found_events.append(EVENT_ID_REVERSE[beat['name']])
+            events.append((int(timestamp_key), beat))
 
-            mdata = [0] * 0x40  # Use proper section size here
-
-            mdata[0x00:0x04] = struct.pack("<I", int(timestamp_key))
-            mdata[0x04] = EVENT_ID_REVERSE[beat['name']] & 0xff
-            mdata[0x10:0x14] = struct.pack("<I", beat['beat'])
-
-            if beat['name'] == "bpm":
-                mdata[0x34:0x38] = struct.pack("<I", int(round(60000000 / beat['data']['bpm'])))
-            elif beat['name'] == "barinfo":
-                mdata[0x34] = beat['data']['numerator'] & 0xff
-
-                denominator = 1 << (beat['data']['denominator'].bit_length() - 1)
-                if denominator != beat['data']['denominator']:
-                    raise Exception("ERROR: The time signature denominator must be divisible by 2."
-                                    "Found {}".format(beat['data']['denominator']))
-
-                mdata[0x35] = (beat['data']['denominator'].bit_length() - 1) & 0xff
-            elif beat['name'] == "chipstart":
-                if 'unk' in beat['data']:
-                    mdata[0x14:0x18] = struct.pack("<I", beat['data']['unk'])
-            elif beat['name'] == "note":
-                if beat['data']['note'] not in REVERSE_NOTE_MAPPING:
-                    # Set all unknown events to auto play
-                    REVERSE_NOTE_MAPPING[beat['data']['note']] = 0xff
-
-                if 'hold_duration' in beat['data']:
-                    mdata[0x08:0x0c] = struct.pack("<I", beat['data']['hold_duration'])
-
-                if 'unk' in beat['data']:
-                    mdata[0x14:0x18] = struct.pack("<I", beat['data']['unk'])
-                else:
-                    mdata[0x14:0x18] = struct.pack("<I", 0x16c)
-
-                if 'sound_id' in beat['data']:
-                    mdata[0x20:0x24] = struct.pack("<I", beat['data']['sound_id'])
+    # Everything is written into one buffer that's sized up front
+    output_data = bytearray(0x20 + 0x40 * len(events))
 
-                if chart['header']['game_type'] != 0:
-                    if 'note_length' in beat['data']:
-                        mdata[0x24:0x28] = struct.pack("<I", beat['data']['note_length'])
-                    else:
-                        mdata[0x24:0x28] = struct.pack("<I", 0x40)
-
-                if 'volume' in beat['data']:
-                    mdata[0x2d] = beat['data']['volume'] & 0xff
-
-                if 'auto_volume' in beat['data']:
-                    mdata[0x2e] = beat['data']['auto_volume'] & 0xff
-
-                if 'note' in beat['data']:
-                    mdata[0x30] = REVERSE_NOTE_MAPPING[beat['data']['note']] & 0xff
-
-                if 'wail_misc' in beat['data']:
-                    mdata[0x31] = beat['data']['wail_misc'] & 0xff
-
-                if 'guitar_special' in beat['data']:
-                    mdata[0x32] = beat['data']['guitar_special'] & 0xff
-
-                if 'auto_note' in beat['data']:
-                    mdata[0x34] = beat['data']['auto_note'] & 0xff
-
-                if beat['data'].get('note') == "auto":
-                    mdata[0x34] = 1  # Auto note
-                    mdata[0x2e] = 1  # Auto volume
-
-            event_data.append(bytearray(mdata))
-
-    output_data = [0] * 0x20
     output_data[0x00:0x04] = b'SQ3T'
     output_data[0x06] = 0x03  # SQ3 flag
     output_data[0x0a] = 0x03  # SQ3 flag 2?
-    output_data[0x0c:0x10] = struct.pack("<I", 0x20)  # Size of header
-    output_data[0x10:0x14] = struct.pack("<I", len(event_data))  # Number of events
+    struct.pack_into("<I", output_data, 0x0c, 0x20)  # Size of header
+    struct.pack_into("<I", output_data, 0x10, len(events))  # Number of events
     output_data[0x14] = chart['header']['unk_sys'] & 0xff
     output_data[0x15] = chart['header']['is_metadata'] & 0xff
     output_data[0x16] = chart['header']['difficulty'] & 0xff
     output_data[0x17] = chart['header']['game_type'] & 0xff
-    output_data[0x18:0x1a] = struct.pack("<H", chart['header']['time_division'])
-    output_data[0x1a:0x1c] = struct.pack("<H", chart['header']['beat_division'])
-    output_data[0x1c:0x20] = struct.pack("<I", 0x40)  # Size of each entry
+    struct.pack_into("<H", output_data, 0x18, chart['header']['time_division'])
+    struct.pack_into("<H", output_data, 0x1a, chart['header']['beat_division'])
+    struct.pack_into("<I", output_data, 0x1c, 0x40)  # Size of each entry
 
     if metadata:
         output_data[0x15] = 0x01
         output_data[0x16] = 0x01
 
-    output_data = bytearray(output_data)
-    for data in event_data:
-        output_data += data
+    for idx, (timestamp, beat) in enumerate(events):
+        offset = 0x20 + 0x40 * idx  # Use proper section size here
+
+        struct.pack_into("<I", output_data, offset, timestamp)
+        output_data[offset + 0x04] = EVENT_ID_REVERSE[beat['name']] & 0xff
+        struct.pack_into("<I", output_data, offset + 0x10, beat['beat'])
+
+        if beat['name'] == "bpm":
+            struct.pack_into("<I", output_data, offset + 0x34, int(round(60000000 / beat['data']['bpm'])))
+        elif beat['name'] == "barinfo":
+            output_data[offset + 0x34] = beat['data']['numerator'] & 0xff
+
+            denominator = 1 << (beat['data']['denominator'].bit_length() - 1)
+            if denominator != beat['data']['denominator']:
+                raise Exception("ERROR: The time signature denominator must be divisible by 2."
+                                "Found {}".format(beat['data']['denominator']))
+
+            output_data[offset + 0x35] = (beat['data']['denominator'].bit_length() - 1) & 0xff
+        elif beat['name'] == "chipstart":
+            if 'unk' in beat['data']:
+                struct.pack_into("<I", output_data, offset + 0x14, beat['data']['unk'])
+        elif beat['name'] == "note":
+            if beat['data']['note'] not in REVERSE_NOTE_MAPPING:
+                # Set all unknown events to auto play
+                REVERSE_NOTE_MAPPING[beat['data']['note']] = 0xff
+
+            if 'hold_duration' in beat['data']:
+                struct.pack_into("<I", output_data, offset + 0x08, beat['data']['hold_duration'])
+
+            if 'unk' in beat['data']:
+                struct.pack_into("<I", output_data, offset + 0x14, beat['data']['unk'])
+            else:
+                struct.pack_into("<I", output_data, offset + 0x14, 0x16c)
+
+            if 'sound_id' in beat['data']:
+                struct.pack_into("<I", output_data, offset + 0x20, beat['data']['sound_id'])
+
+            if chart['header']['game_type'] != 0:
+                if 'note_length' in beat['data']:
+                    struct.pack_into("<I", output_data, offset + 0x24, beat['data']['note_length'])
+                else:
+                    struct.pack_into("<I", output_data, offset + 0x24, 0x40)
+
+            if 'volume' in beat['data']:
+                output_data[offset + 0x2d] = beat['data']['volume'] & 0xff
+
+            if 'auto_volume' in beat['data']:
+                output_data[offset + 0x2e] = beat['data']['auto_volume'] & 0xff
+
+            if 'note' in beat['data']:
+                output_data[offset + 0x30] = REVERSE_NOTE_MAPPING[beat['data']['note']] & 0xff
+
+            if 'wail_misc' in beat['data']:
+                output_data[offset + 0x31] = beat['data']['wail_misc'] & 0xff
+
+            if 'guitar_special' in beat['data']:
+                output_data[offset + 0x32] = beat['data']['guitar_special'] & 0xff
+
+            if 'auto_note' in beat['data']:
+                output_data[offset + 0x34] = beat['data']['auto_note'] & 0xff
+
+            if beat['data'].get('note') == "auto":
+                output_data[offset + 0x34] = 1  # Auto note
+                output_data[offset + 0x2e] = 1  # Auto volume
 
     return output_data
 
@@ -1239,6 +1226,85 @@ def parse_event_block(mdata, game, difficulty, events={}):
     }
 
 
+def parse_event_blocks(data, offset, entry_count, entry_size, game, difficulty, events={}):
+    # Same output as calling parse_event_block on every block, but all of the
+    # fields are decoded at once from a structured view of the event table
+    if entry_size != EVENT_DTYPE.itemsize:
+        return [parse_event_block(data[offset + (i * entry_size):offset + (i * entry_size) + entry_size], game, difficulty, events) for i in range(entry_count)]
+
+    blocks = numpy.frombuffer(data, dtype=EVENT_DTYPE, count=entry_count, offset=offset)
+    game_type_id = {"drum": 0, "guitar": 1, "bass": 2, "open": 3}[game]
+
+    ids = blocks['id']
+    is_note = ids == 0x10
+
+    # Note names are only looked up for note events, the same as parse_event_block
+    note_names = [None] * entry_count
+    for i, note in zip(numpy.nonzero(is_note)[0].tolist(), blocks['note'][is_note].tolist()):
+        note_names[i] = NOTE_MAPPING[game][note]
+
+    is_bpm = ids == 0x01
+    bpm_mpm = blocks['bpm_mpm'][is_bpm]
+    if numpy.any(bpm_mpm == 0):
+        raise ZeroDivisionError("BPM event with a tempo of 0")
+
+    bpms = [None] * entry_count
+    for i, bpm in zip(numpy.nonzero(is_bpm)[0].tolist(), (60000000 / bpm_mpm.astype(numpy.float64)).tolist()):
+        bpms[i] = bpm
+
+    columns = {k: blocks[k].tolist() for k in EVENT_DTYPE.names if k != 'bpm_mpm'}
+    ids = columns['id']
+
+    output = []
+    for i in range(entry_count):
+        event_id = ids[i]
+        beat = columns['beat'][i]
+        packet_data = {}
+
+        if event_id == 0x01:
+            packet_data['bpm'] = bpms[i]
+        elif event_id == 0x02:
+            # Time signature is represented as numerator/(1<<denominator)
+            packet_data['numerator'] = columns['auto_note'][i]
+            packet_data['denominator'] = 1 << columns['denominator'][i]
+            packet_data['denominator_orig'] = columns['denominator'][i]
+        elif event_id == 0x07:
+            packet_data['unk'] = columns['unk'][i]
+        elif event_id == 0x10:
+            packet_data['hold_duration'] = columns['hold_duration'][i]
+            packet_data['unk'] = columns['unk'][i]
+            packet_data['sound_id'] = columns['sound_id'][i]
+            packet_data['note_length'] = columns['note_length'][i]
+            packet_data['volume'] = columns['volume'][i]
+            packet_data['auto_volume'] = columns['auto_volume'][i]
+            packet_data['note'] = note_names[i]
+            packet_data['wail_misc'] = columns['wail_misc'][i]
+            packet_data['guitar_special'] = columns['guitar_special'][i]
+            packet_data['auto_note'] = columns['auto_note'][i]
+
+            if packet_data['auto_note'] == 1:
+                packet_data['note'] = "auto"
+
+            if beat in events:
+                for event in events[beat]:
+                    is_gametype = event['game_type'] == game_type_id
+                    is_eventtype = event['event_type'] == 0
+                    is_note = packet_data['sound_id'] == event['note']
+
+                    if is_gametype and is_eventtype and is_note:
+                        packet_data['bonus_note'] = True
+
+        output.append({
+            "id": event_id,
+            "name": EVENT_ID_MAP[event_id],
+            'timestamp': columns['timestamp'][i],
+            'beat': beat,
+            "data": packet_data
+        })
+
+    return output
+
+
 def read_sq3_data(data, events):
     output = {
         "beat_data": []
@@ -1270,11 +1336,8 @@ def read_sq3_data(data, events):
         "beat_division": beat_division,
     }
 
-    for i in range(entry_count):
-        mdata = data[header_size + (i * entry_size):header_size + (i * entry_size) + entry_size]
-        part = ["drum", "guitar", "bass"][game_type]
-        parsed_data = parse_event_block(mdata, part, difficulty, events)
-        output['beat_data'].append(parsed_data)
+    part = ["drum", "guitar", "bass"][game_type]
+    output['beat_data'] = parse_event_blocks(data, header_size, entry_count, entry_size, part, difficulty, events)
 
     return output
 
@@ -1472,6 +1535,11 @@ def generate_json_from_sq3(params):
         raw_charts.append(chart_data)
         data_offset += data_size
 
+    # Skip charts that weren't selected using the header before parsing the events
+    headers = [chart[0x14:0x18] for chart in raw_charts]
+    difficulties = helper.get_part_difficulties(params, [(game_type, difficulty) for _, is_metadata, difficulty, game_type in headers if is_metadata == 0])
+    raw_charts = [chart for chart, (_, is_metadata, difficulty, game_type) in zip(raw_charts, headers) if is_metadata != 0 or helper.is_chart_selected(params, game_type, difficulty, difficulties)]
+
     output_data['musicid'] = musicid
     output_data['format'] = Sq3Format.get_format_name()
 
@@ -1498,7 +1566,7 @@ def generate_json_from_sq3(params):
 
     output_data['charts'] = charts
 
-    return json.dumps(output_data, indent=4, sort_keys=True)
+    return chartdata.get_chart_data(output_data)
 
 
 class Sq3Format:
@@ -1,19 +1,42 @@
 import glob
+import hashlib
 import json
 import math
+import multiprocessing
+import numpy
 import pydub
 import os
 import re
+import shutil
 import string
+import subprocess
+import wave
 
 import tmpfile
 import audio
 import wavbintool
 import helper
+import chartdata
+import soundmetadata
 
 import imageio
 imageio.plugins.ffmpeg.download()
 
+# Songs shorter than this many seconds are always mixed in a single process
+PARALLEL_RENDER_MIN_DURATION = 30
+
+# Length in seconds of each block written out while streaming a render
+STREAM_WINDOW_DURATION = 5
+
+# State shared with the mixing worker processes, see init_mix_worker
+mix_worker_state = {}
+
+
+# Decoded keysounds by (filename, mtime, size, rate) and merged BGMs by BGM hash,
+# kept between preview renders so repeated previews of a song are fast
+preview_keysound_cache = {}
+preview_bgm_cache = {}
+
 
 def percentage_to_db(percentage):
     if percentage == 0:
@@ -22,15 +45,19 @@ def percentage_to_db(percentage):
     return 20 * math.log10(percentage / 100)
 
 
+def get_chart_duration(chart_data):
+    # Find last timestamp
+    last_timestamp = int(sorted(chart_data['timestamp'].keys(), key=lambda x: int(x))[-1])
+
+    # TODO: Find a better way to calculate the ending of the audio
+    # Convert last timestamp into a duration and add 2 seconds in
+    # case the final notes ring out for long
+    return ((last_timestamp) / 0x12c) + 2
+
+
 def get_base_audio(input_foldername, bgm_filename, chart_data, no_bgm):
     if no_bgm:
-        # Find last timestamp
-        last_timestamp = int(sorted(chart_data['timestamp'].keys(), key=lambda x: int(x))[-1])
-
-        # TODO: Find a better way to calculate the ending of the audio
-        # Convert last timestamp into a duration and add 2 seconds in
-        # case the final notes ring out for long
-        duration = ((last_timestamp) / 0x12c) + 2
+        duration = get_chart_duration(chart_data)
 
         # Create silent audio file
         output_audio = pydub.AudioSegment.silent(duration=duration * 1000)
@@ -55,31 +82,249 @@ def find_sound_filename(path):
     return path
 
 
-def create_wav_from_chart(chart_data,
-                          input_foldername,
-                          sound_metadata,
-                          output_filename,
-                          bgm_filename="bgm.wav",
-                          tags=None,
-                          no_bgm=False,
-                          ext="mp3",
-                          quality="320k",
-                          volume_part=100,
-                          volume_bgm=100,
-                          volume_auto=100,
-                          ignore_auto=False):
+def get_pan_gains(pan):
+    # Same curve as pydub's pan effect: the boosted side gets at most +3dB
+    # and the other side fades out completely at either extreme
+    pan = min(max(pan, -1.0), 1.0)
+    boost_factor = 2.0 ** abs(pan)
+    reduce_factor = 2.0 - boost_factor
+    boost_factor = math.sqrt(boost_factor)
 
-    output_audio = get_base_audio(input_foldername, bgm_filename, chart_data, no_bgm)
-    output_audio = make_silent(output_audio)
+    if pan < 0:
+        return boost_factor, reduce_factor
+
+    return reduce_factor, boost_factor
+
+
+def get_keysound_samples(keysound, rate):
+    keysound = keysound.set_sample_width(2).set_frame_rate(rate)
+    samples = numpy.frombuffer(keysound.raw_data, dtype=numpy.int16)
+    return samples.reshape(-1, keysound.channels).astype(numpy.float32)
+
+
+def get_timestamp_frame(timestamp, rate):
+    # Converts a timestamp to a frame the same way pydub's overlay did with
+    # the position in milliseconds so notes land on the same frames as before
+    return int((timestamp / 0x12c * 1000) * (rate / 1000.0))
+
+
+def mix_notes(notes, keysounds, rate, start_frame, end_frame):
+    # Accumulate every note into one buffer instead of overlaying the
+    # full-length segment once per note.
+    # Only the frames in [start_frame, end_frame) are mixed, including the
+    # tails of notes that started before the window. Note positions are
+    # always calculated from the start of the song so windows can be
+    # joined back together without any drift.
+    output = numpy.zeros((end_frame - start_frame, 2), dtype=numpy.float32)
+
+    for timestamp, wav_filename, gains in notes:
+        position = get_timestamp_frame(timestamp, rate)
+        samples = keysounds[wav_filename]
+
+        if position >= end_frame or position + len(samples) <= start_frame:
+            continue
+
+        offset = max(start_frame - position, 0)
+        samples = samples[offset:end_frame - position]
+        output_position = position + offset - start_frame
+        output[output_position:output_position + len(samples)] += samples * gains
+
+    return output
+
+
+def init_mix_worker(stems, keysounds, rate):
+    mix_worker_state['stems'] = stems
+    mix_worker_state['keysounds'] = keysounds
+    mix_worker_state['rate'] = rate
+
+
+def mix_window_worker(stem_key, start_frame, end_frame):
+    return mix_notes(mix_worker_state['stems'][stem_key],
+                     mix_worker_state['keysounds'],
+                     mix_worker_state['rate'],
+                     start_frame,
+                     end_frame)
+
+
+def get_render_windows(frame_count, rate, processes):
+    if processes <= 1 or frame_count < PARALLEL_RENDER_MIN_DURATION * rate:
+        return [(0, frame_count)]
+
+    window_frames = -(-frame_count // processes)
+    return [(start, min(start + window_frames, frame_count)) for start in range(0, frame_count, window_frames)]
+
+
+def get_render_processes(params):
+    # Mix in this process unless more processes were asked for
+    return params.get('render_processes') or 1
+
+
+def get_render_pool(processes, initargs):
+    # The workers are spawned rather than forked because renders usually run
+    # in a worker thread (seqtool's process_file, the SQ2/SQ3 BGM renders)
+    # and forking a process with other threads running isn't safe
+    return multiprocessing.get_context("spawn").Pool(processes, initializer=init_mix_worker, initargs=initargs)
+
+
+def samples_to_pcm(samples):
+    return numpy.clip(numpy.round(samples), -32768, 32767).astype(numpy.int16)
+
+
+def samples_to_audio(samples, rate):
+    samples = samples_to_pcm(samples)
+    return pydub.AudioSegment(data=samples.tobytes(), sample_width=2, frame_rate=rate, channels=samples.shape[1])
+
+
+def stream_mix(notes, keysounds, rate, frame_count, processes=1):
+    # Yields the mix one window at a time so the whole song never has to be
+    # held in memory. notes must be sorted by timestamp.
+    window_frames = int(STREAM_WINDOW_DURATION * rate)
+    windows = [(start_frame, min(start_frame + window_frames, frame_count)) for start_frame in range(0, frame_count, window_frames)]
+
+    if processes <= 1 or frame_count < PARALLEL_RENDER_MIN_DURATION * rate:
+        active_notes = []
+        note_idx = 0
+
+        for start_frame, end_frame in windows:
+            while note_idx < len(notes) and get_timestamp_frame(notes[note_idx][0], rate) < end_frame:
+                active_notes.append(notes[note_idx])
+                note_idx += 1
+
+            # Drop notes that have finished ringing out before this window
+            active_notes = [x for x in active_notes if get_timestamp_frame(x[0], rate) + len(keysounds[x[1]]) > start_frame]
+
+            yield mix_notes(active_notes, keysounds, rate, start_frame, end_frame)
+
+        return
+
+    # Only mix as many windows ahead as there are processes so a slow
+    # encoder can't make finished windows pile up in memory
+    with get_render_pool(processes, ({'render': notes}, keysounds, rate)) as pool:
+        for idx in range(0, len(windows), processes):
+            tasks = [('render', start_frame, end_frame) for start_frame, end_frame in windows[idx:idx + processes]]
+
+            for mixed in pool.starmap(mix_window_worker, tasks):
+                yield mixed
+
+
+def open_bgm_wave(bgm_filename, rate=0):
+    # Returns a wave reader for the BGM, converting it to 16-bit PCM first if required.
+    # A BGM with a lower sample rate than rate is resampled up to it, as
+    # pydub's overlay did when the keysounds used a higher rate.
+    try:
+        bgm = wave.open(bgm_filename, "rb")
+
+        if bgm.getsampwidth() == 2 and bgm.getnchannels() <= 2 and bgm.getframerate() >= rate:
+            return bgm
+
+        bgm.close()
+    except (wave.Error, EOFError):
+        pass
+
+    bgm_audio = audio.get_audio_file(bgm_filename).set_sample_width(2)
+    if bgm_audio.frame_rate < rate:
+        bgm_audio = bgm_audio.set_frame_rate(rate)
+
+    converted_filename = tmpfile.mkstemp(suffix=".wav")
+    bgm_audio.export(converted_filename, format="wav")
 
-    if volume_bgm != 100:
-        volume_bgm_db = percentage_to_db(volume_bgm)
-        if not volume_bgm_db:
-            output_audio = make_silent(output_audio)
-        elif volume_bgm_db != 0:
-            output_audio += volume_bgm_db
+    return wave.open(converted_filename, "rb")
 
-    sound_files = {}
+
+class RenderSink:
+    # Writes 16-bit stereo PCM as it is rendered, either straight into a WAV
+    # file or through an ffmpeg pipe for any other format
+
+    def __init__(self, output_filename, ext="mp3", quality="320k", rate=48000):
+        self.output_filename = output_filename
+        self.wave = None
+        self.process = None
+
+        if ext == "wav":
+            self.wave = wave.open(output_filename, "wb")
+            self.wave.setnchannels(2)
+            self.wave.setsampwidth(2)
+            self.wave.setframerate(rate)
+        else:
+            cmd = [pydub.AudioSegment.converter, "-y",
+                   "-f", "s16le", "-ar", str(rate), "-ac", "2", "-i", "-",
+                   "-b:a", quality]
+
+            # Same default codec pydub uses
+            if ext == "ogg":
+                cmd += ["-acodec", "libvorbis"]
+
+            cmd += ["-f", ext, output_filename]
+
+            self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def write(self, samples):
+        data = samples_to_pcm(samples).tobytes()
+
+        if self.wave:
+            self.wave.writeframes(data)
+        else:
+            self.process.stdin.write(data)
+
+    def close(self):
+        if self.wave:
+            self.wave.close()
+        else:
+            self.process.stdin.close()
+
+            if self.process.wait() != 0:
+                raise Exception("Couldn't encode %s" % self.output_filename)
+
+
+def render_notes(notes, keysounds, output_filename, bgm_filename=None, duration=None, ext="mp3", quality="320k", processes=1, volume_bgm=100):
+    # Streams the mix of notes over the BGM into output_filename.
+    # The mix uses the highest sample rate of the BGM and the keysounds, as
+    # pydub's overlay would, and lasts as long as the BGM or duration seconds.
+    rate = max([keysound.frame_rate for keysound in keysounds.values()] + [0])
+    bgm = open_bgm_wave(bgm_filename, rate) if bgm_filename else None
+
+    if bgm:
+        rate = bgm.getframerate()
+        frame_count = bgm.getnframes()
+    else:
+        rate = rate or 48000
+        frame_count = int(duration * rate)
+
+    # keysounds is left as it is so the same decoded keysounds can be used for several renders
+    keysound_samples = {wav_filename: get_keysound_samples(keysounds[wav_filename], rate) for wav_filename in set([x[1] for x in notes])}
+
+    sink = RenderSink(output_filename, ext, quality, rate)
+
+    try:
+        for mixed in stream_mix(notes, keysound_samples, rate, frame_count, processes):
+            if bgm:
+                bgm_samples = numpy.frombuffer(bgm.readframes(len(mixed)), dtype=numpy.int16)
+                bgm_samples = bgm_samples.reshape(-1, bgm.getnchannels())
+                mixed[:len(bgm_samples)] += bgm_samples * numpy.float32(volume_bgm / 100)
+
+            sink.write(mixed)
+    finally:
+        sink.close()
+
+        if bgm:
+            bgm.close()
+
+
+def get_chart_notes(chart_data,
+                    input_foldername,
+                    sound_metadata,
+                    keysound_files,
+                    volume_part=100,
+                    volume_auto=100,
+                    ignore_auto=False):
+    # Returns a list of (timestamp, wav filename, gains) for every playable note.
+    # keysound_files is filled with every referenced file and whether it
+    # exists so it can be shared between several charts. The files are only
+    # decoded later by load_keysounds.
+    sound_metadata = soundmetadata.get_sound_metadata(sound_metadata)
+
+    notes = []
+    keysound_gains = {}
 
     for timestamp_key in sorted(chart_data['timestamp'].keys(), key=lambda x: int(x)):
         for cd in chart_data['timestamp'][timestamp_key]:
@@ -89,74 +334,208 @@ def create_wav_from_chart(chart_data,
             if ignore_auto and (cd['data'].get('auto_volume', 0) != 0 or cd['data'].get('auto_note', 0) != 0):
                 continue
 
-            if 'volume' not in cd['data']:
-                cd['data']['volume'] = 127
+            note_volume = cd['data'].get('volume', 127)
 
             is_auto = cd['data'].get('auto_volume') == 1 and cd['data'].get('auto_note') != 0
             if is_auto:
                 # Change 2/3 later if other games use different ratios
-                cd['data']['volume'] = int(round(cd['data']['volume'] * (2/3)))
+                note_volume = int(round(note_volume * (2/3)))
 
-            if 'pan' not in cd['data']:
-                cd['data']['pan'] = 64
+            note_pan = cd['data'].get('pan', 64)
 
             volume = 127  # 100% volume
             pan = 64  # Center
             wav_filename = "%04x.wav" % int(cd['data']['sound_id'])
 
             sound_key = "%04d_%03d_%03d" % (cd['data']['sound_id'],
-                                            cd['data']['volume'],
-                                            cd['data']['pan'])
+                                            note_volume,
+                                            note_pan)
 
             if sound_metadata and 'entries' in sound_metadata:
-                for sound_entry in sound_metadata['entries']:
-                    if int(sound_entry['sound_id']) == int(cd['data']['sound_id']):
-                        volume = sound_entry.get('volume', volume)
-                        pan = sound_entry.get('pan', pan)
-
-                        if 'flags' not in sound_entry or "NoFilename" not in sound_entry['flags']:
-                            wav_filename = sound_entry['filename']
+                sound_entry = sound_metadata.get_entry(cd['data']['sound_id'])
+                if sound_entry:
+                    volume = sound_entry.get('volume', volume)
+                    pan = sound_entry.get('pan', pan)
 
-                        break
+                    if 'flags' not in sound_entry or "NoFilename" not in sound_entry['flags']:
+                        wav_filename = sound_entry['filename']
 
-            if sound_key not in sound_files:
-                if cd['data'].get('volume'):
-                    volume = (cd['data']['volume'] / 127) * (volume / 127) * 127
+            if sound_key not in keysound_gains:
+                if note_volume:
+                    volume = (note_volume / 127) * (volume / 127) * 127
 
-                if cd['data'].get('pan'):
-                    pan = (cd['data']['pan'] - ((128 - pan) / 2)) / (128 / 2)
+                if note_pan:
+                    pan = (note_pan - ((128 - pan) / 2)) / (128 / 2)
                 else:
                     pan = (pan - (128 / 2)) / (128 / 2)
 
                 wav_filename = find_sound_filename(helper.getCaseInsensitivePath(os.path.join(input_foldername, wav_filename)))
-                if os.path.exists(wav_filename):
-                    keysound = audio.get_audio_file(wav_filename)
-                    keysound = keysound.pan(pan)
-                    db = percentage_to_db((volume / 127) * 100)
-                    keysound += db
-
-                    if is_auto:
-                        volume_key = volume_auto
-                    else:
-                        volume_key = volume_part
-
-                    if volume_key != 100:
-                        volume_db = percentage_to_db(volume_key)
-                        if not volume_db:
-                            keysound = make_silent(keysound)
-                        elif volume_db != 0:
-                            keysound += volume_db
-
-                    sound_files[sound_key] = keysound
+                if wav_filename not in keysound_files:
+                    keysound_files[wav_filename] = os.path.exists(wav_filename)
+
+                    if not keysound_files[wav_filename]:
+                        print("Couldn't find file: %s" % wav_filename)
+
+                if is_auto:
+                    volume_key = volume_auto
                 else:
-                    print("Couldn't find file: %s" % wav_filename)
+                    volume_key = volume_part
 
-            if sound_key in sound_files:
-                position = int(timestamp_key) / 0x12c
-                #print("Overlaying sound at %f" % position)
-                output_audio = output_audio.overlay(sound_files[sound_key], position=position * 1000)
+                gain = (volume / 127) * (volume_key / 100)
+                left_gain, right_gain = get_pan_gains(pan)
+                keysound_gains[sound_key] = (wav_filename, numpy.array([left_gain * gain, right_gain * gain], dtype=numpy.float32))
 
-    return output_audio
+            wav_filename, gains = keysound_gains[sound_key]
+            if keysound_files[wav_filename]:
+                notes.append((int(timestamp_key), wav_filename, gains))
+
+    return notes
+
+
+def load_keysounds(keysound_files):
+    return {wav_filename: audio.get_audio_file(wav_filename) for wav_filename in keysound_files if keysound_files[wav_filename]}
+
+
+def mix_stems(stems, keysounds, duration, processes=1, base_rate=0):
+    # Mixes each list of notes in stems into its own buffer of the given
+    # duration in seconds. Every keysound is only converted once no matter
+    # how many stems use it. base_rate is the sample rate of the audio the
+    # mixes will be laid over.
+    # Long songs are split into one window per process and each window is
+    # mixed in a separate worker process.
+    if not keysounds:
+        return None, None
+
+    # Mix at the highest sample rate used by the keysounds and the base audio, as pydub's overlay would
+    rate = max([keysound.frame_rate for keysound in keysounds.values()] + [base_rate])
+    frame_count = int(duration * rate)
+
+    for wav_filename in keysounds:
+        keysounds[wav_filename] = get_keysound_samples(keysounds[wav_filename], rate)
+
+    windows = get_render_windows(frame_count, rate, processes)
+
+    mixes = {}
+    if len(windows) == 1:
+        for stem_key in stems:
+            mixes[stem_key] = mix_notes(stems[stem_key], keysounds, rate, 0, frame_count)
+
+        return mixes, rate
+
+    stem_keys = list(stems.keys())
+    tasks = [(stem_key, start_frame, end_frame) for stem_key in stem_keys for start_frame, end_frame in windows]
+
+    with get_render_pool(processes, (stems, keysounds, rate)) as pool:
+        results = pool.starmap(mix_window_worker, tasks)
+
+    for idx, stem_key in enumerate(stem_keys):
+        mixes[stem_key] = numpy.concatenate(results[idx * len(windows):(idx + 1) * len(windows)])
+
+    return mixes, rate
+
+
+def create_wav_from_chart(chart_data,
+                          input_foldername,
+                          sound_metadata,
+                          output_filename,
+                          bgm_filename="bgm.wav",
+                          tags=None,
+                          no_bgm=False,
+                          ext="mp3",
+                          quality="320k",
+                          volume_part=100,
+                          volume_bgm=100,
+                          volume_auto=100,
+                          ignore_auto=False,
+                          processes=1):
+
+    # Only the chart is returned. The BGM is just used for the length of the
+    # render, so volume_bgm is applied by whatever lays the result over it.
+    output_audio = get_base_audio(input_foldername, bgm_filename, chart_data, no_bgm)
+
+    keysound_files = {}
+    notes = get_chart_notes(chart_data,
+                            input_foldername,
+                            sound_metadata,
+                            keysound_files,
+                            volume_part=volume_part,
+                            volume_auto=volume_auto,
+                            ignore_auto=ignore_auto)
+
+    mixes, rate = mix_stems({'chart': notes}, load_keysounds(keysound_files), output_audio.duration_seconds, processes, output_audio.frame_rate)
+
+    if not mixes:
+        return make_silent(output_audio)
+
+    return samples_to_audio(mixes['chart'], rate)
+
+
+def get_bgm_hash(json_data, chart_data, input_foldername):
+    # Identify the BGM by its source files so it doesn't need to be merged
+    # just to check the render cache
+    if 'bgm' in json_data:
+        return {
+            'end': json_data['bgm'].get('end'),
+            'data': [[bgm['timestamp'], audio.get_file_hash(helper.getCaseInsensitivePath(os.path.join(input_foldername, bgm['filename'])))] for bgm in json_data['bgm']['data']],
+        }
+
+    bgm_filename = helper.getCaseInsensitivePath(os.path.join(input_foldername, get_bgm_filename(json_data, chart_data, input_foldername)))
+    return audio.get_file_hash(bgm_filename) if os.path.exists(bgm_filename) else None
+
+
+def get_render_cache_filename(params, notes, keysound_files, bgm_hash, duration):
+    # Renders are cached by the notes being played (which already include
+    # the final gains), the contents of every file used and the render settings
+    render_cache = params.get('render_cache')
+
+    if not render_cache:
+        return None
+
+    ext = params.get('render_ext', "mp3")
+    file_hashes = {wav_filename: audio.get_file_hash(wav_filename) for wav_filename in keysound_files if keysound_files[wav_filename]}
+
+    # Settings use the same defaults as the renderers so an unset option and
+    # its default value share a cache entry
+    cache_key = {
+        'notes': [[timestamp, file_hashes[wav_filename], [float(x) for x in gains]] for timestamp, wav_filename, gains in notes],
+        'bgm': bgm_hash,
+        'duration': duration,
+        'ext': ext,
+        'quality': params.get('render_quality', '320k'),
+        'volume': params.get('render_volume', 100),
+        'volume_bgm': params.get('render_volume_bgm', 100),
+        'volume_auto': params.get('render_volume_auto', 100),
+        'ignore_auto': bool(params.get('render_ignore_auto', False)),
+        'no_bgm': bool(params.get('render_no_bgm', False)),
+        'parts': sorted(params.get('parts') or []),
+        'difficulty': sorted(params.get('difficulty') or []),
+    }
+
+    cache_hash = hashlib.sha1(json.dumps(cache_key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    return os.path.join(render_cache, "%s.%s" % (cache_hash, ext))
+
+
+def get_cached_render(cache_filename, output_filename):
+    if not cache_filename or not os.path.exists(cache_filename):
+        return False
+
+    print("Using cached render %s" % cache_filename)
+    shutil.copy(cache_filename, output_filename)
+
+    return True
+
+
+def add_cached_render(cache_filename, output_filename):
+    if not cache_filename or not os.path.exists(output_filename):
+        return
+
+    os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+
+    # Copy under a temporary name first so a partially written file is never used
+    temp_filename = "%s.%d.tmp" % (cache_filename, os.getpid())
+    shutil.copy(output_filename, temp_filename)
+    os.replace(temp_filename, cache_filename)
 
 
 def get_selected_difficulty(json_data, params):
@@ -296,14 +675,27 @@ def generate_wav_from_json(params, generate_output_filename=True):
     if not input_json:
         raise Exception("Couldn't find input data")
 
-    json_data = json.loads(input_json)
+    if params.get('render_measures'):
+        # Only the requested section of the song is rendered
+        start_measure, end_measure = params['render_measures']
+        output_audio = render_preview(params, start_measure=start_measure, end_measure=end_measure)
+
+        if output_audio:
+            print("Saving to %s..." % params['output'])
+            output_audio.export(params['output'], format=params['render_ext'], bitrate=params.get('render_quality', '320k'))
+
+        return
+
+    json_data = chartdata.get_chart_data(input_json)
     selected_difficulty = get_selected_difficulty(json_data, params)
 
     if not selected_difficulty:
         raise Exception("Couldn't find selected difficulty")
 
-    bgms = []
-    bgm_filename = None
+    keysound_files = {}
+    notes = []
+    duration = None
+    bgm_chart = None
     for chart_data in json_data['charts']:
         # Skip metadata charts and stuff not specified by the user
         if chart_data['header']['is_metadata'] != 0:
@@ -321,10 +713,11 @@ def generate_wav_from_json(params, generate_output_filename=True):
         else:
             output_filename = params['output']
 
-        tags = get_tags(json_data, chart_data)
+        if not bgm_chart:
+            bgm_chart = chart_data
 
-        if not bgm_filename:
-            bgm_filename = get_bgm_filename(json_data, chart_data, input_foldername)
+        if duration is None:
+            duration = get_chart_duration(chart_data)
 
         sound_metadata_type = ['drum', 'guitar', 'guitar'][chart_data['header']['game_type']]
         json_sound_metadata = get_sound_metadata(params, json_data, input_foldername, sound_metadata_type)
@@ -333,39 +726,313 @@ def generate_wav_from_json(params, generate_output_filename=True):
 
         print("Exporting %s..." % output_filename)
 
-        bgms.append(create_wav_from_chart(chart_data,
-                              input_foldername,
-                              json_sound_metadata,
-                              output_filename,
-                              bgm_filename,
-                              tags=tags,
-                              no_bgm=params.get('render_no_bgm', False),
-                              ext=params.get('render_ext', "mp3"),
-                              quality=params.get('render_quality', '320k'),
-                              volume_part=params.get('render_volume', 100),
-                              volume_bgm=params.get('render_volume_bgm', 100),
-                              volume_auto=params.get('render_volume_auto', 100),
-                              ignore_auto=params.get('render_ignore_auto', False)))
-
-
-    if not bgm_filename:
+        notes += get_chart_notes(chart_data,
+                                 input_foldername,
+                                 json_sound_metadata,
+                                 keysound_files,
+                                 volume_part=params.get('render_volume', 100),
+                                 volume_auto=params.get('render_volume_auto', 100),
+                                 ignore_auto=params.get('render_ignore_auto', False))
+
+    if not bgm_chart:
+        return
+
+    notes.sort(key=lambda x: x[0])
+
+    if params.get('render_no_bgm', False):
+        bgm_hash = None
+    else:
+        bgm_hash = get_bgm_hash(json_data, bgm_chart, input_foldername)
+
+    cache_filename = get_render_cache_filename(params, notes, keysound_files, bgm_hash, duration)
+    if get_cached_render(cache_filename, params['output']):
         return
 
     print("Saving to %s..." % output_filename)
 
+    if params.get('render_no_bgm', False):
+        bgm_filename = None
+    else:
+        bgm_filename = get_bgm_filename(json_data, bgm_chart, input_foldername)
+        bgm_filename = helper.getCaseInsensitivePath(os.path.join(input_foldername, bgm_filename))
+
+    render_notes(notes,
+                 load_keysounds(keysound_files),
+                 params['output'],
+                 bgm_filename=bgm_filename,
+                 duration=duration,
+                 ext=params.get('render_ext', "mp3"),
+                 quality=params.get('render_quality', '320k'),
+                 processes=get_render_processes(params),
+                 volume_bgm=params.get('render_volume_bgm', 100))
+
+    add_cached_render(cache_filename, params['output'])
+
+
+def generate_wav_stems_from_json(params, renders):
+    # Renders several part combinations of the selected difficulty over the
+    # BGM. renders is a list of (target_parts, ignore_auto, output_filename).
+    # Each chart is turned into a stem once per ignore_auto setting and every
+    # keysound is decoded once. The renders are then streamed out one at a
+    # time so only one of them is being mixed at once.
+    input_json = params.get('input')
+    input_foldername = params.get('sound_folder')
+
+    if not input_json:
+        raise Exception("Couldn't find input data")
+
+    json_data = chartdata.get_chart_data(input_json)
+    selected_difficulty = get_selected_difficulty(json_data, params)
+
+    if not selected_difficulty:
+        raise Exception("Couldn't find selected difficulty")
+
+    charts = [x for x in json_data['charts'] if x['header']['is_metadata'] == 0 and x['header']['difficulty'] == selected_difficulty]
+
+    bgm_chart = None
+    keysound_files = {}
+    stems = {}
+    render_stems = []
+    for target_parts, ignore_auto, output_filename in renders:
+        stem_keys = []
+
+        for idx, chart_data in enumerate(charts):
+            game_type = ['drum', 'guitar', 'bass'][chart_data['header']['game_type']]
+            if game_type not in target_parts:
+                continue
+
+            if not bgm_chart:
+                bgm_chart = chart_data
+
+            stem_key = (idx, ignore_auto)
+            stem_keys.append(stem_key)
+
+            if stem_key in stems:
+                continue
+
+            sound_metadata_type = ['drum', 'guitar', 'guitar'][chart_data['header']['game_type']]
+            json_sound_metadata = get_sound_metadata(params, json_data, input_foldername, sound_metadata_type)
+            if not json_sound_metadata:
+                raise Exception("Couldn't find sound metadata")
+
+            stems[stem_key] = get_chart_notes(chart_data,
+                                              input_foldername,
+                                              json_sound_metadata,
+                                              keysound_files,
+                                              volume_part=params.get('render_volume', 100),
+                                              volume_auto=params.get('render_volume_auto', 100),
+                                              ignore_auto=ignore_auto)
+
+        render_stems.append(stem_keys)
+
+    if not bgm_chart:
+        return
+
+    # The same extension is used for the cache and the exported files
+    ext = params.get('render_ext') or "wav"
+
+    # Without a BGM the length of the render comes from the chart instead
+    if params.get('render_no_bgm', False):
+        bgm_hash = None
+        duration = get_chart_duration(bgm_chart)
+    else:
+        bgm_hash = get_bgm_hash(json_data, bgm_chart, input_foldername)
+        duration = None
+
+    # Skip any renders that are already cached
+    pending_renders = []
+    for (target_parts, ignore_auto, output_filename), stem_keys in zip(renders, render_stems):
+        render_params = dict(params, parts=target_parts, render_ignore_auto=ignore_auto, render_ext=ext)
+        notes = sorted([note for stem_key in stem_keys for note in stems[stem_key]], key=lambda x: x[0])
+        cache_filename = get_render_cache_filename(render_params, notes, keysound_files, bgm_hash, duration)
+
+        if not get_cached_render(cache_filename, output_filename):
+            pending_renders.append((output_filename, notes, cache_filename))
+
+    if not pending_renders:
+        return
+
+    if params.get('render_no_bgm', False):
+        bgm_filename = None
+    else:
+        bgm_filename = get_bgm_filename(json_data, bgm_chart, input_foldername)
+        bgm_filename = helper.getCaseInsensitivePath(os.path.join(input_foldername, bgm_filename))
+
+    keysounds = load_keysounds(keysound_files)
+
+    for output_filename, notes, cache_filename in pending_renders:
+        print("Saving to %s..." % output_filename)
+
+        render_notes(notes,
+                     keysounds,
+                     output_filename,
+                     bgm_filename=bgm_filename,
+                     duration=duration,
+                     ext=ext,
+                     quality=params.get('render_quality', '320k'),
+                     processes=get_render_processes(params),
+                     volume_bgm=params.get('render_volume_bgm', 100))
+
+        add_cached_render(cache_filename, output_filename)
+
+
+def get_measure_timestamps(json_data):
+    # Timestamps of every measure line, taken from the metadata chart when
+    # it has them and any other chart otherwise
+    measure_timestamps = {0: [], 1: []}
+
+    for chart_data in json_data['charts']:
+        is_metadata = 1 if chart_data['header']['is_metadata'] != 0 else 0
+
+        for timestamp_key in chart_data['timestamp']:
+            if any([x['name'] == "measure" for x in chart_data['timestamp'][timestamp_key]]):
+                measure_timestamps[is_metadata].append(int(timestamp_key))
+
+    return sorted(set(measure_timestamps[1] or measure_timestamps[0]))
+
+
+def get_wav_rate(wav_filename):
+    try:
+        with wave.open(wav_filename, "rb") as f:
+            return f.getframerate()
+    except (wave.Error, EOFError):
+        return audio.get_audio_file(wav_filename).frame_rate
+
+
+def get_preview_keysound_samples(wav_filename, rate):
+    stat = os.stat(wav_filename)
+    key = (wav_filename, stat.st_mtime, stat.st_size, rate)
+
+    if key not in preview_keysound_cache:
+        preview_keysound_cache[key] = get_keysound_samples(audio.get_audio_file(wav_filename), rate)
+
+    return preview_keysound_cache[key]
+
+
+def get_preview_bgm_samples(bgm_filename, rate=0):
+    # The BGM is decoded through audio's PCM cache so a compressed BGM is only
+    # converted once no matter how many sections of the song are previewed.
+    # A BGM with a lower sample rate than rate is resampled up to it.
+    samples = audio.get_decoded_samples(bgm_filename)
+    data = samples['data']
+
+    if samples['sample_width'] != 2 or samples['rate'] < rate:
+        data = pydub.AudioSegment(data=data,
+                                  sample_width=samples['sample_width'],
+                                  frame_rate=samples['rate'],
+                                  channels=samples['channels']).set_sample_width(2).set_frame_rate(max(samples['rate'], rate)).raw_data
+
+    return numpy.frombuffer(data, dtype=numpy.int16).reshape(-1, samples['channels']), max(samples['rate'], rate)
+
+
+def get_preview_bgm_filename(json_data, chart_data, input_foldername):
+    bgm_key = json.dumps(get_bgm_hash(json_data, chart_data, input_foldername), sort_keys=True)
+
+    if bgm_key not in preview_bgm_cache or not os.path.exists(preview_bgm_cache[bgm_key]):
+        bgm_filename = get_bgm_filename(json_data, chart_data, input_foldername)
+        preview_bgm_cache[bgm_key] = helper.getCaseInsensitivePath(os.path.join(input_foldername, bgm_filename))
+
+    return preview_bgm_cache[bgm_key]
+
+
+def render_preview(params, start_timestamp=None, end_timestamp=None, start_measure=None, end_measure=None):
+    # Renders only a section of the selected charts and returns it as an AudioSegment.
+    # The section is either given in timestamps (1/300th of a second) or as an
+    # inclusive range of measures, counting the first measure line as measure 0.
+    # Notes that started before the section but still ring into it are included.
+    input_json = params.get('input')
+    input_foldername = params.get('sound_folder')
+
+    if not input_json:
+        raise Exception("Couldn't find input data")
+
+    json_data = chartdata.get_chart_data(input_json)
+    selected_difficulty = get_selected_difficulty(json_data, params)
+
+    if not selected_difficulty:
+        raise Exception("Couldn't find selected difficulty")
+
+    if start_measure is not None or end_measure is not None:
+        measure_timestamps = get_measure_timestamps(json_data)
+
+        if not measure_timestamps:
+            raise Exception("Couldn't find any measures")
+
+        if start_measure is not None:
+            start_timestamp = measure_timestamps[min(start_measure, len(measure_timestamps) - 1)]
+
+        if end_measure is not None and end_measure + 1 < len(measure_timestamps):
+            end_timestamp = measure_timestamps[end_measure + 1]
+
+    keysound_files = {}
+    notes = []
+    duration = None
+    bgm_chart = None
+    for chart_data in json_data['charts']:
+        if chart_data['header']['is_metadata'] != 0:
+            continue
+
+        if chart_data['header']['difficulty'] != selected_difficulty:
+            continue
+
+        game_type = ['drum', 'guitar', 'bass'][chart_data['header']['game_type']]
+        if game_type not in params['parts']:
+            continue
+
+        if not bgm_chart:
+            bgm_chart = chart_data
+
+        if duration is None:
+            duration = get_chart_duration(chart_data)
+
+        sound_metadata_type = ['drum', 'guitar', 'guitar'][chart_data['header']['game_type']]
+        json_sound_metadata = get_sound_metadata(params, json_data, input_foldername, sound_metadata_type)
+        if not json_sound_metadata:
+            raise Exception("Couldn't find sound metadata")
+
+        notes += get_chart_notes(chart_data,
+                                 input_foldername,
+                                 json_sound_metadata,
+                                 keysound_files,
+                                 volume_part=params.get('render_volume', 100),
+                                 volume_auto=params.get('render_volume_auto', 100),
+                                 ignore_auto=params.get('render_ignore_auto', False))
+
+    if not bgm_chart:
+        return None
+
+    if start_timestamp is None:
+        start_timestamp = 0
+
+    if end_timestamp is None:
+        end_timestamp = int(duration * 0x12c)
+
+    # Nothing after the end of the section can be heard in it
+    notes = [x for x in notes if x[0] < end_timestamp]
+
+    # Mix at the highest sample rate of the BGM and the keysounds, as pydub's overlay would
+    rate = max([get_wav_rate(wav_filename) for wav_filename in set([x[1] for x in notes])] + [0])
+
+    bgm_samples = None
     if not params.get('render_no_bgm', False):
-        output_audio = audio.get_audio_file(bgm_filename)
+        bgm_samples, rate = get_preview_bgm_samples(get_preview_bgm_filename(json_data, bgm_chart, input_foldername), rate)
     else:
-        if len(bgms) == 0:
-            return
+        rate = rate or 48000
+
+    keysounds = {}
+    for wav_filename in set([x[1] for x in notes]):
+        keysounds[wav_filename] = get_preview_keysound_samples(wav_filename, rate)
+
+    start_frame = get_timestamp_frame(start_timestamp, rate)
+    end_frame = max(get_timestamp_frame(end_timestamp, rate), start_frame)
+    mixed = mix_notes(notes, keysounds, rate, start_frame, end_frame)
 
-        output_audio = bgms[0]
-        bgms = bgms[1:]
+    if bgm_samples is not None:
+        bgm_samples = bgm_samples[start_frame:end_frame]
+        mixed[:len(bgm_samples)] += bgm_samples * numpy.float32(params.get('render_volume_bgm', 100) / 100)
 
-    for bgm in bgms:
-        output_audio = output_audio.overlay(bgm)
+    return samples_to_audio(mixed, rate)
 
-    output_audio.export(params['output'], format=params.get('render_ext', "mp3"), tags={}, bitrate=params.get('render_quality', '320k'))
 
 class WavFormat:
     @staticmethod
@@ -8,10 +8,13 @@ import shutil
 import sys
 import threading
 
+import helper
 import tmpfile
 
 import wavbintool
 import vas3tool
+import soundmetadata
+import chartdata
 import ifs
 import eamxml
 import event
@@ -33,47 +36,16 @@ def find_handler(input_filename, input_format):
 
 
 def filter_charts(json_data, params):
-    json_data = json.loads(json_data)
+    json_data = chartdata.get_chart_data(json_data)
 
-    if 'charts' not in json_data:
+    if not json_data or 'charts' not in json_data:
         return json_data
 
-    min_diff = None
-    max_diff = None
-    for chart in json_data['charts']:
-        if min_diff == None or chart['header']['difficulty'] < min_diff:
-            min_diff = chart['header']['difficulty']
+    # min/max are resolved over the selected parts only, the same as the
+    # readers do when they skip charts before parsing them
+    json_data['charts'] = helper.filter_charts(params, json_data['charts'])
 
-        if max_diff == None or chart['header']['difficulty'] > max_diff:
-            max_diff = chart['header']['difficulty']
-
-    filtered_charts = []
-    for chart in json_data['charts']:
-        if chart['header']['is_metadata'] != 0:
-            continue
-
-        part = ["drum", "guitar", "bass", "open"][chart['header']['game_type']]
-        has_all = 'all' in params['parts']
-        has_part = part in params['parts']
-
-        if not has_all and not has_part:
-            filtered_charts.append(chart)
-            continue
-
-        diff = ["nov", "bsc", "adv", "ext", "mst"][chart['header']['difficulty']]
-        has_min = 'min' in params['difficulty'] and chart['header']['difficulty'] == min_diff
-        has_max = 'max' in params['difficulty'] and chart['header']['difficulty'] == max_diff
-        has_all = 'all' in params['difficulty']
-        has_diff = diff in params['difficulty']
-
-        if not has_min and not has_max and not has_all and not has_diff:
-            filtered_charts.append(chart)
-            continue
-
-    for chart in filtered_charts:
-        json_data['charts'].remove(chart)
-
-    return json.dumps(json_data, indent=4)
+    return json_data
 
 
 def process_file(params):
@@ -112,6 +84,27 @@ def process_file(params):
     output_handler.to_chart(params)
 
 
+def get_referenced_sound_ids(params):
+    input_handler = find_handler(params.get('input'), params.get('input_format'))
+
+    if input_handler is None:
+        return None
+
+    json_data = filter_charts(input_handler.to_json(params), params)
+
+    if not json_data:
+        return None
+
+    sound_ids = set()
+    for chart in json_data.get('charts', []):
+        for timestamp_key in chart['timestamp']:
+            for event in chart['timestamp'][timestamp_key]:
+                if event['name'] in ['note', 'auto'] and 'sound_id' in event.get('data', {}):
+                    sound_ids.add(int(event['data']['sound_id']))
+
+    return sound_ids
+
+
 def get_sound_metadata(sound_folder):
     if not sound_folder:
         return None
@@ -120,7 +113,7 @@ def get_sound_metadata(sound_folder):
 
     if os.path.exists(sound_metadata_filename):
         with open(sound_metadata_filename, "r") as f:
-            return json.loads(f.read())
+            return soundmetadata.SoundMetadata(json.loads(f.read()))
 
     return None
 
@@ -155,6 +148,7 @@ if __name__ == "__main__":
     parser.add_argument('--no-sounds', action='store_true', help="Don't convert sound files", default=False)
     parser.add_argument('--copy-raw-files', action='store_true', help="Copy the raw files without processing", default=False)
     parser.add_argument('--generate-bgms', action='store_true', help="Generate BGMs for various combination of instruments as needed (SQ2/SQ3)", default=False)
+    parser.add_argument('--referenced-sounds-only', action='store_true', help="Only extract sounds used by the selected parts and difficulties (IFS)", default=False)
 
     parser.add_argument('--music-db', help="Music database file to read metadata about song")
     parser.add_argument('--music-id', type=int, help="Force a music ID", default=None)
@@ -167,10 +161,14 @@ if __name__ == "__main__":
     parser.add_argument('--render-volume-auto', help="Force volume of auto notes during rendering", default=100, type=int)
     parser.add_argument('--render-no-bgm', action='store_true', help="Mute BGM during render", default=False)
     parser.add_argument('--render-ignore-auto', action='store_true', help="Mute auto notes during render", default=False)
+    parser.add_argument('--render-processes', help="Number of processes used to mix audio during rendering (default: 1)", default=None, type=int)
+    parser.add_argument('--render-cache', help="Folder to cache rendered audio in so unchanged renders can be reused", default=None)
+    parser.add_argument('--render-measures', nargs=2, type=int, metavar=('START', 'END'), help="Only render measures START to END, counting the first measure as 0", default=None)
 
     parser.add_argument('--dtx-pad-start', help="Pad the start of the song by x measures", default=0, type=int)
     parser.add_argument('--dtx-pad-end', help="Pad the end of the song by x measures", default=2, type=int)
     parser.add_argument('--dtx-fake-timesigs', help="Fake time signatures when converting to DTX to work around x/4 limitation", default=False, action='store_true')
+    parser.add_argument('--dtx-processes', help="Number of processes used to parse DTX charts (default: 1)", default=None, type=int)
 
     parser.add_argument('--single-threaded', help="Process charts in single threads", default=False, action='store_true')
 
@@ -289,18 +287,13 @@ if __name__ == "__main__":
             if 'seq' not in file_set or not file_set['seq']:
                 return
 
-            # Extract va3 files
-            if 'sound' in file_set and not args.no_sounds:
-                print("Parsing %s..." % file_set['sound'])
-                vas3tool.read_vas3(file_set['sound'], sound_folder)
-
             params = {
                 "input": file_set['seq'],
                 "input_format": None,
                 "output": args.output,
                 "output_format": args.output_format,
                 "sound_folder": sound_folder,
-                "sound_metadata": get_sound_metadata(sound_folder),
+                "sound_metadata": None,
                 "event_file": file_set['event'] if 'event' in file_set else None,
                 "parts": args.parts,
                 "difficulty": args.difficulty,
@@ -345,13 +338,29 @@ if __name__ == "__main__":
                 "render_volume": args.render_volume,
                 "render_volume_bgm": args.render_volume_bgm,
                 "render_ignore_auto": args.render_ignore_auto,
+                "render_processes": args.render_processes,
+                "render_cache": args.render_cache,
+                "render_measures": args.render_measures,
                 "dtx_pad_start": args.dtx_pad_start,
                 "dtx_pad_end": args.dtx_pad_end,
                 "dtx_fake_timesigs": args.dtx_fake_timesigs,
+                "dtx_processes": args.dtx_processes,
                 "no_sounds": args.no_sounds,
                 "generate_bgms": args.generate_bgms,
             }
 
+            # Extract va3 files
+            if 'sound' in file_set and not args.no_sounds:
+                sound_ids = None
+
+                if args.referenced_sounds_only:
+                    sound_ids = get_referenced_sound_ids(params)
+
+                print("Parsing %s..." % file_set['sound'])
+                vas3tool.read_vas3(file_set['sound'], sound_folder, sound_ids=sound_ids)
+
+            params['sound_metadata'] = get_sound_metadata(sound_folder)
+
             process_file(params)
 
 
@@ -434,9 +443,13 @@ if __name__ == "__main__":
             "render_volume": args.render_volume,
             "render_volume_bgm": args.render_volume_bgm,
             "render_ignore_auto": args.render_ignore_auto,
+            "render_processes": args.render_processes,
+            "render_cache": args.render_cache,
+            "render_measures": args.render_measures,
             "dtx_pad_start": args.dtx_pad_start,
             "dtx_pad_end": args.dtx_pad_end,
             "dtx_fake_timesigs": args.dtx_fake_timesigs,
+            "dtx_processes": args.dtx_processes,
             "no_sounds": args.no_sounds,
             "generate_bgms": args.generate_bgms,
         }
@@ -0,0 +1,48 @@
+# Sound metadata (metadata.json) with lookup indexes
+
+
+class SoundMetadata(dict):
+    # Behaves like the plain metadata dict so it can still be passed around
+    # and serialized, but keeps the entries indexed for constant time lookups.
+    # Entries must be added with add_entry so the indexes stay up to date.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reindex()
+
+    def reindex(self):
+        self.entries_by_sound_id = {}
+        self.clipped_entries = {}
+
+        for entry in self.get('entries', []):
+            self.index_entry(entry)
+
+    def index_entry(self, entry):
+        # The first entry for a sound ID wins, same as the old linear searches
+        self.entries_by_sound_id.setdefault(int(entry['sound_id']), entry)
+
+        if entry.get('clipped', False):
+            self.clipped_entries.setdefault((entry['filename'], entry['duration']), entry)
+
+    def add_entry(self, entry):
+        self.setdefault('entries', []).append(entry)
+        self.index_entry(entry)
+
+    def get_entry(self, sound_id):
+        return self.entries_by_sound_id.get(int(sound_id))
+
+    def get_clipped_entry(self, filename, duration):
+        return self.clipped_entries.get((filename, duration))
+
+    def get_next_sound_id(self, sound_id=100):
+        if self.entries_by_sound_id:
+            sound_id = max(sound_id, max(self.entries_by_sound_id.keys()) + 1)
+
+        return sound_id
+
+
+def get_sound_metadata(sound_metadata):
+    if sound_metadata is None or isinstance(sound_metadata, SoundMetadata):
+        return sound_metadata
+
+    return SoundMetadata(sound_metadata)
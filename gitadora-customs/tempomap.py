@@ -0,0 +1,127 @@
+# Tempo/beat map for charts with timestamp based events (SQ2/SQ3)
+import bisect
+import math
+
+
+def get_tempo_map(chart, beats_by_timestamp):
+    # Sorted marker and tempo change arrays so beats and timestamps can be
+    # resolved with a binary search instead of scanning the whole chart.
+    # Every marker and tempo change starts a new segment, and the marker and
+    # tempo in effect for each segment are worked out once here.
+    marker_timestamps = sorted(beats_by_timestamp.keys())
+
+    bpm_timestamps = []
+    bpms = []
+    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
+        for beat in chart['timestamp'][timestamp_key]:
+            if beat['name'] == "bpm":
+                # Only the first tempo change at a timestamp is used
+                bpm_timestamps.append(int(timestamp_key))
+                bpms.append(beat['data']['bpm'])
+                break
+
+    segment_timestamps = sorted(set(marker_timestamps) | set(bpm_timestamps))
+    segment_markers = []
+    segment_bpms = []
+
+    marker_idx = 0
+    bpm_idx = 0
+    for timestamp in segment_timestamps:
+        while marker_idx < len(marker_timestamps) and marker_timestamps[marker_idx] <= timestamp:
+            marker_idx += 1
+
+        while bpm_idx < len(bpm_timestamps) and bpm_timestamps[bpm_idx] <= timestamp:
+            bpm_idx += 1
+
+        segment_markers.append(marker_timestamps[marker_idx - 1] if marker_idx > 0 else 0)
+        segment_bpms.append(bpms[bpm_idx - 1] if bpm_idx > 0 else 0)
+
+    return {
+        'beats_by_timestamp': beats_by_timestamp,
+        'marker_timestamps': marker_timestamps,
+        'bpm_timestamps': bpm_timestamps,
+        'bpms': bpms,
+        'segment_timestamps': segment_timestamps,
+        'segment_markers': segment_markers,
+        'segment_bpms': segment_bpms,
+        'segment_beats': {},
+    }
+
+
+def get_segment(tempo_map, timestamp):
+    # Returns the last marker and the tempo at timestamp. Before the first
+    # segment there's no tempo and the marker at 0 is used.
+    idx = bisect.bisect_right(tempo_map['segment_timestamps'], timestamp) - 1
+
+    if idx < 0:
+        return 0, 0
+
+    return tempo_map['segment_markers'][idx], tempo_map['segment_bpms'][idx]
+
+
+def get_last_marker_timestamp(tempo_map, timestamp):
+    return get_segment(tempo_map, timestamp)[0]
+
+
+def get_bpm_at_timestamp(tempo_map, timestamp):
+    return get_segment(tempo_map, timestamp)[1]
+
+
+def get_beat_at_timestamp(tempo_map, timestamp, denominator):
+    if timestamp in tempo_map['beats_by_timestamp']:
+        return tempo_map['beats_by_timestamp'][timestamp]
+
+    # Events between markers are offset from the last marker using the current tempo
+    last_timestamp, cur_bpm = get_segment(tempo_map, timestamp)
+
+    diff = timestamp - last_timestamp
+    tf = ((diff / 300) * (cur_bpm / 60)) * (1920 // denominator)
+
+    return tempo_map['beats_by_timestamp'][last_timestamp] + int(tf)
+
+
+def get_segment_beats(tempo_map, denominator):
+    # Beat at the start of every segment, built the first time a denominator
+    # is used so a beat's segment can be found with a binary search
+    if denominator not in tempo_map['segment_beats']:
+        tempo_map['segment_beats'][denominator] = [get_beat_at_timestamp(tempo_map, timestamp, denominator) for timestamp in tempo_map['segment_timestamps']]
+
+    return tempo_map['segment_beats'][denominator]
+
+
+def get_timestamp_at_beat(tempo_map, beat, denominator):
+    # Returns the first timestamp where get_beat_at_timestamp reaches beat.
+    # Beats are expected to only go up over time, as they do in real charts.
+    segment_timestamps = tempo_map['segment_timestamps']
+    idx = bisect.bisect_right(get_segment_beats(tempo_map, denominator), beat) - 1
+
+    if idx < 0:
+        return segment_timestamps[0] if segment_timestamps else 0
+
+    start_timestamp = segment_timestamps[idx]
+    end_timestamp = segment_timestamps[idx + 1] if idx + 1 < len(segment_timestamps) else None
+    last_timestamp = tempo_map['segment_markers'][idx]
+    cur_bpm = tempo_map['segment_bpms'][idx]
+
+    if cur_bpm <= 0:
+        # The beat doesn't move until the next segment
+        if get_beat_at_timestamp(tempo_map, start_timestamp, denominator) >= beat or end_timestamp is None:
+            return start_timestamp
+
+        return end_timestamp
+
+    diff = beat - tempo_map['beats_by_timestamp'][last_timestamp]
+    timestamp = last_timestamp + math.ceil((diff / (1920 // denominator)) * (60 / cur_bpm) * 300)
+    timestamp = max(timestamp, start_timestamp)
+
+    if end_timestamp is not None:
+        timestamp = min(timestamp, end_timestamp)
+
+    # Beats are truncated, so the estimate can be a timestamp or two off
+    while timestamp > start_timestamp and get_beat_at_timestamp(tempo_map, timestamp - 1, denominator) >= beat:
+        timestamp -= 1
+
+    while (end_timestamp is None or timestamp < end_timestamp) and get_beat_at_timestamp(tempo_map, timestamp, denominator) < beat:
+        timestamp += 1
+
+    return timestamp
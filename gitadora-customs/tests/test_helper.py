@@ -0,0 +1,75 @@
+import unittest
+
+import helper
+
+
+DRUM, GUITAR, BASS, OPEN = 0, 1, 2, 3
+NOV, BSC, ADV, EXT, MST = 0, 1, 2, 3, 4
+
+
+def get_selected_charts(params, charts):
+    # Same selection the readers make before parsing, for a list of (game_type, difficulty)
+    difficulties = helper.get_part_difficulties(params, charts)
+    return [chart for chart in charts if helper.is_chart_selected(params, chart[0], chart[1], difficulties)]
+
+
+class TestChartSelection(unittest.TestCase):
+    def test_all_parts(self):
+        params = {'parts': ['all'], 'difficulty': ['all']}
+        self.assertEqual(helper.get_selected_parts(params), ["drum", "guitar", "bass", "open"])
+        self.assertTrue(helper.is_part_selected(params, OPEN))
+
+    def test_part_filter(self):
+        params = {'parts': ['guitar'], 'difficulty': ['all']}
+        self.assertFalse(helper.is_chart_selected(params, DRUM, EXT))
+        self.assertTrue(helper.is_chart_selected(params, GUITAR, EXT))
+
+    def test_difficulty_filter(self):
+        params = {'parts': ['drum'], 'difficulty': ['bsc', 'mst']}
+        self.assertEqual(get_selected_charts(params, [(DRUM, NOV), (DRUM, BSC), (DRUM, MST)]), [(DRUM, BSC), (DRUM, MST)])
+
+    def test_max_mixed_parts(self):
+        # A file with a drum EXT and a guitar MST chart: max is the drum EXT
+        # chart when only drums are selected, not the guitar's MST
+        charts = [(DRUM, EXT), (GUITAR, MST)]
+        params = {'parts': ['drum'], 'difficulty': ['max']}
+        self.assertEqual(helper.get_part_difficulties(params, charts), [EXT])
+        self.assertEqual(get_selected_charts(params, charts), [(DRUM, EXT)])
+
+    def test_min_mixed_parts(self):
+        charts = [(DRUM, ADV), (DRUM, EXT), (GUITAR, NOV), (BASS, BSC)]
+        params = {'parts': ['drum'], 'difficulty': ['min']}
+        self.assertEqual(get_selected_charts(params, charts), [(DRUM, ADV)])
+
+    def test_max_several_parts(self):
+        # min/max are resolved over every selected part together
+        charts = [(DRUM, EXT), (GUITAR, MST), (BASS, MST)]
+        params = {'parts': ['drum', 'bass'], 'difficulty': ['max']}
+        self.assertEqual(get_selected_charts(params, charts), [(BASS, MST)])
+
+    def test_max_all_parts(self):
+        charts = [(DRUM, EXT), (GUITAR, MST)]
+        params = {'parts': ['all'], 'difficulty': ['max']}
+        self.assertEqual(get_selected_charts(params, charts), [(GUITAR, MST)])
+
+
+def get_chart(game_type, difficulty, is_metadata=0):
+    return {'header': {'game_type': game_type, 'difficulty': difficulty, 'is_metadata': is_metadata}}
+
+
+class TestFilterCharts(unittest.TestCase):
+    def test_max_mixed_parts(self):
+        # seqtool used to resolve max over every chart, so the drum EXT chart
+        # was dropped because of the guitar's MST chart
+        charts = [get_chart(DRUM, EXT), get_chart(GUITAR, MST)]
+        params = {'parts': ['drum'], 'difficulty': ['max']}
+        self.assertEqual(helper.filter_charts(params, charts), [get_chart(DRUM, EXT)])
+
+    def test_metadata_kept(self):
+        charts = [get_chart(DRUM, MST, is_metadata=1), get_chart(DRUM, NOV), get_chart(DRUM, ADV)]
+        params = {'parts': ['drum'], 'difficulty': ['min']}
+        self.assertEqual(helper.filter_charts(params, charts), [get_chart(DRUM, MST, is_metadata=1), get_chart(DRUM, NOV)])
+
+
+if __name__ == "__main__":
+    unittest.main()
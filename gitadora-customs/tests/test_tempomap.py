@@ -0,0 +1,215 @@
+import random
+import unittest
+
+import tempomap
+
+
+def bpm_event(bpm):
+    return {'name': "bpm", 'data': {'bpm': bpm}}
+
+
+def note_event():
+    return {'name': "note", 'data': {}}
+
+
+def get_chart(events):
+    return {'timestamp': {str(timestamp): events[timestamp] for timestamp in events}}
+
+
+def get_beat_reference(chart, beats_by_timestamp, timestamp, denominator):
+    # The linear walk the SQ2/SQ3 readers used before the tempo map
+    last_timestamp = 0
+    cur_bpm = 0
+
+    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
+        if int(timestamp_key) > timestamp:
+            break
+
+        if int(timestamp_key) in beats_by_timestamp:
+            last_timestamp = int(timestamp_key)
+
+        for beat in chart['timestamp'][timestamp_key]:
+            if beat['name'] == "bpm":
+                cur_bpm = beat['data']['bpm']
+                break
+
+    if timestamp in beats_by_timestamp:
+        return beats_by_timestamp[timestamp]
+
+    diff = timestamp - last_timestamp
+    tf = ((diff / 300) * (cur_bpm / 60)) * (1920 // denominator)
+
+    return beats_by_timestamp[last_timestamp] + int(tf)
+
+
+class TestTempoMap(unittest.TestCase):
+    def test_constant_tempo(self):
+        # 120 BPM in 4/4 is two beats of 480 ticks every second (300 timestamps)
+        chart = get_chart({0: [bpm_event(120)], 300: [note_event()]})
+        tempo_map = tempomap.get_tempo_map(chart, {0: 0})
+
+        self.assertEqual(tempomap.get_beat_at_timestamp(tempo_map, 150, 4), 480)
+        self.assertEqual(tempomap.get_beat_at_timestamp(tempo_map, 300, 4), 960)
+
+    def test_tempo_change(self):
+        chart = get_chart({0: [bpm_event(120)], 600: [bpm_event(60)], 900: [note_event()]})
+        tempo_map = tempomap.get_tempo_map(chart, {0: 0, 600: 1920})
+
+        self.assertEqual(tempomap.get_bpm_at_timestamp(tempo_map, 599), 120)
+        self.assertEqual(tempomap.get_bpm_at_timestamp(tempo_map, 600), 60)
+
+        # Offsets after the change use the new tempo from the last marker
+        self.assertEqual(tempomap.get_beat_at_timestamp(tempo_map, 900, 4), 1920 + 480)
+
+    def test_denominator(self):
+        chart = get_chart({0: [bpm_event(120)]})
+        tempo_map = tempomap.get_tempo_map(chart, {0: 0})
+
+        self.assertEqual(tempomap.get_beat_at_timestamp(tempo_map, 150, 8), 240)
+
+    def test_first_bpm_event_only(self):
+        chart = get_chart({0: [bpm_event(120), bpm_event(240)]})
+        tempo_map = tempomap.get_tempo_map(chart, {0: 0})
+
+        self.assertEqual(tempo_map['bpms'], [120])
+
+    def test_marker_boundary(self):
+        # A timestamp exactly on a marker uses the marker's beat, even if the
+        # tempo up to it would put it somewhere else
+        chart = get_chart({0: [bpm_event(120)], 300: [bpm_event(90)]})
+        tempo_map = tempomap.get_tempo_map(chart, {0: 0, 300: 1000})
+
+        self.assertEqual(tempomap.get_last_marker_timestamp(tempo_map, 299), 0)
+        self.assertEqual(tempomap.get_last_marker_timestamp(tempo_map, 300), 300)
+        self.assertEqual(tempomap.get_beat_at_timestamp(tempo_map, 300, 4), 1000)
+        self.assertEqual(tempomap.get_beat_at_timestamp(tempo_map, 299, 4), int(((299 / 300) * (120 / 60)) * 480))
+
+    def test_tempo_change_boundary(self):
+        chart = get_chart({0: [bpm_event(120)], 300: [bpm_event(240)]})
+        tempo_map = tempomap.get_tempo_map(chart, {0: 0})
+
+        # The new tempo already applies at the timestamp of the change
+        self.assertEqual(tempomap.get_beat_at_timestamp(tempo_map, 300, 4), 1920)
+
+    def test_before_first_tempo(self):
+        # Events before the first tempo change have no tempo to offset with
+        chart = get_chart({0: [note_event()], 150: [note_event()], 300: [bpm_event(120)]})
+        tempo_map = tempomap.get_tempo_map(chart, {0: 100})
+
+        self.assertEqual(tempomap.get_bpm_at_timestamp(tempo_map, 150), 0)
+        self.assertEqual(tempomap.get_beat_at_timestamp(tempo_map, 150, 4), 100)
+
+    def test_between_markers(self):
+        chart = get_chart({0: [bpm_event(120)], 600: [note_event()]})
+        tempo_map = tempomap.get_tempo_map(chart, {0: 0, 600: 1920})
+
+        self.assertEqual(tempomap.get_last_marker_timestamp(tempo_map, 300), 0)
+        self.assertEqual(tempomap.get_beat_at_timestamp(tempo_map, 300, 4), 960)
+
+    def test_before_first_event(self):
+        # Timestamps before everything fall back to the marker at 0 with no tempo
+        chart = get_chart({-150: [note_event()], 0: [bpm_event(120)]})
+        tempo_map = tempomap.get_tempo_map(chart, {0: 0})
+
+        self.assertEqual(tempomap.get_last_marker_timestamp(tempo_map, -150), 0)
+        self.assertEqual(tempomap.get_beat_at_timestamp(tempo_map, -150, 4), 0)
+        self.assertEqual(tempomap.get_beat_at_timestamp(tempo_map, -150, 4), get_beat_reference(chart, {0: 0}, -150, 4))
+
+    def test_matches_reference(self):
+        rng = random.Random(0)
+
+        for _ in range(20):
+            events = {0: [bpm_event(rng.choice([90, 120, 150.5, 180]))]}
+            beats_by_timestamp = {0: 0}
+
+            beat = 0
+            for timestamp in sorted(rng.sample(range(1, 20000), 200)):
+                event = rng.random()
+
+                if event < 0.1:
+                    events[timestamp] = [bpm_event(rng.uniform(60, 300))]
+                elif event < 0.3:
+                    events[timestamp] = [note_event()]
+                    beat += rng.randint(1, 8) * 480
+                    beats_by_timestamp[timestamp] = beat
+                else:
+                    events[timestamp] = [note_event()]
+
+            chart = get_chart(events)
+            tempo_map = tempomap.get_tempo_map(chart, beats_by_timestamp)
+
+            for timestamp in events:
+                for denominator in [4, 8, 16]:
+                    self.assertEqual(tempomap.get_beat_at_timestamp(tempo_map, timestamp, denominator),
+                                     get_beat_reference(chart, beats_by_timestamp, timestamp, denominator))
+
+
+    def test_segments(self):
+        chart = get_chart({0: [bpm_event(120)], 450: [bpm_event(60)], 900: [note_event()]})
+        tempo_map = tempomap.get_tempo_map(chart, {0: 0, 600: 1920})
+
+        self.assertEqual(tempo_map['segment_timestamps'], [0, 450, 600])
+        self.assertEqual(tempo_map['segment_markers'], [0, 0, 600])
+        self.assertEqual(tempo_map['segment_bpms'], [120, 60, 60])
+        self.assertEqual(tempomap.get_segment_beats(tempo_map, 4), [0, 720, 1920])
+
+
+class TestTimestampAtBeat(unittest.TestCase):
+    def test_constant_tempo(self):
+        chart = get_chart({0: [bpm_event(120)]})
+        tempo_map = tempomap.get_tempo_map(chart, {0: 0})
+
+        self.assertEqual(tempomap.get_timestamp_at_beat(tempo_map, 0, 4), 0)
+        self.assertEqual(tempomap.get_timestamp_at_beat(tempo_map, 480, 4), 150)
+        self.assertEqual(tempomap.get_timestamp_at_beat(tempo_map, 960, 4), 300)
+        self.assertEqual(tempomap.get_timestamp_at_beat(tempo_map, 240, 8), 150)
+
+    def test_marker(self):
+        chart = get_chart({0: [bpm_event(120)], 600: [bpm_event(60)]})
+        tempo_map = tempomap.get_tempo_map(chart, {0: 0, 600: 1920})
+
+        self.assertEqual(tempomap.get_timestamp_at_beat(tempo_map, 1920, 4), 600)
+        self.assertEqual(tempomap.get_timestamp_at_beat(tempo_map, 1920 + 480, 4), 900)
+
+    def test_no_tempo(self):
+        # Without a tempo the beat stays at the marker's beat until the next segment
+        chart = get_chart({0: [note_event()], 300: [bpm_event(120)]})
+        tempo_map = tempomap.get_tempo_map(chart, {0: 100})
+
+        self.assertEqual(tempomap.get_timestamp_at_beat(tempo_map, 100, 4), 0)
+        self.assertEqual(tempomap.get_timestamp_at_beat(tempo_map, 101, 4), 300)
+
+    def test_matches_beat_at_timestamp(self):
+        # The timestamp returned is the first one whose beat reaches the
+        # requested beat
+        rng = random.Random(1)
+
+        for _ in range(20):
+            events = {0: [bpm_event(rng.choice([90, 120, 150.5, 180]))]}
+            beats_by_timestamp = {0: 0}
+
+            for timestamp in sorted(rng.sample(range(1, 20000), 100)):
+                if rng.random() < 0.2:
+                    events[timestamp] = [bpm_event(rng.uniform(60, 300))]
+                else:
+                    events[timestamp] = [note_event()]
+
+                if events[timestamp][0]['name'] == "bpm" or rng.random() < 0.1:
+                    # Markers never go back from the beat the tempo had reached,
+                    # as in a real chart
+                    tempo_map = tempomap.get_tempo_map(get_chart(events), beats_by_timestamp)
+                    beats_by_timestamp[timestamp] = tempomap.get_beat_at_timestamp(tempo_map, timestamp - 1, 4) + rng.randint(1, 3) * 480
+
+            tempo_map = tempomap.get_tempo_map(get_chart(events), beats_by_timestamp)
+            last_beat = tempomap.get_beat_at_timestamp(tempo_map, 20000, 4)
+
+            # Everything before the start of the chart is at beat 0
+            for beat in rng.sample(range(1, last_beat), 200) + list(beats_by_timestamp.values())[1:]:
+                timestamp = tempomap.get_timestamp_at_beat(tempo_map, beat, 4)
+
+                self.assertGreaterEqual(tempomap.get_beat_at_timestamp(tempo_map, timestamp, 4), beat)
+                self.assertLess(tempomap.get_beat_at_timestamp(tempo_map, timestamp - 1, 4), beat)
+
+
+if __name__ == "__main__":
+    unittest.main()
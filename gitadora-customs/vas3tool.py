@@ -1,4 +1,5 @@
 import argparse
+import hashlib
 import io
 import json
 import math
@@ -107,6 +108,11 @@ def write_vas3(input_foldername, output_filename, metadata=None):
         defaults = [metadata['defaults'][x] for x in metadata['defaults']]
         data_section = bytearray()
 
+        # Multiple entries can point to the same sound data, so only encode
+        # and store each unique payload once and reuse its offset afterwards
+        payloads_by_filename = {}
+        payloads_by_hash = {}
+
         for entry in metadata['entries']:
             filename = entry['filename']
 
@@ -149,13 +155,32 @@ def write_vas3(input_foldername, output_filename, metadata=None):
             # wavfile for the was3tool since looping isn't required
             # TODO: Replace this with code to detect if it's a WAV, 16bit, mono, and 48000 and if so, use wavfile instead
             #print(filename)
-            filename = audio.get_processed_wav(filename, channels=1, rate=48000, bits=16)
+            if filename in payloads_by_filename:
+                payload_key = payloads_by_filename[filename]
+
+            else:
+                processed_filename = audio.get_processed_wav(filename, channels=1, rate=48000, bits=16)
+
+                rate, raw_data, bits = wavfile.read(processed_filename)
+
+                channels = 1 if len(raw_data.shape) == 1 else raw_data.shape[1]
+
+                payload_key = (hashlib.sha1(raw_data.tobytes()).hexdigest(), channels, rate)
+                payloads_by_filename[filename] = payload_key
 
-            rate, raw_data, bits = wavfile.read(filename)
+                if payload_key not in payloads_by_hash:
+                    encoded_data = adpcmwave.encode_data(raw_data, channels)
 
-            channels = 1 if len(raw_data.shape) == 1 else raw_data.shape[1]
+                    payloads_by_hash[payload_key] = (len(data_section), len(encoded_data))
 
-            encoded_data = adpcmwave.encode_data(raw_data, channels)
+                    data_section += encoded_data
+
+                    padding = 0x10 - (len(data_section) % 0x10)
+                    if padding != 0x10:
+                        data_section += bytearray([0] * padding)
+
+            _, channels, rate = payload_key
+            data_offset, data_size = payloads_by_hash[payload_key]
 
             sound_flag = 0
             for flag in entry['flags']:
@@ -177,8 +202,8 @@ def write_vas3(input_foldername, output_filename, metadata=None):
             if version < 2:
                 volume = VOLUME_TABLE.index(min(VOLUME_TABLE, key=lambda x:abs(x-entry['volume'])))
 
-            outfile.write(struct.pack("<I", len(data_section)))
-            outfile.write(struct.pack("<I", len(encoded_data)))
+            outfile.write(struct.pack("<I", data_offset))
+            outfile.write(struct.pack("<I", data_size))
             outfile.write(struct.pack("<H", channels))
             outfile.write(struct.pack("<H", 0x10)) # Will this ever not be 16 bit?
             outfile.write(struct.pack("<I", rate))
@@ -196,12 +221,6 @@ def write_vas3(input_foldername, output_filename, metadata=None):
             if len(filename_bytes) < 0x20:
                 outfile.write(bytearray([0] * (0x20 - len(filename_bytes))))
 
-            data_section += encoded_data
-
-            padding = 0x10 - (len(data_section) % 0x10)
-            if padding != 0x10:
-                data_section += bytearray([0] * padding)
-
 
         if outfile.tell() < data_start:
             outfile.write(bytearray([0] * (data_start - outfile.tell()))) # Padding
@@ -209,7 +228,7 @@ def write_vas3(input_foldername, output_filename, metadata=None):
         outfile.write(data_section)
 
 
-def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False):
+def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False, sound_ids=None):
     data = open(input_filename, "rb").read()
 
     if data[0:4].decode('ascii') != "VA3W":
@@ -359,6 +378,13 @@ def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False):
         if (sound_flag & 0x0100) != 0:
             metadata['entries'][-1]['flags'].append("NoFilename")
 
+    if sound_ids is not None:
+        # Only extract the requested sounds. Default sounds are always kept
+        # so the metadata stays usable when creating a new archive from it.
+        sound_ids = set(sound_ids) | set(metadata['defaults'].values())
+        entries = [x for x in entries if x['sound_id'] in sound_ids]
+        metadata['entries'] = [x for x in metadata['entries'] if x['sound_id'] in sound_ids]
+
     if output_folder:
         basepath = output_folder
     else: